@@ -1,7 +1,29 @@
 import streamlit as st
-from travelAgent import run_conversation, list_existing_users
-import os
-from tts import TextToSpeech
+from travelAgent import (run_conversation, stream_conversation, user_exists, get_existing_user_ids,
+                         missing_info_responses, components, AgentComponents,
+                         LOG_LEVEL, LOG_FORMAT, METRICS_PORT, METRICS_HOST)
+from metrics import metrics, configure_logging, start_metrics_server
+from tts import SpeechSynthesizer, TextToSpeech
+
+# Fixed text the app speaks, synthesized into the speech cache at startup: the templated answers
+# to recommendation requests with missing budget, companions or travel time. Other replies,
+# including the welcome message, are generated by the model and never repeat exactly.
+PREWARM_PHRASES = missing_info_responses()
+
+@st.cache_resource(show_spinner="Starting the travel agent...")
+def load_agent() -> AgentComponents:
+    """Build the agent's clients, stores and graphs once per process, shared by all sessions and reruns."""
+    configure_logging(LOG_LEVEL, LOG_FORMAT)
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT, METRICS_HOST)
+    return components.build()
+
+@st.cache_resource(show_spinner=False)
+def load_speech_synthesizer() -> SpeechSynthesizer:
+    """Create the speech client and synthesis cache once per process and prewarm the cache."""
+    synthesizer = SpeechSynthesizer()
+    synthesizer.prewarm(PREWARM_PHRASES, wait_for_completion=False)
+    return synthesizer
 
 def initialize_session_state():
     """Initialize session state variables."""
@@ -9,25 +31,44 @@ def initialize_session_state():
         st.session_state.messages = []
     if 'user_id' not in st.session_state:
         st.session_state.user_id = None
+    if 'is_new_user' not in st.session_state:
+        st.session_state.is_new_user = True
     if 'tts' not in st.session_state:
-        st.session_state.tts = TextToSpeech()
+        # Only the playback of the session's speech is per session
+        st.session_state.tts = TextToSpeech(synthesizer=load_speech_synthesizer())
+
+def show_turn_breakdown():
+    """Show where the time, tokens and cost of the user's last turn went."""
+    turn = metrics.last_turn(st.session_state.user_id) if st.session_state.user_id else None
+    if turn is None or turn["ms"] is None:
+        return
+    st.subheader("Last Turn")
+    st.write(f"{turn['ms']:.0f} ms, {turn['prompt_tokens']} prompt and {turn['completion_tokens']} "
+             f"completion tokens, ${turn['cost_usd']:.5f}")
+    st.dataframe(
+        [{"call": f"{row['kind']}: {row['name']}" + (" (background)" if row["background"] else ""), "calls": row["calls"], "ms": round(row["ms"]),
+          "tokens": row["prompt_tokens"] + row["completion_tokens"], "cost ($)": round(row["cost_usd"], 6)}
+         for row in turn["breakdown"]],
+        hide_index=True
+    )
 
 def main():
     st.title("AI Travel Agent 🌎✈️")
     
     # Initialize session state
+    load_agent()
     initialize_session_state()
     
-    # Sidebar for user management
+    # Sidebar for user management; the last turn's breakdown is filled in once the turn is done
     with st.sidebar:
+        turn_breakdown = st.container()
         st.header("User Management")
         
         # Option to enter existing user ID
         existing_id = st.text_input("Enter your user ID (if returning):")
         if existing_id:
-            if os.path.exists(os.path.join("./travel_memory", existing_id)):
-                import travelAgent
-                travelAgent.is_new_user = False
+            if user_exists(existing_id):
+                st.session_state.is_new_user = False
                 st.session_state.user_id = existing_id
                 st.success(f"Welcome back! User ID: {existing_id}")
             else:
@@ -35,9 +76,8 @@ def main():
         
         # Option to create new user
         if st.button("Start New Session"):
-            import travelAgent
-            travelAgent.is_new_user = True
-            _, response = run_conversation("Hello", None)  # This will create a new user
+            st.session_state.is_new_user = True
+            _, response = run_conversation("Hello", None, is_new_user=True)  # This will create a new user
             st.session_state.user_id = _
             st.success(f"New session created! Your User ID: {st.session_state.user_id}")
             # Play welcome message
@@ -46,15 +86,13 @@ def main():
         # Show existing users
         st.subheader("Existing Users")
         try:
-            base_dir = "./travel_memory"
-            if os.path.exists(base_dir):
-                users = [d for d in os.listdir(base_dir) if os.path.isdir(os.path.join(base_dir, d))]
-                if users:
-                    st.write("Available user IDs:")
-                    for user in users:
-                        st.code(user)
-                else:
-                    st.write("No existing users found.")
+            users = get_existing_user_ids()
+            if users:
+                st.write("Available user IDs:")
+                for user in users:
+                    st.code(user)
+            else:
+                st.write("No existing users found.")
         except Exception as e:
             st.error(f"Error listing users: {e}")
     
@@ -81,14 +119,33 @@ def main():
         with st.chat_message("user"):
             st.markdown(prompt)
         
-        # Get agent response
+        # Stream the agent response as it is generated
         with st.chat_message("assistant"):
-            with st.spinner("Thinking..."):
-                _, response = run_conversation(prompt, st.session_state.user_id)
-                st.markdown(response)
-                # Play the response audio
-                st.session_state.tts.play(response)
-                st.session_state.messages.append({"role": "assistant", "content": response})
+            _, response_stream = stream_conversation(
+                prompt,
+                st.session_state.user_id,
+                is_new_user=st.session_state.is_new_user
+            )
+            # Speak each sentence as soon as it has been streamed; playback runs in the
+            # background and is queued after any audio still playing from the last turn
+            speech = st.session_state.tts.start_stream(interrupt=False)
+            
+            def speak_while_streaming():
+                for chunk in response_stream:
+                    speech.feed(chunk)
+                    yield chunk
+            
+            try:
+                response = st.write_stream(speak_while_streaming())
+            except BaseException:
+                # Also on a Streamlit rerun or stop, so the playback worker moves on to later speech
+                speech.cancel()
+                raise
+            speech.finish()
+            st.session_state.messages.append({"role": "assistant", "content": response})
+    
+    with turn_breakdown:
+        show_turn_breakdown()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -0,0 +1,452 @@
+"""Benchmark the travel agent end to end, offline.
+
+The chat model, the embeddings and the Google text-to-speech client are replaced by
+deterministic local fakes with a configurable latency, so no API calls are made and runs
+are repeatable. Scripted multi-turn sessions are driven through run_conversation for
+every simulated user. For each combination of user count and session length, run in a
+fresh process and temporary directory, the benchmark reports turn latency percentiles,
+LLM calls and prompt tokens per turn, speech synthesis latency, the vector store size
+and the process RSS. Results can be written as JSON and compared with an earlier run.
+
+The graph, extraction and vector store modes are read from the environment as usual,
+e.g. MEMORY_GRAPH_MODE=background python bench_agent.py.
+"""
+from typing import Any, Dict, List, Optional
+import argparse
+import contextvars
+import hashlib
+import io
+import json
+import os
+import random
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import wave
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Scripted sessions: the user introduces themselves, gives the essential travel details,
+# asks for a recommendation and then keeps chatting with follow-up questions
+SCRIPT = [
+    "Hi, my name is {name}.",
+    "We live in {city} and we love {preference} holidays.",
+    "Our budget is around ${amount}.",
+    "I'll be traveling with {companions}.",
+    "We would like to go in {month}.",
+    "Can you recommend a destination for us?",
+    "What is the food like there?",
+    "Any tips for getting around?",
+    "Thanks, that sounds great!"
+]
+FOLLOW_UPS = [
+    "Tell me more about the second option.",
+    "How many days should we plan for that?",
+    "Last year we went to {past} and really enjoyed it.",
+    "Is it crowded at that time of year?",
+    "What would you suggest for a rainy day?",
+    "Could you suggest something a bit cheaper?",
+    "We don't like long flights.",
+    "What should we pack?"
+]
+CHOICES = {
+    "name": ["Alex", "Sam", "Maria", "Kenji", "Priya", "Lena"],
+    "city": ["Berlin", "Toronto", "Lisbon", "Osaka", "Austin"],
+    "preference": ["beach", "mountain", "city", "countryside"],
+    "companions": ["my partner", "my family with two kids", "two friends", "nobody, I travel solo"],
+    "month": ["January", "April", "July", "October", "December"],
+    "past": ["Crete", "Kyoto", "Iceland", "Tuscany", "Peru"]
+}
+DESTINATIONS = ["Lisbon", "the Algarve", "Kyoto", "the Dolomites", "Crete", "Vancouver Island",
+                "Cape Town", "Bali", "the Scottish Highlands", "Oaxaca"]
+
+def user_script(user_index: int, turns: int) -> List[str]:
+    """Return the scripted inputs of a simulated user's session."""
+    rng = random.Random(user_index)
+    values = {key: rng.choice(options) for key, options in CHOICES.items()}
+    values["amount"] = rng.randrange(1000, 10000, 500)
+    inputs = [text.format(**values) for text in SCRIPT]
+    while len(inputs) < turns:
+        inputs.append(rng.choice(FOLLOW_UPS).format(**values))
+    return inputs[:turns]
+
+def estimate_tokens(text: str) -> int:
+    """Deterministic token estimate: words and punctuation marks."""
+    return len(re.findall(r"\w+|[^\w\s]", text))
+
+# Counters of the turn that is running in the current context; LLM calls of background
+# work the turn does not wait for (background memory checks) are only counted in the totals
+current_turn: contextvars.ContextVar[Optional[Dict[str, int]]] = contextvars.ContextVar("current_turn", default=None)
+_counter_lock = threading.Lock()
+
+def fake_reply(prompt: str) -> str:
+    """Return a plausible, deterministic completion for one of the agent's prompts."""
+    # The memory prompts end with the user input followed by the instructions
+    user_input = prompt.rsplit("User input:", 1)[-1].split("\n\n")[0]
+    if "Answer with 'yes' or 'no'" in prompt:
+        return "yes" if fake_extraction(user_input) else "no"
+    if "Return ONLY a valid JSON object" in prompt:
+        return json.dumps(fake_extraction(user_input))
+    if "Progressively summarize" in prompt:
+        return "The user is planning a trip and has shared their preferences with the travel agent."
+    rng = random.Random(hashlib.sha256(prompt.encode("utf-8")).digest())
+    first, second = rng.sample(DESTINATIONS, 2)
+    if "generate a personalized travel recommendation" in prompt:
+        return (f"{first} would be perfect for you, as it matches your budget and travel style. "
+                f"If you'd like an alternative, {second} is lovely at that time of year too.")
+    return (f"That's a great question, and {first} handles it really well for travelers like you. "
+            f"You could also consider {second} if you want something a little different.")
+
+def fake_extraction(user_input: str) -> Dict[str, Any]:
+    info: Dict[str, Any] = {}
+    name = re.search(r"my name is (\w+)", user_input, re.IGNORECASE)
+    if name:
+        info["user_name"] = name.group(1)
+    budget = re.search(r"\$\s?[\d,]+", user_input)
+    if budget:
+        info["budget"] = budget.group(0)
+    companions = re.search(r"traveling with ([^.]+)", user_input)
+    if companions:
+        info["travel_companions"] = companions.group(1)
+    month = re.search(r"\b(January|April|July|October|December)\b", user_input)
+    if month:
+        info["travel_time"] = month.group(1)
+    preference = re.search(r"love (\w+) holidays", user_input)
+    if preference:
+        info["vacation_preferences"] = {"type": preference.group(1)}
+    past = re.search(r"went to (\w+)", user_input)
+    if past:
+        info["past_vacations"] = [past.group(1)]
+    return info
+
+def create_fake_llm(latency_seconds: float):
+    """Create a chat model that answers the agent's prompts locally after latency_seconds."""
+    from langchain_core.language_models.chat_models import BaseChatModel
+    from langchain_core.messages import AIMessage
+    from langchain_core.outputs import ChatGeneration, ChatResult
+    from metrics import is_background
+
+    class FakeChatModel(BaseChatModel):
+        latency_seconds: float = 0.0
+        totals: Dict[str, int] = {}
+
+        @property
+        def _llm_type(self) -> str:
+            return "fake-chat"
+
+        def get_num_tokens(self, text: str) -> int:
+            return estimate_tokens(text)
+
+        def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+            prompt = "\n".join(str(message.content) for message in messages)
+            reply = fake_reply(prompt)
+            prompt_tokens = estimate_tokens(prompt)
+            time.sleep(self.latency_seconds)
+            with _counter_lock:
+                for counters in (self.totals, None if is_background() else current_turn.get()):
+                    if counters is None:
+                        continue
+                    counters["llm_calls"] = counters.get("llm_calls", 0) + 1
+                    counters["prompt_tokens"] = counters.get("prompt_tokens", 0) + prompt_tokens
+                    counters["completion_tokens"] = counters.get("completion_tokens", 0) + estimate_tokens(reply)
+            return ChatResult(generations=[ChatGeneration(message=AIMessage(content=reply))])
+
+    return FakeChatModel(latency_seconds=latency_seconds, totals={"llm_calls": 0})
+
+def create_fake_embeddings(latency_seconds: float):
+    """Create local hashing embeddings that take latency_seconds per request."""
+    from embedding_providers import HashingEmbeddings
+
+    class SlowHashingEmbeddings(HashingEmbeddings):
+        def __init__(self):
+            super().__init__()
+            self.requests = 0
+
+        def embed_documents(self, texts: List[str]) -> List[List[float]]:
+            # One request embeds the whole batch, as with the OpenAI API
+            time.sleep(latency_seconds)
+            self.requests += 1
+            return [HashingEmbeddings.embed_query(self, text) for text in texts]
+
+        def embed_query(self, text: str) -> List[float]:
+            return self.embed_documents([text])[0]
+
+    return SlowHashingEmbeddings()
+
+def silent_wav(text: str, rate: int = 24000) -> bytes:
+    """Return silent LINEAR16 audio as long as text would take to speak."""
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as audio:
+        audio.setnchannels(1)
+        audio.setsampwidth(2)
+        audio.setframerate(rate)
+        # About 15 characters per second of speech
+        audio.writeframes(b"\0\0" * (rate * len(text) // 15))
+    return buffer.getvalue()
+
+class FakeSpeechClient:
+    """Stand-in for google.cloud.texttospeech.TextToSpeechClient that returns silence after a delay."""
+
+    def __init__(self, latency_seconds: float):
+        self.latency_seconds = latency_seconds
+        self.requests = 0
+
+    def synthesize_speech(self, input, voice, audio_config):
+        time.sleep(self.latency_seconds)
+        self.requests += 1
+        return SimpleNamespace(audio_content=silent_wav(input.text))
+
+def create_fake_tts(latency_seconds: float, cache_dir: str):
+    """Create a TextToSpeech whose client is a FakeSpeechClient; audio is never played."""
+    os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+    from unittest import mock
+    import tts
+    client = FakeSpeechClient(latency_seconds)
+    with mock.patch.object(tts.texttospeech, "TextToSpeechClient", lambda: client):
+        return tts.TextToSpeech(cache_dir=cache_dir)
+
+def percentile(values: List[float], share: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))] if ordered else 0.0
+
+def latency_summary(values: List[float]) -> Dict[str, float]:
+    return {"p50": percentile(values, 0.5), "p95": percentile(values, 0.95),
+            "p99": percentile(values, 0.99), "max": max(values, default=0.0)}
+
+def rss_mb() -> Dict[str, float]:
+    """Return the current and peak resident set size of this process."""
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak = peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+    try:
+        with open("/proc/self/statm") as statm:
+            current = int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except OSError:
+        current = peak
+    return {"current": current, "peak": peak}
+
+def directory_bytes(path: str) -> int:
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+def run_sessions(users: int, turns: int, args) -> Dict[str, Any]:
+    """Run the scripted sessions of all users in this process and return the measurements."""
+    import travelAgent
+    from embedding_providers import CachedEmbeddings
+
+    llm = create_fake_llm(args.llm_latency_ms / 1000)
+    embeddings = create_fake_embeddings(args.embedding_latency_ms / 1000)
+    cache_path = travelAgent.EMBEDDING_CACHE_PATH
+    travelAgent.components.configure(
+        llm=llm, embeddings=CachedEmbeddings(embeddings, cache_path, name=embeddings.name) if cache_path else embeddings
+    )
+    speech = None
+    if args.tts_latency_ms >= 0:
+        # Speech needs pygame and the Google client library, so they are only imported when benchmarked
+        from tts import split_sentences
+        speech = create_fake_tts(args.tts_latency_ms / 1000, "./tts_cache")
+    travelAgent.components.build()
+    rss_before = rss_mb()
+
+    records: List[Dict[str, Any]] = []
+    records_lock = threading.Lock()
+
+    def run_user(user_index: int):
+        user_id = None
+        for turn, user_input in enumerate(user_script(user_index, turns)):
+            counters = {"llm_calls": 0, "prompt_tokens": 0}
+            token = current_turn.set(counters)
+            start = time.perf_counter()
+            try:
+                user_id, response = travelAgent.run_conversation(user_input, user_id, is_new_user=False)
+            finally:
+                current_turn.reset(token)
+            latency_ms = (time.perf_counter() - start) * 1000
+            record = {"turn": turn, "latency_ms": latency_ms, **counters}
+            if speech is not None:
+                # Pipelined playback starts once the first sentence is synthesized
+                start = time.perf_counter()
+                first_sentence = next(iter(split_sentences(response)), response)
+                speech.synthesize(first_sentence)
+                record["tts_first_audio_ms"] = (time.perf_counter() - start) * 1000
+            with records_lock:
+                records.append(record)
+        return user_id
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as executor:
+        user_ids = list(executor.map(run_user, range(users)))
+    elapsed = time.perf_counter() - start
+    travelAgent.wait_for_pending_memory_checks()
+
+    vectorstore = travelAgent.components.vectorstore
+    # Users of the shared backend share a store, which is measured once
+    store_users = {vectorstore.store_path(user_id): user_id for user_id in user_ids}
+    latencies = [record["latency_ms"] for record in records]
+    windows = []
+    for window_start in range(0, turns, args.window):
+        window = [record for record in records if window_start <= record["turn"] < window_start + args.window]
+        windows.append({
+            "turns": f"{window_start + 1}-{min(turns, window_start + args.window)}",
+            "latency_ms_p50": percentile([record["latency_ms"] for record in window], 0.5),
+            "prompt_tokens_per_turn": sum(record["prompt_tokens"] for record in window) / len(window)
+        })
+    results = {
+        "users": users,
+        "turns_per_user": turns,
+        "turns": len(records),
+        "seconds": elapsed,
+        "turns_per_second": len(records) / elapsed if elapsed else 0.0,
+        "turn_latency_ms": latency_summary(latencies),
+        "llm_calls_per_turn": llm.totals["llm_calls"] / len(records),
+        "prompt_tokens_per_turn": llm.totals.get("prompt_tokens", 0) / len(records),
+        "completion_tokens_per_turn": llm.totals.get("completion_tokens", 0) / len(records),
+        # LLM calls and prompt tokens the user waits for, excluding background memory checks
+        "foreground_llm_calls_per_turn": sum(record["llm_calls"] for record in records) / len(records),
+        "foreground_prompt_tokens_per_turn": sum(record["prompt_tokens"] for record in records) / len(records),
+        "llm_calls_by_chain": travelAgent.get_llm_call_stats()["calls"],
+        "embedding_requests": embeddings.requests,
+        "by_session_length": windows,
+        "vector_store": {
+            "memories": sum(vectorstore.count(user_id) for user_id in user_ids),
+            "bytes": sum(vectorstore.index_size(user_id) for user_id in store_users.values())
+        },
+        "travel_memory_bytes": directory_bytes("./travel_memory"),
+        "rss_mb": {"after_build": rss_before["current"], **rss_mb()}
+    }
+    if speech is not None:
+        results["tts_first_audio_ms"] = latency_summary([record["tts_first_audio_ms"] for record in records])
+        results["tts_requests"] = speech.client.requests
+    return results
+
+def run_configuration(users: int, turns: int, args) -> Dict[str, Any]:
+    """Run one configuration in a fresh process and temporary directory."""
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [REPO_DIR, env.get("PYTHONPATH")]))
+    env.setdefault("ANONYMIZED_TELEMETRY", "False")
+    env.setdefault("SDL_AUDIODRIVER", "dummy")
+    command = [sys.executable, os.path.abspath(__file__), "--run", str(users), str(turns),
+               "--llm-latency-ms", str(args.llm_latency_ms), "--embedding-latency-ms", str(args.embedding_latency_ms),
+               "--tts-latency-ms", str(args.tts_latency_ms), "--concurrency", str(args.concurrency),
+               "--window", str(args.window)]
+    print(f"Benchmarking {users} users x {turns} turns", file=sys.stderr)
+    with tempfile.TemporaryDirectory(prefix="bench_agent_") as directory:
+        output = subprocess.run(command, cwd=directory, env=env, capture_output=True, text=True)
+    if output.returncode != 0:
+        print(output.stderr, file=sys.stderr)
+        output.check_returncode()
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+def benchmark(args) -> Dict[str, Any]:
+    import travelAgent
+    results = {
+        "config": {
+            "llm_latency_ms": args.llm_latency_ms,
+            "embedding_latency_ms": args.embedding_latency_ms,
+            "tts_latency_ms": args.tts_latency_ms,
+            "concurrency": args.concurrency,
+            "memory_graph_mode": travelAgent.MEMORY_GRAPH_MODE,
+            "memory_extraction_mode": travelAgent.MEMORY_EXTRACTION_MODE,
+            "vector_backend": travelAgent.VECTOR_BACKEND
+        },
+        "runs": []
+    }
+    for users in args.users:
+        for turns in args.turns:
+            results["runs"].append(run_configuration(users, turns, args))
+    return results
+
+def print_results(results: Dict[str, Any]):
+    config = results["config"]
+    print(f"\nAgent benchmark ({config['memory_graph_mode']} graph, {config['memory_extraction_mode']} extraction, "
+          f"{config['vector_backend']} vector store; fake LLM {config['llm_latency_ms']:.0f} ms, "
+          f"embeddings {config['embedding_latency_ms']:.0f} ms, TTS {config['tts_latency_ms']:.0f} ms)")
+    for run in results["runs"]:
+        latency = run["turn_latency_ms"]
+        print(f"\n{run['users']} users x {run['turns_per_user']} turns: {run['turns_per_second']:.1f} turns/s")
+        print(f"- turn latency: p50 {latency['p50']:.0f} ms, p95 {latency['p95']:.0f} ms, p99 {latency['p99']:.0f} ms")
+        print(f"- per turn: {run['llm_calls_per_turn']:.2f} LLM calls, {run['prompt_tokens_per_turn']:.0f} prompt tokens "
+              f"({run['foreground_llm_calls_per_turn']:.2f} calls, "
+              f"{run['foreground_prompt_tokens_per_turn']:.0f} tokens in the foreground)")
+        if "tts_first_audio_ms" in run:
+            tts_latency = run["tts_first_audio_ms"]
+            print(f"- first audio: p50 {tts_latency['p50']:.0f} ms, p95 {tts_latency['p95']:.0f} ms, "
+                  f"{run['tts_requests']} synthesis requests")
+        print(f"- vector store: {run['vector_store']['memories']} memories, "
+              f"{run['vector_store']['bytes'] / 1024:.0f} KB; travel_memory {run['travel_memory_bytes'] / 1024:.0f} KB")
+        print(f"- RSS: {run['rss_mb']['after_build']:.0f} MB after startup, {run['rss_mb']['current']:.0f} MB at the end, "
+              f"{run['rss_mb']['peak']:.0f} MB peak")
+        for window in run["by_session_length"]:
+            print(f"  turns {window['turns']}: p50 {window['latency_ms_p50']:.0f} ms, "
+                  f"{window['prompt_tokens_per_turn']:.0f} prompt tokens per turn")
+
+# Metrics compared with a baseline, and whether lower is better
+COMPARED_METRICS = [
+    ("turn latency p50", lambda run: run["turn_latency_ms"]["p50"]),
+    ("turn latency p95", lambda run: run["turn_latency_ms"]["p95"]),
+    ("turn latency p99", lambda run: run["turn_latency_ms"]["p99"]),
+    ("LLM calls per turn", lambda run: run["llm_calls_per_turn"]),
+    ("prompt tokens per turn", lambda run: run["prompt_tokens_per_turn"]),
+    ("vector store bytes", lambda run: run["vector_store"]["bytes"]),
+    ("peak RSS", lambda run: run["rss_mb"]["peak"])
+]
+
+def print_comparison(results: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> int:
+    """Print the change of each metric against the baseline and return the number of regressions."""
+    baseline_runs = {(run["users"], run["turns_per_user"]): run for run in baseline["runs"]}
+    regressions = 0
+    for run in results["runs"]:
+        previous = baseline_runs.get((run["users"], run["turns_per_user"]))
+        if previous is None:
+            continue
+        print(f"\n{run['users']} users x {run['turns_per_user']} turns against the baseline:")
+        for label, metric in COMPARED_METRICS:
+            before, after = metric(previous), metric(run)
+            change = (after - before) / before if before else 0.0
+            regressed = change > threshold
+            regressions += regressed
+            print(f"- {label}: {before:.1f} -> {after:.1f} ({change:+.1%}){' REGRESSION' if regressed else ''}")
+    return regressions
+
+def parse_counts(value: str) -> List[int]:
+    return [int(count) for count in value.split(",")]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the travel agent offline with fake LLM, embeddings and TTS')
+    parser.add_argument('--users', type=parse_counts, default=[1, 10], help='Comma-separated numbers of simulated users')
+    parser.add_argument('--turns', type=parse_counts, default=[10, 40], help='Comma-separated session lengths in turns')
+    parser.add_argument('--concurrency', type=int, default=4, help='Number of users chatting at the same time')
+    parser.add_argument('--llm-latency-ms', type=float, default=300, help='Latency of each fake LLM call')
+    parser.add_argument('--embedding-latency-ms', type=float, default=50, help='Latency of each fake embedding request')
+    parser.add_argument('--tts-latency-ms', type=float, default=150,
+                        help='Latency of each fake speech synthesis request (negative to skip speech)')
+    parser.add_argument('--window', type=int, default=10, help='Turns per session length bucket')
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    parser.add_argument('--compare', help='Compare with the results of an earlier run (a JSON file)')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Relative increase reported as a regression when comparing')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    parser.add_argument('--run', type=int, nargs=2, metavar=("USERS", "TURNS"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(run_sessions(args.run[0], args.run[1], args)))
+        sys.exit(0)
+
+    results = benchmark(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = print_comparison(results, json.load(f), args.threshold)
+        sys.exit(1 if regressions else 0)
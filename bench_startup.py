@@ -0,0 +1,99 @@
+"""Benchmark the startup time of the travel agent.
+
+Measures, each in fresh processes: importing travelAgent, running `travelAgent.py
+--list-users`, and building all components needed to chat (chat model, embeddings,
+vector store, chains and the compiled graph). Runs in a temporary directory, so no
+existing travel_memory is touched; no API calls are made.
+"""
+from typing import Any, Dict, List
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+IMPORT_SCRIPT = "import travelAgent"
+BUILD_SCRIPT = """
+import time
+start = time.perf_counter()
+import travelAgent
+imported = time.perf_counter()
+travelAgent.components.build()
+print((imported - start) * 1000, (time.perf_counter() - imported) * 1000)
+"""
+
+def environment() -> Dict[str, str]:
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [REPO_DIR, env.get("PYTHONPATH")]))
+    env.setdefault("ANONYMIZED_TELEMETRY", "False")
+    # Building the chat model and embeddings clients needs a key, but nothing is sent
+    env.setdefault("OPENAI_API_KEY", "sk-benchmark")
+    return env
+
+def timed_run(command: List[str], cwd: str) -> float:
+    start = time.perf_counter()
+    subprocess.run(command, cwd=cwd, env=environment(), check=True, capture_output=True)
+    return (time.perf_counter() - start) * 1000
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    ordered = sorted(values)
+    return {"median": ordered[len(ordered) // 2], "min": ordered[0], "max": ordered[-1]}
+
+def slowest_imports(cwd: str, count: int) -> List[Dict[str, Any]]:
+    """Return the top-level imports of travelAgent with the highest cumulative import time."""
+    output = subprocess.run([sys.executable, "-X", "importtime", "-c", IMPORT_SCRIPT], cwd=cwd,
+                            env=environment(), check=True, capture_output=True, text=True).stderr
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Direct imports of travelAgent are indented by three spaces
+        if name.startswith("   ") and not name.startswith("    "):
+            imports.append({"module": name.strip(), "ms": int(cumulative) / 1000})
+    return sorted(imports, key=lambda entry: entry["ms"], reverse=True)[:count]
+
+def benchmark(runs: int, cwd: str) -> Dict[str, Any]:
+    import_ms = [timed_run([sys.executable, "-c", IMPORT_SCRIPT], cwd) for _ in range(runs)]
+    list_users_ms = [timed_run([sys.executable, os.path.join(REPO_DIR, "travelAgent.py"), "--list-users"], cwd)
+                     for _ in range(runs)]
+    build_ms = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", BUILD_SCRIPT], cwd=cwd, env=environment(),
+                                check=True, capture_output=True, text=True).stdout
+        build_ms.append(float(output.strip().splitlines()[-1].split()[1]))
+    return {
+        "runs": runs,
+        "process_import_ms": summarize(import_ms),
+        "list_users_ms": summarize(list_users_ms),
+        "build_components_ms": summarize(build_ms),
+        "slowest_imports": slowest_imports(cwd, 8)
+    }
+
+def print_results(results: Dict[str, Any]):
+    print(f"\nStartup over {results['runs']} runs (median, min-max):")
+    for key, label in (("process_import_ms", "python -c 'import travelAgent'"),
+                       ("list_users_ms", "travelAgent.py --list-users"),
+                       ("build_components_ms", "building the components to chat")):
+        stats = results[key]
+        print(f"- {label}: {stats['median']:.0f} ms ({stats['min']:.0f}-{stats['max']:.0f} ms)")
+    print("Slowest imports of travelAgent:")
+    for entry in results["slowest_imports"]:
+        print(f"- {entry['module']}: {entry['ms']:.1f} ms")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the startup time of the travel agent')
+    parser.add_argument('--runs', type=int, default=5, help='Number of fresh processes per measurement')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="bench_startup_") as directory:
+        results = benchmark(args.runs, directory)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
@@ -0,0 +1,165 @@
+"""Benchmark the per-user and shared vector store backends.
+
+Each backend is populated with synthetic memories for many users, then queried from a
+fresh process so the first query of every sampled user pays the cold open cost. Reports
+populate time, cold and warm query latency, peak RSS, open file handles and disk usage.
+Embeddings are computed locally, so no API key is needed.
+"""
+from typing import Any, Dict, List
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("ANONYMIZED_TELEMETRY", "False")
+
+from embedding_providers import HashingEmbeddings
+from vector_store import VECTOR_BACKENDS, create_vectorstore
+
+MEMORY_TEMPLATES = [
+    "budget: \"around ${amount}\"",
+    "travel_companions: \"{companions}\"",
+    "travel_time: \"{month}\"",
+    "vacation_preferences: {{\"type\": \"{preference}\"}}",
+    "location: \"{city}\""
+]
+CHOICES = {
+    "companions": ["solo", "partner", "family with two kids", "friends"],
+    "month": ["January", "April", "July", "October", "December"],
+    "preference": ["beach", "mountains", "city", "countryside"],
+    "city": ["Berlin", "Toronto", "Lisbon", "Osaka", "Austin"]
+}
+
+def user_memories(user_index: int, count: int) -> List[str]:
+    rng = random.Random(user_index)
+    values = {key: rng.choice(options) for key, options in CHOICES.items()}
+    values["amount"] = rng.randrange(500, 10000, 250)
+    return [MEMORY_TEMPLATES[i % len(MEMORY_TEMPLATES)].format(**values) for i in range(count)]
+
+def percentile(values: List[float], share: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))] if ordered else 0.0
+
+def directory_stats(path: str) -> Dict[str, int]:
+    files = 0
+    size = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            files += 1
+            size += os.path.getsize(os.path.join(root, name))
+    return {"files": files, "bytes": size}
+
+def open_file_handles() -> int:
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return -1
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+def create_store(backend: str, base_dir: str, shards: int, max_open_stores: int):
+    return create_vectorstore(backend, base_dir, HashingEmbeddings(), shards=shards, max_open_stores=max_open_stores)
+
+def populate(backend: str, base_dir: str, users: int, memories: int, shards: int, max_open_stores: int) -> Dict[str, Any]:
+    store = create_store(backend, base_dir, shards, max_open_stores)
+    start = time.perf_counter()
+    for user_index in range(users):
+        texts = user_memories(user_index, memories)
+        store.add_texts(f"user-{user_index}", texts=texts, metadatas=[{"type": "bench"} for _ in texts])
+        if (user_index + 1) % 1000 == 0:
+            print(f"  {backend}: populated {user_index + 1}/{users} users", file=sys.stderr)
+    elapsed = time.perf_counter() - start
+    return {"populate_seconds": elapsed, "populate_rss_mb": peak_rss_mb()}
+
+def query(backend: str, base_dir: str, users: int, queries: int, shards: int, max_open_stores: int) -> Dict[str, Any]:
+    start = time.perf_counter()
+    store = create_store(backend, base_dir, shards, max_open_stores)
+    open_seconds = time.perf_counter() - start
+    rng = random.Random(0)
+    sampled = rng.sample(range(users), min(queries, users))
+    cold = []
+    warm = []
+    for user_index in sampled:
+        user_id = f"user-{user_index}"
+        for timings in (cold, warm):
+            start = time.perf_counter()
+            store.similarity_search(user_id, "budget for a beach trip in July", k=3)
+            timings.append((time.perf_counter() - start) * 1000)
+    return {
+        "open_seconds": open_seconds,
+        "cold_query_ms": {"p50": percentile(cold, 0.5), "p95": percentile(cold, 0.95), "max": max(cold)},
+        "warm_query_ms": {"p50": percentile(warm, 0.5), "p95": percentile(warm, 0.95), "max": max(warm)},
+        "query_rss_mb": peak_rss_mb(),
+        "open_file_handles": open_file_handles()
+    }
+
+def run_phase(phase: str, backend: str, base_dir: str, args) -> Dict[str, Any]:
+    """Run a phase in a fresh process, so memory and cold-start numbers are not shared."""
+    command = [sys.executable, __file__, "--phase", phase, "--backend", backend, "--dir", base_dir,
+               "--users", str(args.users), "--memories", str(args.memories), "--queries", str(args.queries),
+               "--shards", str(args.shards), "--max-open-stores", str(args.max_open_stores)]
+    output = subprocess.run(command, check=True, capture_output=True, text=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+def benchmark(backend: str, args) -> Dict[str, Any]:
+    base_dir = os.path.join(args.dir, backend)
+    shutil.rmtree(base_dir, ignore_errors=True)
+    print(f"Benchmarking {backend} backend with {args.users} users", file=sys.stderr)
+    results = {"backend": backend}
+    results.update(run_phase("populate", backend, base_dir, args))
+    results.update(run_phase("query", backend, base_dir, args))
+    results["disk"] = directory_stats(base_dir)
+    return results
+
+def print_results(results: Dict[str, Any]):
+    print(f"\n{results['backend']} backend")
+    print(f"- populate: {results['populate_seconds']:.1f}s, peak RSS {results['populate_rss_mb']:.0f} MB")
+    print(f"- open: {results['open_seconds'] * 1000:.1f} ms")
+    cold, warm = results["cold_query_ms"], results["warm_query_ms"]
+    print(f"- first query per user: p50 {cold['p50']:.1f} ms, p95 {cold['p95']:.1f} ms, max {cold['max']:.1f} ms")
+    print(f"- repeated query: p50 {warm['p50']:.1f} ms, p95 {warm['p95']:.1f} ms, max {warm['max']:.1f} ms")
+    print(f"- query peak RSS {results['query_rss_mb']:.0f} MB, {results['open_file_handles']} open file handles")
+    print(f"- disk: {results['disk']['files']} files, {results['disk']['bytes'] / (1024 * 1024):.1f} MB")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the per-user and shared vector store backends')
+    parser.add_argument('--users', type=int, default=10000, help='Number of synthetic users')
+    parser.add_argument('--memories', type=int, default=5, help='Memories per user')
+    parser.add_argument('--queries', type=int, default=200, help='Number of users queried')
+    parser.add_argument('--shards', type=int, default=1, help='Number of collections for the shared backend')
+    parser.add_argument('--max-open-stores', type=int, default=100, help='Open store cache size for the per-user backend')
+    parser.add_argument('--backend', choices=VECTOR_BACKENDS, help='Only benchmark this backend')
+    parser.add_argument('--dir', help='Directory for the benchmark stores (default: a temporary directory)')
+    parser.add_argument('--keep', action='store_true', help='Keep the benchmark stores')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    parser.add_argument('--phase', choices=("populate", "query"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.phase:
+        phase = populate if args.phase == "populate" else query
+        count = args.memories if args.phase == "populate" else args.queries
+        print(json.dumps(phase(args.backend, args.dir, args.users, count, args.shards, args.max_open_stores)))
+        sys.exit(0)
+
+    temporary = args.dir is None
+    args.dir = args.dir or tempfile.mkdtemp(prefix="bench_vectorstore_")
+    try:
+        all_results = [benchmark(backend, args) for backend in ([args.backend] if args.backend else VECTOR_BACKENDS)]
+    finally:
+        if temporary and not args.keep:
+            shutil.rmtree(args.dir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(all_results, indent=2))
+    else:
+        for results in all_results:
+            print_results(results)
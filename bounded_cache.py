@@ -0,0 +1,157 @@
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Iterator, List, Optional, Tuple
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+class BoundedCache:
+    """Thread-safe dictionary with LRU eviction, an optional TTL and hit/miss/eviction counters.
+
+    Entries are evicted when the cache grows beyond its capacity (least recently used first)
+    or when they have not been accessed for longer than ttl_seconds. on_evict is called with
+    the key and value of every evicted entry, outside the cache lock.
+    """
+
+    def __init__(self, capacity: int, ttl_seconds: Optional[float] = None,
+                 on_evict: Optional[Callable[[Hashable, Any], None]] = None):
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        self.capacity = capacity
+        self.ttl_seconds = ttl_seconds
+        self.on_evict = on_evict
+        self._entries: "OrderedDict[Hashable, Tuple[Any, float]]" = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _is_expired(self, last_access: float, now: float) -> bool:
+        return self.ttl_seconds is not None and now - last_access > self.ttl_seconds
+
+    def _expire(self, now: float) -> List[Tuple[Hashable, Any]]:
+        """Remove expired entries; must be called with the lock held."""
+        evicted = []
+        if self.ttl_seconds is None:
+            return evicted
+        # Entries are ordered by last access, so the expired ones are at the front
+        while self._entries:
+            key, (value, last_access) = next(iter(self._entries.items()))
+            if not self._is_expired(last_access, now):
+                break
+            del self._entries[key]
+            evicted.append((key, value))
+        self.evictions += len(evicted)
+        return evicted
+
+    def _notify(self, evicted: List[Tuple[Hashable, Any]]):
+        if self.on_evict is None:
+            return
+        for key, value in evicted:
+            try:
+                self.on_evict(key, value)
+            except Exception as e:
+                logger.error("Error evicting %s from cache: %s", key, e)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Return the value for key and mark it as recently used, or default if absent."""
+        now = time.monotonic()
+        with self._lock:
+            evicted = self._expire(now)
+            entry = self._entries.get(key, _MISSING)
+            if entry is _MISSING:
+                self.misses += 1
+                value = default
+            else:
+                self.hits += 1
+                value = entry[0]
+                self._entries[key] = (value, now)
+                self._entries.move_to_end(key)
+        self._notify(evicted)
+        return value
+
+    def peek(self, key: Hashable, default: Any = None) -> Any:
+        """Return the value for key without touching its recency or the hit/miss counters."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or self._is_expired(entry[1], time.monotonic()):
+                return default
+            return entry[0]
+
+    def __getitem__(self, key: Hashable) -> Any:
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: Hashable, value: Any):
+        now = time.monotonic()
+        with self._lock:
+            evicted = self._expire(now)
+            self._entries[key] = (value, now)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                evicted_key, (evicted_value, _) = self._entries.popitem(last=False)
+                evicted.append((evicted_key, evicted_value))
+                self.evictions += 1
+        self._notify(evicted)
+
+    def __contains__(self, key: Hashable) -> bool:
+        """Check for a live entry without touching its recency or the hit/miss counters."""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and not self._is_expired(entry[1], time.monotonic())
+
+    def __delitem__(self, key: Hashable):
+        with self._lock:
+            del self._entries[key]
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """Remove key without calling on_evict and return its value."""
+        with self._lock:
+            entry = self._entries.pop(key, _MISSING)
+        return default if entry is _MISSING else entry[0]
+
+    def setdefault(self, key: Hashable, default: Any) -> Any:
+        """Return the value for key, inserting default first if it is absent."""
+        with self._lock:
+            if key in self:
+                return self.get(key)
+            self[key] = default
+            return default
+
+    def clear(self):
+        """Evict every entry, calling on_evict for each of them."""
+        with self._lock:
+            evicted = [(key, value) for key, (value, _) in self._entries.items()]
+            self._entries.clear()
+            self.evictions += len(evicted)
+        self._notify(evicted)
+
+    def keys(self) -> List[Hashable]:
+        with self._lock:
+            return list(self._entries.keys())
+
+    def __iter__(self) -> Iterator[Hashable]:
+        return iter(self.keys())
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def stats(self) -> Dict[str, Any]:
+        """Return the cache size and its hit, miss and eviction counters."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "capacity": self.capacity,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
@@ -0,0 +1,81 @@
+from typing import Awaitable, Callable, List, Optional
+from langchain.memory import ConversationSummaryBufferMemory
+from langchain_core.messages import BaseMessage
+import logging
+
+logger = logging.getLogger(__name__)
+
+class WindowedSummaryMemory(ConversationSummaryBufferMemory):
+    """Chat history that keeps the most recent turns verbatim and summarizes the rest.
+
+    At most max_turns turns are kept, within max_token_limit tokens. When the window
+    overflows, the oldest turns are folded into the running summary, at least
+    summary_batch_turns at a time so the summary is updated every few turns instead of
+    on every turn. The summary is extended with the folded turns, never regenerated.
+    Tokens are counted with token_counter (the model's tokenizer by default).
+    run_summary (arun_summary when async) is called with the function that extends the
+    summary and the estimated prompt tokens, and returns its result, e.g. to count, time,
+    schedule and retry the LLM call. If the summary cannot be extended, the turns stay in
+    the window and are folded with the next update.
+    """
+    max_turns: int = 5
+    summary_batch_turns: int = 2
+    token_counter: Optional[Callable[[str], int]] = None
+    run_summary: Optional[Callable[[Callable[[], str], int], str]] = None
+    arun_summary: Optional[Callable[[Callable[[], Awaitable[str]], int], Awaitable[str]]] = None
+
+    def _history_tokens(self, messages: List[BaseMessage]) -> int:
+        count_tokens = self.token_counter or self.llm.get_num_tokens
+        # A few tokens of per-message overhead, as in the chat completion format
+        return sum(count_tokens(str(message.content)) + 4 for message in messages)
+
+    def _pop_overflow(self) -> List[BaseMessage]:
+        """Remove the messages that no longer fit the window and return them."""
+        buffer = self.chat_memory.messages
+        pruned = []
+        # Each turn is a user message followed by the agent's reply
+        if len(buffer) > 2 * self.max_turns:
+            keep_turns = max(0, min(self.max_turns, len(buffer) // 2 - self.summary_batch_turns))
+            while len(buffer) > 2 * keep_turns:
+                pruned.append(buffer.pop(0))
+        while buffer and self._history_tokens(buffer) > self.max_token_limit:
+            pruned.append(buffer.pop(0))
+        return pruned
+
+    def _summary_tokens(self, pruned: List[BaseMessage]) -> int:
+        count_tokens = self.token_counter or self.llm.get_num_tokens
+        return self._history_tokens(pruned) + count_tokens(self.moving_summary_buffer)
+
+    def _restore(self, pruned: List[BaseMessage], error: Exception):
+        # The turns are neither in the window nor in the summary, so put them back
+        self.chat_memory.messages[:0] = pruned
+        logger.warning("Error extending the chat history summary, keeping %d messages for the next update: %s",
+                       len(pruned), error)
+
+    def prune(self) -> None:
+        """Fold the turns that overflow the window into the running summary."""
+        pruned = self._pop_overflow()
+        if not pruned:
+            return
+        summarize = lambda: self.predict_new_summary(pruned, self.moving_summary_buffer)
+        try:
+            if self.run_summary:
+                self.moving_summary_buffer = self.run_summary(summarize, self._summary_tokens(pruned))
+            else:
+                self.moving_summary_buffer = summarize()
+        except Exception as e:
+            self._restore(pruned, e)
+
+    async def aprune(self) -> None:
+        """Async variant of prune."""
+        pruned = self._pop_overflow()
+        if not pruned:
+            return
+        summarize = lambda: self.apredict_new_summary(pruned, self.moving_summary_buffer)
+        try:
+            if self.arun_summary:
+                self.moving_summary_buffer = await self.arun_summary(summarize, self._summary_tokens(pruned))
+            else:
+                self.moving_summary_buffer = await summarize()
+        except Exception as e:
+            self._restore(pruned, e)
@@ -0,0 +1,206 @@
+from typing import Dict, List, Optional
+from array import array
+from langchain_core.embeddings import Embeddings
+import hashlib
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+
+EMBEDDING_PROVIDERS = ("openai", "hashing", "sentence_transformer")
+
+# Last use times kept in memory before they are written even without an insert
+MAX_TOUCHED = 10000
+
+class HashingEmbeddings(Embeddings):
+    """Local embeddings from signed feature hashing of words and word pairs.
+
+    Runs on the CPU without a model or network access. Texts that share words end up
+    close to each other, which is enough to retrieve short memory strings such as
+    'budget: "moderate"', but it does not capture synonyms like a learned model does.
+    """
+
+    def __init__(self, dimensions: int = 384):
+        self.dimensions = dimensions
+        self.name = f"hashing-{dimensions}"
+
+    def _features(self, text: str) -> List[str]:
+        words = re.findall(r"\w+", text.lower())
+        return words + [f"{first} {second}" for first, second in zip(words, words[1:])]
+
+    def embed_query(self, text: str) -> List[float]:
+        vector = [0.0] * self.dimensions
+        for feature in self._features(text):
+            digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest()
+            index = int.from_bytes(digest[:4], "big") % self.dimensions
+            # The sign bit keeps colliding features from always adding up
+            vector[index] += 1.0 if digest[4] & 1 else -1.0
+        norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+        return [value / norm for value in vector]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self.embed_query(text) for text in texts]
+
+class SentenceTransformerEmbeddings(Embeddings):
+    """Local embeddings from a sentence-transformers model, e.g. all-MiniLM-L6-v2, on the CPU.
+
+    Requires the optional sentence-transformers package; the model is downloaded on first use.
+    """
+
+    def __init__(self, model_name: str = "all-MiniLM-L6-v2", batch_size: int = 32):
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError:
+            raise ImportError("The sentence_transformer embedding provider requires the sentence-transformers "
+                              "package. Install it with: pip install sentence-transformers")
+        self.model = SentenceTransformer(model_name, device="cpu")
+        self.batch_size = batch_size
+        self.name = f"sentence-transformer-{model_name}"
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors = self.model.encode(texts, batch_size=self.batch_size, normalize_embeddings=True)
+        return [vector.tolist() for vector in vectors]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+class CachedEmbeddings(Embeddings):
+    """Persistent embedding cache in front of another provider.
+
+    Vectors are stored in SQLite, keyed by a hash of the provider name and the text, so
+    embedding a text that was embedded before costs nothing, across restarts as well. The
+    texts missing from the cache are embedded in a single batched call to the provider.
+    The cache holds at most max_entries vectors (0 is unlimited); once it is full, the
+    least recently used tenth is pruned. Lookups only record when a vector was used in
+    memory; the times are written with the next insert, so cache hits do not write to disk.
+    """
+
+    def __init__(self, provider: Embeddings, path: str, name: Optional[str] = None, max_entries: int = 100000):
+        self.provider = provider
+        self.name = name or getattr(provider, "name", type(provider).__name__)
+        self.max_entries = max_entries
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL, "
+            "used REAL NOT NULL DEFAULT 0)"
+        )
+        # Caches created before the size cap have no last used column
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(embeddings)")]
+        if "used" not in columns:
+            self.connection.execute("ALTER TABLE embeddings ADD COLUMN used REAL NOT NULL DEFAULT 0")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS embeddings_used ON embeddings (used)")
+        self.connection.commit()
+        self.size = self.connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.pruned = 0
+        # Last use of the vectors read since the last write, by key
+        self.touched: Dict[str, float] = {}
+
+    def key(self, text: str) -> str:
+        """Return the cache key of a text for this provider."""
+        return hashlib.sha256(f"{self.name}\n{text}".encode("utf-8")).hexdigest()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [self.key(text) for text in texts]
+        vectors: Dict[str, List[float]] = {}
+        with self.lock:
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                rows = self.connection.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch
+                ).fetchall()
+                for key, blob in rows:
+                    vectors[key] = array("f", blob).tolist()
+            now = time.time()
+            self.touched.update((key, now) for key in vectors)
+            if len(self.touched) >= MAX_TOUCHED:
+                self._flush_touched()
+                self.connection.commit()
+
+        # Embed every missing text once, in one call
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors:
+                missing.setdefault(key, text)
+        if missing:
+            embedded = self.provider.embed_documents(list(missing.values()))
+            rows = []
+            now = time.time()
+            for key, vector in zip(missing, embedded):
+                vectors[key] = list(vector)
+                rows.append((key, array("f", vector).tobytes(), now))
+            with self.lock:
+                before = self.connection.total_changes
+                self.connection.executemany("INSERT OR IGNORE INTO embeddings (key, vector, used) VALUES (?, ?, ?)",
+                                            rows)
+                self.size += self.connection.total_changes - before
+                self._flush_touched()
+                self._prune()
+                self.connection.commit()
+
+        with self.lock:
+            self.misses += len(missing)
+            self.hits += len(texts) - len(missing)
+        return [vectors[key] for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    def _flush_touched(self):
+        """Write the recorded last use times, uncommitted; must be called with the lock held."""
+        if self.touched:
+            self.connection.executemany("UPDATE embeddings SET used = ? WHERE key = ?",
+                                        [(used, key) for key, used in self.touched.items()])
+            self.touched = {}
+
+    def _prune(self):
+        """Delete the least recently used vectors once the cache is full; must be called with the lock held."""
+        if not self.max_entries or self.size <= self.max_entries:
+            return
+        # Prune a tenth more than needed, so the cache is not pruned on every insert
+        surplus = self.size - self.max_entries + max(1, self.max_entries // 10)
+        deleted = self.connection.execute(
+            "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY used LIMIT ?)", (surplus,)
+        ).rowcount
+        self.size -= deleted
+        self.pruned += deleted
+
+    def stats(self) -> Dict[str, int]:
+        """Return the cache size and its hit, miss and pruning counters."""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "pruned": self.pruned,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
+
+def create_embeddings(provider: str, api_key: Optional[str] = None, cache_path: Optional[str] = None,
+                      model_name: Optional[str] = None, cache_max_entries: int = 100000) -> Embeddings:
+    """Create the embedding provider ("openai", "hashing" or "sentence_transformer").
+
+    With a cache_path the provider is wrapped in a persistent CachedEmbeddings cache of at
+    most cache_max_entries vectors.
+    """
+    if provider == "openai":
+        from langchain.embeddings import OpenAIEmbeddings
+        embeddings = OpenAIEmbeddings(api_key=api_key)
+        name = f"openai-{embeddings.model}"
+    elif provider == "hashing":
+        embeddings = HashingEmbeddings()
+        name = embeddings.name
+    elif provider == "sentence_transformer":
+        embeddings = SentenceTransformerEmbeddings(model_name or "all-MiniLM-L6-v2")
+        name = embeddings.name
+    else:
+        raise ValueError(f"Unknown embedding provider {provider}, expected one of {EMBEDDING_PROVIDERS}")
+    return CachedEmbeddings(embeddings, cache_path, name=name, max_entries=cache_max_entries) if cache_path else embeddings
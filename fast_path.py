@@ -0,0 +1,664 @@
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from datetime import datetime
+from pydantic import BaseModel
+import argparse
+import json
+import re
+import sys
+import threading
+
+# Keyword patterns for the kinds of information listed in MEMORY_CHECK_PROMPT
+MEMORY_CATEGORY_PATTERNS: Dict[str, str] = {
+    "name": r"\bmy name\b|\bi'?m called\b|\bcall me\b|\b(i am|i'?m) (?-i:[A-Z])[a-z]+",
+    "preferences": r"\b(i|we) (really |don'?t |do not |never |always )?(like|love|prefer|enjoy|hate|dislike|adore|avoid)\b"
+                   r"|\b(fan of|into|favou?rite|not a fan)\b|\b(beach|mountains?|city|cities|countryside|island|ski|hiking|museums?|nightlife|cruise|resort|relax)",
+    "past_experiences": r"\b(went|visited|been to|travell?ed|stayed|flew|spent|trip to|was in|were in)\b|\blast (year|summer|winter|spring|fall|autumn|time|month)\b",
+    "location": r"\b(i|we) live\b|\b(i'?m|i am|we'?re|we are) from\b|\bbased in\b|\bhome ?town\b|\bwhere i live\b",
+    "travel_style": r"\b(solo|alone|by myself|family|friends|partner|wife|husband|boyfriend|girlfriend|spouse|group|couple|honeymoon|backpack\w*|luxury|adventur\w*)\b",
+    "budget": r"[$€£¥]|\b\d[\d,.]*\s*(k|usd|eur|gbp|dollars?|euros?|pounds?|bucks)\b|\b(budget|cheap|afford\w*|expensive|splurge|spend|price|cost|money|pricey)\b",
+    "family": r"\b(kids?|child(ren)?|sons?|daughters?|bab(y|ies)|toddlers?|teens?|teenagers?|parents?|mom|dad|mother|father|grand\w+|pets?|dogs?|aged?|years? old)\b",
+    "time": r"\b(january|february|march|april|may|june|july|august|september|october|november|december"
+            r"|jan|feb|mar|apr|jun|jul|aug|sep|sept|oct|nov|dec"
+            r"|spring|summer|autumn|fall|winter|season|weekend|week|weeks|days?|nights?|months?|holidays?|vacation"
+            r"|christmas|easter|new year|thanksgiving|next year|this year)\b",
+    "frequency": r"\b(every (year|summer|winter|month)|once a|twice a|times a|usually|often|annually|regularly)\b",
+    "special_requirements": r"\b(wheelchair|accessib\w*|mobility|disab\w*|vegan|vegetarian|gluten|allerg\w*|diet\w*|halal|kosher|medical|pregnan\w*)\b",
+    "bucket_list": r"\b(dream|bucket list|always wanted|some ?day|one day|wish)\b",
+}
+
+# Inputs that never contain information worth memorizing
+TRIVIAL_INPUTS = {
+    "hi", "hello", "hey", "hiya", "yo", "good morning", "good afternoon", "good evening",
+    "thanks", "thank you", "thanks a lot", "thank you very much", "thx", "ty", "cheers",
+    "ok", "okay", "k", "sure", "yes", "yeah", "yep", "no", "nope", "cool", "great", "nice",
+    "awesome", "perfect", "sounds good", "got it", "i see", "alright", "all right", "fine",
+    "bye", "goodbye", "see you", "hmm", "hm", "lol", "wow", "tell me more", "go on", "more",
+    "why", "how", "what", "really", "interesting", "that sounds great", "sounds great"
+}
+
+# First-person references; with high recall any statement about the user is checked
+FIRST_PERSON = r"\b(i|i'?m|i'?ve|i'?d|i'?ll|me|my|mine|myself|we|we'?re|we'?ve|us|our|ours)\b"
+
+RECALL_LEVELS = ("high", "balanced")
+
+def normalize_input(text: str) -> str:
+    """Lowercase text and strip punctuation and surrounding whitespace."""
+    return re.sub(r"[^\w\s'$€£¥]", " ", text.lower()).strip()
+
+class MemoryPrefilter:
+    """Cheap local check that short-circuits inputs which clearly contain nothing to memorize.
+
+    Only clear negatives are skipped, everything else still goes to the LLM memory check.
+    With recall="high" an input is checked when it matches any category keyword or talks
+    about the user in the first person; with recall="balanced" it must match a category
+    keyword. Trivial inputs such as greetings and acknowledgements are always skipped.
+    """
+
+    def __init__(self, recall: str = "high"):
+        if recall not in RECALL_LEVELS:
+            raise ValueError(f"recall must be one of {RECALL_LEVELS}")
+        self.recall = recall
+        self.category_patterns = {
+            category: re.compile(pattern, re.IGNORECASE)
+            for category, pattern in MEMORY_CATEGORY_PATTERNS.items()
+        }
+        self.first_person = re.compile(FIRST_PERSON, re.IGNORECASE)
+        self.lock = threading.Lock()
+        self.checked = 0
+        self.skipped = 0
+
+    def matching_categories(self, text: str) -> List[str]:
+        """Return the memory categories whose keywords appear in the text."""
+        return [category for category, pattern in self.category_patterns.items() if pattern.search(text)]
+
+    def classify(self, text: str) -> bool:
+        """Return True if the input may contain information worth memorizing."""
+        normalized = normalize_input(text)
+        if not normalized or normalized in TRIVIAL_INPUTS:
+            return False
+        if self.matching_categories(text):
+            return True
+        return self.recall == "high" and bool(self.first_person.search(normalized))
+
+    def should_check(self, text: str) -> bool:
+        """Classify the input and count the decision; False means the LLM check can be skipped."""
+        decision = self.classify(text)
+        with self.lock:
+            if decision:
+                self.checked += 1
+            else:
+                self.skipped += 1
+        return decision
+
+    def stats(self) -> Dict[str, int]:
+        """Return how many inputs were passed on to the LLM check and how many were skipped."""
+        with self.lock:
+            return {
+                "recall": self.recall,
+                "checked": self.checked,
+                "skipped": self.skipped,
+                # The memory check is one LLM call per input in both extraction modes
+                "llm_calls_saved": self.skipped
+            }
+
+# Deterministic extraction of the essential travel fields checked by has_essential_travel_info
+
+TRAVEL_FIELDS = ("budget", "travel_companions", "travel_time")
+
+# Keys an LLM commonly returns for the essential travel fields instead of the ones the
+# extraction prompts ask for, compared in lower snake case
+TRAVEL_FIELD_ALIASES = {
+    "budget": ("budget_information", "budget_info", "budget_range", "budget_preferences", "travel_budget",
+               "trip_budget", "price_range", "spending", "spending_limit"),
+    "travel_companions": ("companions", "travel_companion", "travel_party", "travel_group", "party_size",
+                          "group_size", "travelers", "travellers", "traveling_with", "travelling_with",
+                          "family_composition", "family", "family_members"),
+    "travel_time": ("time_preferences", "time_preference", "preferred_travel_time", "travel_dates", "travel_date",
+                    "trip_dates", "dates", "travel_period", "travel_season", "travel_timing", "travel_month", "when")
+}
+
+NUMBER_WORDS = {
+    "a": 1, "an": 1, "one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6,
+    "seven": 7, "eight": 8, "nine": 9, "ten": 10, "eleven": 11, "twelve": 12
+}
+NUMBER = r"(\d+|a|an|one|two|three|four|five|six|seven|eight|nine|ten|eleven|twelve)"
+
+CURRENCY_SYMBOLS = {"$": "USD", "€": "EUR", "£": "GBP", "¥": "JPY"}
+CURRENCY_WORDS = {
+    "usd": "USD", "dollar": "USD", "dollars": "USD", "bucks": "USD",
+    "eur": "EUR", "euro": "EUR", "euros": "EUR",
+    "gbp": "GBP", "pound": "GBP", "pounds": "GBP",
+    "jpy": "JPY", "yen": "JPY"
+}
+AMOUNT = r"(\d{1,3}(?:,\d{3})+|\d+(?:\.\d+)?)\s?(k\b)?"
+SYMBOL_MONEY = re.compile(r"([$€£¥])\s?" + AMOUNT, re.IGNORECASE)
+WORD_MONEY = re.compile(AMOUNT + r"\s?(usd|eur|gbp|jpy|dollars?|euros?|pounds?|bucks|yen)\b", re.IGNORECASE)
+# Amounts without a currency only count as a budget in phrases like "5000 to spend" or "a budget of 5000"
+BARE_MONEY = re.compile(r"(?:(?<=budget )|(?<=budget is )|(?<=budget of )|(?<=spend ))" + AMOUNT
+                        + r"(?!\s*(?:%|percent|days?|nights?|weeks?|months?|years?|people|persons|adults?|kids?|children))"
+                        r"|(?<![$€£¥\d,.])" + AMOUNT + r"(?=\s+to spend\b)", re.IGNORECASE)
+RANGE_END = re.compile(r"\s*(?:-|–|to|and)\s*[$€£¥]?\s?" + AMOUNT, re.IGNORECASE)
+RANGE_START = re.compile(r"(?:between\s+)?[$€£¥]?\s?" + AMOUNT + r"\s*(?:-|–|to|and)\s*$", re.IGNORECASE)
+PER_PERSON = re.compile(r"\s*(per person|per head|a head|each|pp)\b", re.IGNORECASE)
+MAX_QUALIFIER = re.compile(r"\b(under|below|less than|at most|up to|no more than|max(?:imum)?(?: of)?|within)\s*$", re.IGNORECASE)
+MIN_QUALIFIER = re.compile(r"\b(over|above|more than|at least|from)\s*$", re.IGNORECASE)
+APPROXIMATE_QUALIFIER = re.compile(r"(\b(around|about|roughly|approximately|approx|circa)|~)\s*$", re.IGNORECASE)
+BUDGET_LEVELS = {
+    "low": r"\b(cheap|budget[- ]friendly|affordable|low[- ]budget|tight budget|on a budget|backpack(?:er|ing)?)\b",
+    "medium": r"\b(mid[- ]range|moderate|mid[- ]priced)\b",
+    "high": r"\b(luxury|luxurious|high[- ]end|five[- ]star|5[- ]star|splurge|upscale|money is no object)\b"
+}
+
+PARTNER = re.compile(r"\bmy (wife|husband|partner|boyfriend|girlfriend|spouse|fianc[eé]e?)\b", re.IGNORECASE)
+COUPLE = re.compile(r"\b(as a couple|the two of us|honeymoon)\b", re.IGNORECASE)
+CHILD_WORDS = r"(kids?|child(?:ren)?|sons?|daughters?|toddlers?|teens?|teenagers?|bab(?:y|ies)|boys|girls)"
+COUNTED_CHILDREN = re.compile(rf"\b{NUMBER}\s+(?:young\s+|little\s+|small\s+)?{CHILD_WORDS}\b", re.IGNORECASE)
+SINGLE_CHILD = re.compile(r"\b(?:my|our|and)\s+(son|daughter|kid|child|baby|toddler)\b", re.IGNORECASE)
+UNCOUNTED_CHILDREN = re.compile(r"\b(?:my|our|the)\s+(kids|children|sons|daughters|little ones)\b", re.IGNORECASE)
+CHILD_AGES = re.compile(r"\b(?:aged?|ages)\s+(\d+(?:\s*(?:,|and|&)\s*\d+)*)"
+                        r"|\b(\d+(?:\s*(?:,|and|&)\s*\d+)*)[- ]?(?:years?[- ]old|yo|y/o)\b", re.IGNORECASE)
+ADULTS = re.compile(rf"\b{NUMBER}\s+adults?\b", re.IGNORECASE)
+PARTY = re.compile(rf"\b{NUMBER}\s+of us\b|\b(?:party|group) of\s+{NUMBER}(?:\s+(?:friends|people|adults))?\b", re.IGNORECASE)
+FAMILY_PARTY = re.compile(rf"\bfamily of\s+{NUMBER}\b", re.IGNORECASE)
+FRIENDS = re.compile(r"\bwith (?:some |a few |a couple of |my |a group of )?(?:friends|mates|buddies|colleagues)\b"
+                     r"|\b(?:friends|mates) and I\b", re.IGNORECASE)
+SOLO = re.compile(r"\b(alone|solo|by myself|on my own|just me)\b", re.IGNORECASE)
+FAMILY = re.compile(r"\b(with (?:my|the|our) family|family (?:trip|holiday|vacation)"
+                    r"|with (?:my|our) (?:mother|mom|mum|father|dad|parents|sisters?|brothers?|siblings"
+                    r"|grand(?:mother|father|ma|pa|parents)|aunt|uncle|cousins?|in-laws))\b", re.IGNORECASE)
+
+MONTH_NAMES = ("january", "february", "march", "april", "may", "june", "july", "august",
+               "september", "october", "november", "december")
+# "may" is only read as a month after a preposition or before a year
+MONTH = re.compile(r"\b(?:(early|mid|late|end of|beginning of)[\s-]+)?"
+                   r"(january|february|march|april|june|july|august|september|october|november|december"
+                   r"|(?<=in )may|(?<=during )may|(?<=of )may|(?<=early )may|(?<=mid )may|(?<=mid-)may|(?<=late )may"
+                   r"|(?<=next )may|(?<=this )may|may(?= 20\d\d))\b", re.IGNORECASE)
+SEASON = re.compile(r"\b(?:(early|mid|late)[\s-]+)?(spring|summer|autumn|winter|(?<=the )fall|(?<=this )fall|(?<=next )fall|(?<=in )fall)\b",
+                    re.IGNORECASE)
+HOLIDAY = re.compile(r"\b(christmas|easter|new year'?s?(?: eve)?|thanksgiving|spring break|half[- ]term"
+                     r"|summer (?:holidays|break|vacation))\b", re.IGNORECASE)
+RELATIVE = re.compile(r"\b(next|this|coming)\b(?=\s+(?:year|month|week|weekend|spring|summer|autumn|fall|winter|"
+                      + "|".join(MONTH_NAMES) + r"))", re.IGNORECASE)
+RELATIVE_YEAR = re.compile(r"\b(next|this) year\b", re.IGNORECASE)
+YEAR = re.compile(r"\b(20[2-9]\d)\b")
+DURATION = re.compile(rf"\b(?:for\s+)?{NUMBER}[\s-]+(day|night|week|month)s?\b|\b(?:a\s+)?(fortnight|long weekend|weekend)\b",
+                      re.IGNORECASE)
+DURATION_DAYS = {"day": 1, "night": 1, "week": 7, "month": 30, "fortnight": 14, "long weekend": 3, "weekend": 2}
+
+# Inputs describing the past, negations and questions are left to the LLM
+PAST = re.compile(r"\b(last (?:year|summer|winter|spring|fall|autumn|month|week|time)|ago|went|visited|been to|was|were"
+                  r"|travell?ed|stayed|spent|flew|had|did|used to)\b", re.IGNORECASE)
+NEGATION = re.compile(r"\b(not|never|neither|nor|without)\b|n't\b|\bno\b(?! more than)", re.IGNORECASE)
+
+# Words that carry no information beyond the extracted fields
+FILLER_WORDS = {
+    "i", "im", "id", "ive", "ill", "me", "my", "we", "were", "weve", "wed", "well", "us", "our", "you", "it", "its",
+    "a", "an", "the", "of", "for", "in", "on", "at", "to", "with", "and", "or", "but", "by", "from", "about",
+    "around", "roughly", "approximately", "approx", "under", "over", "up", "max", "maximum", "most", "least",
+    "more", "than", "less", "between", "within", "be", "is", "are", "am", "will", "would", "can", "could",
+    "have", "has", "got", "want", "wanna", "looking", "planning", "plan", "plans", "thinking", "hoping", "going",
+    "go", "travel", "traveling", "travelling", "trip", "vacation", "holiday", "holidays", "getaway", "break",
+    "book", "spend", "spending", "budget", "total", "person", "people", "per", "so", "just", "only", "also",
+    "too", "there", "that", "this", "some", "somewhere", "time", "probably", "maybe", "ideally", "hi", "hello",
+    "hey", "ok", "okay", "yes", "yeah", "thanks", "please", "all", "together", "both", "be", "coming", "family",
+    "kids", "adults", "party", "group", "out", "away", "off", "sometime", "during", "early", "late", "mid",
+    "year", "next", "money", "something", "no"
+}
+
+class Budget(BaseModel):
+    """Budget as a currency amount or range, or as a level when no amount is given."""
+    currency: Optional[str] = None
+    min_amount: Optional[float] = None
+    max_amount: Optional[float] = None
+    approximate: bool = False
+    per_person: bool = False
+    level: Optional[str] = None
+
+class TravelCompanions(BaseModel):
+    """Who the user travels with."""
+    style: str
+    adults: Optional[int] = None
+    children: Optional[int] = None
+    children_ages: List[int] = []
+
+class TravelTime(BaseModel):
+    """When and for how long the user wants to travel."""
+    month: Optional[str] = None
+    season: Optional[str] = None
+    holiday: Optional[str] = None
+    part: Optional[str] = None
+    relative: Optional[str] = None
+    year: Optional[int] = None
+    duration_days: Optional[int] = None
+
+class LocalExtraction(BaseModel):
+    """Result of the local extraction; needs_llm is set when the LLM should still look at the input."""
+    budget: Optional[Budget] = None
+    travel_companions: Optional[TravelCompanions] = None
+    travel_time: Optional[TravelTime] = None
+    ambiguous: bool = False
+
+    def info(self) -> Dict[str, Any]:
+        """Return the extracted fields in the format used by the memory extraction prompts."""
+        info = {}
+        for key in TRAVEL_FIELDS:
+            value = getattr(self, key)
+            if value is not None:
+                info[key] = value.model_dump(exclude_none=True, exclude_defaults=True)
+        return info
+
+    @property
+    def needs_llm(self) -> bool:
+        return self.ambiguous or not self.info()
+
+def parse_number(token: str) -> int:
+    token = token.lower()
+    return NUMBER_WORDS[token] if token in NUMBER_WORDS else int(token)
+
+def parse_amount(number: str, thousands: Optional[str]) -> float:
+    amount = float(number.replace(",", ""))
+    return amount * 1000 if thousands else amount
+
+class TravelFactExtractor:
+    """Rule-based extractor for budget, travel companions and travel time.
+
+    Every rule marks the part of the input it consumed. If anything other than filler words
+    is left over or the input contains a question, the extraction is marked as ambiguous and
+    the LLM extraction still runs; the typed local values then take precedence over the LLM's
+    free-form values for the same fields. Negations and inputs about the past are left to
+    the LLM entirely.
+    """
+
+    def __init__(self):
+        self.budget_levels = {level: re.compile(pattern, re.IGNORECASE) for level, pattern in BUDGET_LEVELS.items()}
+        self.lock = threading.Lock()
+        self.inputs = 0
+        self.local_only = 0
+        self.llm_fallbacks = 0
+        self.fields_extracted = 0
+
+    def _find(self, pattern: "re.Pattern", text: str, taken: List[Tuple[int, int]]) -> List["re.Match"]:
+        """Return the matches of pattern that do not overlap a consumed span and consume them."""
+        matches = []
+        for match in pattern.finditer(text):
+            start, end = match.span()
+            if start == end or any(start < taken_end and taken_start < end for taken_start, taken_end in taken):
+                continue
+            taken.append((start, end))
+            matches.append(match)
+        return matches
+
+    def _budget(self, text: str, taken: List[Tuple[int, int]]) -> Tuple[Optional[Budget], bool]:
+        amounts = []
+        for match in self._find(SYMBOL_MONEY, text, taken):
+            amounts.append((match.start(), match.end(), CURRENCY_SYMBOLS[match.group(1)],
+                            parse_amount(match.group(2), match.group(3))))
+        for match in self._find(WORD_MONEY, text, taken):
+            amounts.append((match.start(), match.end(), CURRENCY_WORDS[match.group(3).lower()],
+                            parse_amount(match.group(1), match.group(2))))
+        for match in self._find(BARE_MONEY, text, taken):
+            number, thousands = (match.group(1), match.group(2)) if match.group(1) else (match.group(3), match.group(4))
+            amounts.append((match.start(), match.end(), None, parse_amount(number, thousands)))
+        levels = [level for level, pattern in self.budget_levels.items() if self._find(pattern, text, taken)]
+
+        if len(levels) > 1 or len(amounts) > 2:
+            return None, True
+        budget = Budget(level=levels[0] if levels else None)
+        if not amounts:
+            return (budget, False) if levels else (None, False)
+
+        amounts.sort()
+        start, end, currency, amount = amounts[0]
+        budget.currency = currency
+        budget.min_amount = budget.max_amount = amount
+        if len(amounts) == 2:
+            # Two amounts are only understood as a range such as "$2000 to $3000"
+            if currency != amounts[1][2] or not RANGE_END.match(text[end:amounts[1][1]]):
+                return None, True
+            budget.max_amount = amounts[1][3]
+            end = amounts[1][1]
+        else:
+            range_end = RANGE_END.match(text, end)
+            range_start = RANGE_START.search(text[:start])
+            if range_end:
+                budget.max_amount = parse_amount(range_end.group(1), range_end.group(2))
+                end = range_end.end()
+            elif range_start:
+                budget.min_amount = parse_amount(range_start.group(1), range_start.group(2))
+                start = range_start.start()
+        taken.append((start, end))
+
+        prefix = text[max(0, start - 30):start]
+        if MAX_QUALIFIER.search(prefix):
+            budget.min_amount = None
+        elif MIN_QUALIFIER.search(prefix):
+            budget.max_amount = None
+        elif APPROXIMATE_QUALIFIER.search(prefix):
+            budget.approximate = True
+        per_person = PER_PERSON.match(text, end)
+        if per_person:
+            budget.per_person = True
+            taken.append(per_person.span())
+        return budget, False
+
+    def _companions(self, text: str, taken: List[Tuple[int, int]]) -> Optional[TravelCompanions]:
+        partner = bool(self._find(PARTNER, text, taken)) or bool(self._find(COUPLE, text, taken))
+        children = sum(parse_number(match.group(1)) for match in self._find(COUNTED_CHILDREN, text, taken))
+        children += len(self._find(SINGLE_CHILD, text, taken))
+        uncounted_children = bool(self._find(UNCOUNTED_CHILDREN, text, taken))
+        ages = []
+        for match in self._find(CHILD_AGES, text, taken):
+            ages.extend(int(age) for age in re.findall(r"\d+", match.group(1) or match.group(2)))
+        adults = sum(parse_number(match.group(1)) for match in self._find(ADULTS, text, taken)) or None
+        party = None
+        for match in self._find(PARTY, text, taken):
+            party = parse_number(match.group(1) or match.group(2))
+        family_party = False
+        for match in self._find(FAMILY_PARTY, text, taken):
+            party = parse_number(match.group(1))
+            family_party = True
+        friends = bool(self._find(FRIENDS, text, taken))
+        solo = bool(self._find(SOLO, text, taken))
+        family = bool(self._find(FAMILY, text, taken))
+
+        if not children and ages:
+            children = len(ages)
+        if children or uncounted_children or family_party:
+            style = "family"
+        elif friends:
+            style = "friends"
+        elif party and party > 2:
+            style = "group"
+        elif partner or party == 2:
+            style = "couple"
+        elif solo:
+            style = "solo"
+        elif family:
+            style = "family"
+        else:
+            return None
+
+        if adults is None:
+            if party:
+                # "A family of four" does not say how many of them are children
+                adults = party - children if party > children and (children or not family_party) else None
+            elif partner:
+                adults = 2
+            elif solo and style == "solo":
+                adults = 1
+        return TravelCompanions(style=style, adults=adults, children=children or None, children_ages=ages)
+
+    def _travel_time(self, text: str, taken: List[Tuple[int, int]]) -> Tuple[Optional[TravelTime], bool]:
+        travel_time = TravelTime()
+        holidays = self._find(HOLIDAY, text, taken)
+        months = self._find(MONTH, text, taken)
+        seasons = self._find(SEASON, text, taken)
+        if len({m.group(1).lower() for m in holidays}) > 1 or len({m.group(2).lower() for m in months}) > 1 \
+                or len({m.group(2).lower() for m in seasons}) > 1:
+            return None, True
+        if holidays:
+            travel_time.holiday = holidays[0].group(1).lower()
+        if months:
+            travel_time.month = months[0].group(2).capitalize()
+            travel_time.part = months[0].group(1).lower() if months[0].group(1) else None
+        if seasons:
+            travel_time.season = seasons[0].group(2).lower()
+            travel_time.part = travel_time.part or (seasons[0].group(1).lower() if seasons[0].group(1) else None)
+
+        relative_year = self._find(RELATIVE_YEAR, text, taken)
+        years = self._find(YEAR, text, taken)
+        if years:
+            travel_time.year = int(years[0].group(1))
+        elif relative_year:
+            offset = 1 if relative_year[0].group(1).lower() == "next" else 0
+            travel_time.year = datetime.now().year + offset
+        relative = self._find(RELATIVE, text, taken)
+        if relative:
+            travel_time.relative = relative[0].group(1).lower()
+
+        durations = self._find(DURATION, text, taken)
+        if len(durations) > 1:
+            return None, True
+        if durations:
+            match = durations[0]
+            if match.group(3):
+                travel_time.duration_days = DURATION_DAYS[match.group(3).lower()]
+            else:
+                travel_time.duration_days = parse_number(match.group(1)) * DURATION_DAYS[match.group(2).lower()]
+
+        if travel_time == TravelTime():
+            return None, False
+        return travel_time, False
+
+    def has_leftover(self, text: str, taken: List[Tuple[int, int]]) -> bool:
+        """Check whether the input contains anything besides the consumed spans and filler words."""
+        remaining = list(text.lower())
+        for start, end in taken:
+            remaining[start:end] = " " * (end - start)
+        words = re.findall(r"[\w$€£¥']+", "".join(remaining))
+        return any(word.replace("'", "") not in FILLER_WORDS for word in words)
+
+    def parse(self, text: str) -> LocalExtraction:
+        """Extract the essential travel fields from the input without counting it."""
+        if PAST.search(text) or NEGATION.search(text):
+            return LocalExtraction(ambiguous=True)
+        taken: List[Tuple[int, int]] = []
+        budget, budget_ambiguous = self._budget(text, taken)
+        travel_companions = self._companions(text, taken)
+        travel_time, time_ambiguous = self._travel_time(text, taken)
+        return LocalExtraction(
+            budget=budget,
+            travel_companions=travel_companions,
+            travel_time=travel_time,
+            ambiguous=budget_ambiguous or time_ambiguous or "?" in text or self.has_leftover(text, taken)
+        )
+
+    def extract(self, text: str) -> LocalExtraction:
+        """Extract the essential travel fields from the input and count the outcome."""
+        extraction = self.parse(text)
+        with self.lock:
+            self.inputs += 1
+            self.fields_extracted += len(extraction.info())
+            if extraction.needs_llm:
+                self.llm_fallbacks += 1
+            else:
+                self.local_only += 1
+        return extraction
+
+    def normalize(self, info: Dict[str, Any]) -> Dict[str, Any]:
+        """Replace free-form essential fields returned by the LLM with their typed form where possible."""
+        for key in TRAVEL_FIELDS:
+            if isinstance(info.get(key), str):
+                parsed = getattr(self.parse(info[key]), key)
+                if parsed is not None:
+                    info[key] = parsed.model_dump(exclude_none=True, exclude_defaults=True)
+        return info
+
+    def stats(self) -> Dict[str, int]:
+        """Return how many inputs were handled without the LLM and how many fields were extracted."""
+        with self.lock:
+            return {
+                "inputs": self.inputs,
+                "local_only": self.local_only,
+                "llm_fallbacks": self.llm_fallbacks,
+                "fields_extracted": self.fields_extracted
+            }
+
+def canonical_travel_fields(info: Dict[str, Any]) -> Dict[str, Any]:
+    """Rename the keys the LLM used for the essential travel fields to the keys in TRAVEL_FIELDS.
+
+    Aliases such as "budget_information" or "family_composition" are looked up at the top
+    level and one level down, e.g. {"vacation_preferences": {"budget": ...}}; fields that
+    are already present are left alone, and nested objects left empty are removed.
+    """
+    for field, aliases in TRAVEL_FIELD_ALIASES.items():
+        if field in info:
+            continue
+        names = (field, *aliases)
+        for container in (info, *(value for value in list(info.values()) if isinstance(value, dict))):
+            key = next((key for key in container if re.sub(r"[\s-]+", "_", str(key).strip().lower()) in names), None)
+            if key is not None and container[key]:
+                info[field] = container.pop(key)
+                break
+    # Drop the nested objects that only held travel fields
+    for key in [key for key, value in info.items() if value == {}]:
+        del info[key]
+    return info
+
+
+# Explicit requests for destination recommendations, routed to the recommendation chain.
+# A recommendation verb only counts with a destination as its object ("recommend a beach
+# destination", but not "recommend a good restaurant", "recommend somewhere to eat" or "what
+# do you recommend packing"),
+# and "where should we go" only at the end of a sentence (but not "... for dinner").
+DESTINATION = (r"(destinations?|countr(y|ies)|cit(y|ies)|islands?|trips?|holidays?|vacations?|getaways?"
+               r"|places? to (go|visit|travel)|where to (go|travel)|somewhere(?!\s+to\s+(eat|drink|stay|shop|buy)))")
+DESTINATION_MODIFIER = (r"(a|an|some|any|the|a few|few|couple of|good|nice|great|best|top|new|other|cheap|affordable"
+                        r"|warm|sunny|quiet|romantic|exotic|relaxing|beach|city|island|ski|summer|winter"
+                        r"|\w+-friendly)")
+RECOMMENDATION_REQUEST = re.compile(
+    rf"\b(recommend|suggest|propose)\w*\s+((me|us)\s+)?({DESTINATION_MODIFIER}\s+){{0,3}}{DESTINATION}"
+    r"|\bwhere (should|could|can|would|do you think) (i|we) (go|travel|head)"
+    r"( (next|abroad|this \w+|in \w+|on (a )?(holiday|vacation|trip)|for (a |an |our |my )?(holiday|vacation|trip|honeymoon|getaway)))?"
+    r"\s*[.!?]*$"
+    r"|\b(which|what) (destination|country|city|island)s? (should|could|would) (i|we) (go|travel|visit|choose|pick)\b"
+    r"|\b(which|what) (destination|country|city|island)s? (do|would) you (recommend|suggest)\b"
+    r"|\b(destination|travel|holiday|vacation|trip) (ideas|suggestions|recommendations|inspiration)\b"
+    r"|\bhelp (me|us) (choose|pick|find|decide on) (a |an |our |my |the )?(destination|country|city|island|place to go)\b",
+    re.IGNORECASE | re.MULTILINE
+)
+
+def is_recommendation_request(text: str) -> bool:
+    """Check whether the user is explicitly asking for destination recommendations."""
+    return bool(RECOMMENDATION_REQUEST.search(text.strip()))
+
+def evaluate_prefilter(prefilter: MemoryPrefilter, labeled: Iterable[Tuple[str, bool]]) -> Dict[str, float]:
+    """Evaluate a prefilter against inputs labeled with whether they should be memorized.
+
+    Recall is the share of memorable inputs that are still passed on to the LLM check,
+    skip_rate the share of all inputs that would no longer cost an LLM call.
+    """
+    counts = {"true_positive": 0, "false_negative": 0, "false_positive": 0, "true_negative": 0}
+    missed = []
+    for text, should_memorize in labeled:
+        checked = prefilter.classify(text)
+        if should_memorize:
+            counts["true_positive" if checked else "false_negative"] += 1
+            if not checked:
+                missed.append(text)
+        else:
+            counts["false_positive" if checked else "true_negative"] += 1
+    total = sum(counts.values())
+    positives = counts["true_positive"] + counts["false_negative"]
+    skipped = counts["false_negative"] + counts["true_negative"]
+    return {
+        **counts,
+        "total": total,
+        "recall": counts["true_positive"] / positives if positives else 1.0,
+        "skip_rate": skipped / total if total else 0.0,
+        "negatives_skipped": counts["true_negative"] / (total - positives) if total > positives else 0.0,
+        "missed": missed
+    }
+
+def evaluate_router(labeled: Iterable[Tuple[str, bool]]) -> Dict[str, Any]:
+    """Evaluate is_recommendation_request against inputs labeled with whether they ask for destinations."""
+    misrouted = [(text, is_request) for text, is_request in labeled if is_recommendation_request(text) != is_request]
+    return {"total": len(labeled), "misrouted": misrouted}
+
+def evaluate_travel_fields(extractor: TravelFactExtractor,
+                           labeled: Iterable[Tuple[str, Optional[Dict[str, Any]], List[str]]]) -> Dict[str, Any]:
+    """Evaluate which essential travel fields are known after an input.
+
+    Each input is labeled with the travel fields it states and, optionally, an LLM-style
+    extraction of it; the fields must be found by the local extraction of the input, or in
+    the LLM output once its keys are made canonical and its values normalized.
+    """
+    missed = []
+    for text, llm_output, fields in labeled:
+        found = set(extractor.parse(text).info())
+        if llm_output is not None:
+            found |= set(extractor.normalize(canonical_travel_fields(dict(llm_output))))
+        if not set(fields) <= found:
+            missed.append((text, sorted(set(fields) - found)))
+    return {"total": len(labeled), "missed": missed}
+
+def load_labeled_inputs(path: str) -> List[Tuple[str, bool]]:
+    """Load labeled inputs from a JSONL file with "input" and "memorize" fields per line."""
+    labeled = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                labeled.append((record["input"], bool(record["memorize"])))
+    return labeled
+
+def load_labeled_routes(path: str) -> List[Tuple[str, bool]]:
+    """Load the inputs of a JSONL file that are also labeled with a "recommendation" field."""
+    labeled = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                if "recommendation" in record:
+                    labeled.append((record["input"], bool(record["recommendation"])))
+    return labeled
+
+def load_labeled_travel_fields(path: str) -> List[Tuple[str, Optional[Dict[str, Any]], List[str]]]:
+    """Load the inputs of a JSONL file labeled with a "travel_fields" list (and optionally "llm_output")."""
+    labeled = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                if "travel_fields" in record:
+                    labeled.append((record["input"], record.get("llm_output"), list(record["travel_fields"])))
+    return labeled
+
+def print_evaluation(recall: str, results: Dict[str, float]):
+    print(f"\nRecall level: {recall}")
+    print(f"- recall of memorable inputs: {results['recall']:.1%}")
+    print(f"- inputs skipped (LLM calls saved): {results['skip_rate']:.1%}")
+    print(f"- non-memorable inputs skipped: {results['negatives_skipped']:.1%}")
+    for text in results["missed"]:
+        print(f"  missed: {text}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Evaluate the local memory prefilter and extraction against labeled inputs')
+    parser.add_argument('labeled_file', nargs='?', default='prefilter_eval.jsonl',
+                        help='JSONL file with {"input": ..., "memorize": true/false} per line')
+    parser.add_argument('--recall', choices=RECALL_LEVELS, help='Only evaluate this recall level')
+    parser.add_argument('--extract', type=str, help='Print the locally extracted travel fields for this input and exit')
+    args = parser.parse_args()
+
+    if args.extract:
+        extraction = TravelFactExtractor().parse(args.extract)
+        print(json.dumps(extraction.info(), indent=2))
+        print(f"LLM fallback needed: {extraction.needs_llm}")
+        sys.exit(0)
+
+    try:
+        labeled = load_labeled_inputs(args.labeled_file)
+        labeled_routes = load_labeled_routes(args.labeled_file)
+        labeled_fields = load_labeled_travel_fields(args.labeled_file)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Error loading labeled inputs: {e}")
+        sys.exit(1)
+
+    print(f"Evaluating {len(labeled)} labeled inputs from {args.labeled_file}")
+    for recall in ([args.recall] if args.recall else RECALL_LEVELS):
+        print_evaluation(recall, evaluate_prefilter(MemoryPrefilter(recall), labeled))
+
+    if labeled_routes:
+        routing = evaluate_router(labeled_routes)
+        print(f"\nRecommendation router: {routing['total'] - len(routing['misrouted'])} of {routing['total']} "
+              f"inputs routed correctly")
+        for text, is_request in routing["misrouted"]:
+            print(f"  {'missed' if is_request else 'wrongly routed'}: {text}")
+
+    if labeled_fields:
+        fields = evaluate_travel_fields(TravelFactExtractor(), labeled_fields)
+        print(f"\nEssential travel fields: {fields['total'] - len(fields['missed'])} of {fields['total']} "
+              f"inputs complete")
+        for text, missing in fields["missed"]:
+            print(f"  missing {', '.join(missing)}: {text}")
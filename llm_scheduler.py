@@ -0,0 +1,304 @@
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, List, Optional, Tuple, TypeVar
+from contextlib import asynccontextmanager, contextmanager
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Lower values are admitted first; calls of the same priority are admitted in arrival order
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_BACKGROUND: "background"}
+
+# Errors worth retrying: rate limits, timeouts, connection errors and server errors
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+RETRYABLE_ERRORS = {"RateLimitError", "APITimeoutError", "APIConnectionError", "InternalServerError",
+                    "ServiceUnavailableError", "Timeout", "TimeoutError", "ReadTimeout", "ConnectTimeout"}
+
+# How often async callers check whether they can be admitted
+ASYNC_POLL_SECONDS = 0.02
+
+class DeadlineExceeded(TimeoutError):
+    """An LLM call could not be completed before its deadline."""
+
+def status_code(error: BaseException) -> Optional[int]:
+    return getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+
+def is_rate_limit(error: BaseException) -> bool:
+    return status_code(error) == 429 or type(error).__name__ == "RateLimitError"
+
+def is_retryable(error: BaseException) -> bool:
+    return status_code(error) in RETRYABLE_STATUS_CODES or type(error).__name__ in RETRYABLE_ERRORS
+
+def retry_after(error: BaseException) -> Optional[float]:
+    """Return the delay the API asked for in a Retry-After header, if any."""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    try:
+        return float(headers.get("retry-after")) if headers else None
+    except (TypeError, ValueError):
+        return None
+
+class TokenBucket:
+    """Token bucket that refills at per_minute per minute, holding at most one minute's worth."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Return how long until amount can be taken; amounts above the capacity wait for a full bucket."""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def take(self, amount: float, now: float):
+        self._refill(now)
+        self.level -= min(amount, self.capacity)
+
+    def adjust(self, amount: float):
+        """Take (positive) or give back (negative) amount after the fact, e.g. to settle an estimate."""
+        self.level = min(self.capacity, self.level - amount)
+
+class LLMScheduler:
+    """Process-wide admission control, retries and deadlines for LLM calls.
+
+    A call is admitted once it is first in the queue (by priority, then arrival), fewer
+    than max_concurrency calls are in flight and the request and token buckets hold one
+    request and its estimated tokens (limits of 0 are unlimited). Retryable errors are
+    retried up to max_retries times after an exponential backoff with full jitter, at
+    least as long as a Retry-After header asks; a rate limit error pauses all admissions
+    for that long, so the process slows down instead of failing calls. A call that cannot
+    be admitted or retried before its deadline raises DeadlineExceeded.
+    """
+
+    def __init__(self, requests_per_minute: float = 0, tokens_per_minute: float = 0, max_concurrency: int = 8,
+                 max_retries: int = 4, base_delay: float = 0.5, max_delay: float = 20.0):
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute > 0 else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute > 0 else None
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._cond = threading.Condition()
+        # Waiting calls as (priority, arrival) entries
+        self._queue: List[Tuple[int, int]] = []
+        self._arrivals = itertools.count()
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.admitted = 0
+        self.throttled = 0
+        self.rate_limited = 0
+        self.retries = 0
+        self.deadline_exceeded = 0
+        self.failed = 0
+
+    def _enqueue(self, priority: int) -> Tuple[int, int]:
+        entry = (priority, next(self._arrivals))
+        with self._cond:
+            heapq.heappush(self._queue, entry)
+        return entry
+
+    def _dequeue(self, entry: Tuple[int, int]):
+        with self._cond:
+            if entry in self._queue:
+                self._queue.remove(entry)
+                heapq.heapify(self._queue)
+            self._cond.notify_all()
+
+    def _try_admit(self, entry: Tuple[int, int], tokens: float, deadline: Optional[float],
+                   throttled: List[bool]) -> Optional[float]:
+        """Admit the call if it can run now; must be called with the lock held.
+
+        Returns None once admitted, otherwise the time to wait before trying again
+        (float("inf") until another call finishes or is admitted).
+        """
+        now = time.monotonic()
+        wait = float("inf")
+        if self._queue[0] == entry and self.in_flight < self.max_concurrency:
+            wait = max(self.paused_until - now,
+                       self.request_bucket.wait_time(1, now) if self.request_bucket else 0.0,
+                       self.token_bucket.wait_time(tokens, now) if self.token_bucket else 0.0)
+            if wait <= 0:
+                heapq.heappop(self._queue)
+                self._take(tokens, now)
+                # The next call in the queue may be admitted as well
+                self._cond.notify_all()
+                return None
+            if not throttled[0]:
+                throttled[0] = True
+                self.throttled += 1
+        if deadline is not None:
+            if now >= deadline:
+                self.deadline_exceeded += 1
+                raise DeadlineExceeded("LLM call was not admitted before its deadline")
+            wait = min(wait, deadline - now)
+        return wait
+
+    def _take(self, tokens: float, now: float):
+        if self.request_bucket:
+            self.request_bucket.take(1, now)
+        if self.token_bucket:
+            self.token_bucket.take(tokens, now)
+        self.in_flight += 1
+        self.admitted += 1
+
+    def _release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def acquire(self, priority: int = PRIORITY_INTERACTIVE, tokens: float = 0, deadline: Optional[float] = None):
+        """Block until the call is admitted; release() must be called when it is done."""
+        entry = self._enqueue(priority)
+        throttled = [False]
+        try:
+            with self._cond:
+                while True:
+                    wait = self._try_admit(entry, tokens, deadline, throttled)
+                    if wait is None:
+                        return
+                    self._cond.wait(None if wait == float("inf") else wait)
+        except BaseException:
+            self._dequeue(entry)
+            raise
+
+    async def aacquire(self, priority: int = PRIORITY_INTERACTIVE, tokens: float = 0, deadline: Optional[float] = None):
+        """Async variant of acquire; waits on the event loop instead of blocking it."""
+        entry = self._enqueue(priority)
+        throttled = [False]
+        try:
+            while True:
+                with self._cond:
+                    wait = self._try_admit(entry, tokens, deadline, throttled)
+                if wait is None:
+                    return
+                await asyncio.sleep(min(wait, ASYNC_POLL_SECONDS))
+        except BaseException:
+            self._dequeue(entry)
+            raise
+
+    def release(self):
+        self._release()
+
+    def adjust_tokens(self, tokens: float):
+        """Settle the difference between a call's actual and estimated tokens."""
+        if self.token_bucket and tokens:
+            with self._cond:
+                self.token_bucket.adjust(tokens)
+
+    @contextmanager
+    def slot(self, priority: int = PRIORITY_INTERACTIVE, tokens: float = 0,
+             deadline: Optional[float] = None) -> Iterator[None]:
+        """Hold an admitted call for the duration of the block."""
+        self.acquire(priority, tokens, deadline)
+        try:
+            yield
+        finally:
+            self.release()
+
+    @asynccontextmanager
+    async def aslot(self, priority: int = PRIORITY_INTERACTIVE, tokens: float = 0,
+                    deadline: Optional[float] = None) -> AsyncIterator[None]:
+        """Async variant of slot."""
+        await self.aacquire(priority, tokens, deadline)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def backoff(self, error: Exception, attempt: int, deadline: Optional[float] = None) -> float:
+        """Return how long to wait before retrying after error, or raise if it should not be retried."""
+        if not is_retryable(error) or attempt >= self.max_retries:
+            with self._cond:
+                self.failed += 1
+            raise error
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        delay = max(delay, retry_after(error) or 0.0)
+        now = time.monotonic()
+        if deadline is not None and now + delay >= deadline:
+            with self._cond:
+                self.deadline_exceeded += 1
+            raise DeadlineExceeded(f"LLM call failed and cannot be retried before its deadline: {error}") from error
+        with self._cond:
+            self.retries += 1
+            if is_rate_limit(error):
+                self.rate_limited += 1
+                # Every caller backs off, not just this one
+                self.paused_until = max(self.paused_until, now + delay)
+        logger.warning("LLM call failed (%s), retrying in %.1fs (attempt %d of %d)",
+                       type(error).__name__, delay, attempt + 1, self.max_retries)
+        return delay
+
+    def run(self, call: Callable[[], T], priority: int = PRIORITY_INTERACTIVE, tokens: float = 0,
+            deadline: Optional[float] = None) -> T:
+        """Run call once admitted, retrying retryable errors until the deadline."""
+        for attempt in itertools.count():
+            try:
+                with self.slot(priority, tokens, deadline):
+                    return call()
+            except DeadlineExceeded:
+                raise
+            except Exception as e:
+                time.sleep(self.backoff(e, attempt, deadline))
+
+    async def arun(self, call: Callable[[], Awaitable[T]], priority: int = PRIORITY_INTERACTIVE, tokens: float = 0,
+                   deadline: Optional[float] = None) -> T:
+        """Async variant of run."""
+        for attempt in itertools.count():
+            try:
+                async with self.aslot(priority, tokens, deadline):
+                    return await call()
+            except DeadlineExceeded:
+                raise
+            except Exception as e:
+                await asyncio.sleep(self.backoff(e, attempt, deadline))
+
+    def stats(self) -> Dict[str, Any]:
+        """Return the queue depth by priority, the calls in flight and the admission and retry counters."""
+        with self._cond:
+            queued = {name: 0 for name in PRIORITY_NAMES.values()}
+            for priority, _ in self._queue:
+                queued[PRIORITY_NAMES.get(priority, str(priority))] += 1
+            return {
+                "queued": queued,
+                "in_flight": self.in_flight,
+                "admitted": self.admitted,
+                "throttled": self.throttled,
+                "rate_limited": self.rate_limited,
+                "retries": self.retries,
+                "deadline_exceeded": self.deadline_exceeded,
+                "failed": self.failed
+            }
+
+    def prometheus_lines(self) -> List[str]:
+        """Render the scheduler statistics in the Prometheus text exposition format."""
+        stats = self.stats()
+        lines = ["# HELP travel_agent_llm_queue_depth LLM calls waiting to be admitted.",
+                 "# TYPE travel_agent_llm_queue_depth gauge"]
+        lines += [f'travel_agent_llm_queue_depth{{priority="{name}"}} {count}' for name, count in stats["queued"].items()]
+        lines += ["# HELP travel_agent_llm_in_flight LLM calls in flight.",
+                  "# TYPE travel_agent_llm_in_flight gauge",
+                  f"travel_agent_llm_in_flight {stats['in_flight']}"]
+        for key, description in (("admitted", "LLM calls admitted"),
+                                 ("throttled", "LLM calls that waited for the rate limits"),
+                                 ("rate_limited", "Rate limit errors returned by the API"),
+                                 ("retries", "Retried LLM calls"),
+                                 ("deadline_exceeded", "LLM calls that missed their deadline"),
+                                 ("failed", "LLM calls that failed after retries")):
+            lines += [f"# HELP travel_agent_llm_{key}_total {description}.",
+                      f"# TYPE travel_agent_llm_{key}_total counter",
+                      f"travel_agent_llm_{key}_total {stats[key]}"]
+        return lines
@@ -0,0 +1,74 @@
+from typing import Any, Callable, Dict, Iterator, List, Optional
+from contextlib import contextmanager
+from contextvars import ContextVar
+from uuid import UUID
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import LLMResult
+from langchain_core.tracers.context import register_configure_hook
+
+class TokenUsageHandler(BaseCallbackHandler):
+    """Adds the tokens and cost of every LLM call of a run to a metrics span.
+
+    The usage reported by the API is used; if the model reports none (e.g. when
+    streaming), the prompt and completion are counted with count_tokens. The cost is
+    computed from the prices in USD per million prompt and completion tokens.
+    """
+
+    def __init__(self, span: Dict[str, Any], count_tokens: Callable[[str], int],
+                 input_cost_per_million: float = 0.0, output_cost_per_million: float = 0.0):
+        self.span = span
+        self.count_tokens = count_tokens
+        self.input_cost_per_million = input_cost_per_million
+        self.output_cost_per_million = output_cost_per_million
+        # Prompts by run, only counted if the model does not report its usage
+        self._prompts: Dict[UUID, List[str]] = {}
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], *, run_id: UUID, **kwargs: Any):
+        self._prompts[run_id] = prompts
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages: List[List[BaseMessage]], *,
+                            run_id: UUID, **kwargs: Any):
+        self._prompts[run_id] = [str(message.content) for batch in messages for message in batch]
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        self._prompts.pop(run_id, None)
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any):
+        prompts = self._prompts.pop(run_id, [])
+        llm_output = response.llm_output or {}
+        usage = llm_output.get("token_usage") or {}
+        prompt_tokens = usage.get("prompt_tokens")
+        completion_tokens = usage.get("completion_tokens")
+        if prompt_tokens is None:
+            # Chat models may report the usage on the message instead
+            for generation in (generation for generations in response.generations for generation in generations):
+                usage_metadata = getattr(getattr(generation, "message", None), "usage_metadata", None)
+                if usage_metadata:
+                    prompt_tokens = (prompt_tokens or 0) + usage_metadata["input_tokens"]
+                    completion_tokens = (completion_tokens or 0) + usage_metadata["output_tokens"]
+        if prompt_tokens is None:
+            prompt_tokens = sum(self.count_tokens(prompt) for prompt in prompts)
+        if completion_tokens is None:
+            completion_tokens = sum(self.count_tokens(generation.text)
+                                    for generations in response.generations for generation in generations)
+        self.span["prompt_tokens"] += prompt_tokens
+        self.span["completion_tokens"] += completion_tokens
+        self.span["cost_usd"] += (prompt_tokens * self.input_cost_per_million
+                                  + completion_tokens * self.output_cost_per_million) / 1_000_000
+        if llm_output.get("model_name"):
+            self.span["model"] = llm_output["model_name"]
+
+# Handler added to every LLM run started in the current context, for LLM calls made
+# inside LangChain where no callbacks can be passed (e.g. the chat history summary)
+_usage_handler: ContextVar[Optional[TokenUsageHandler]] = ContextVar("token_usage_handler", default=None)
+register_configure_hook(_usage_handler, inheritable=True)
+
+@contextmanager
+def track_usage(handler: TokenUsageHandler) -> Iterator[TokenUsageHandler]:
+    """Add the handler to every LLM run started within the block."""
+    token = _usage_handler.set(handler)
+    try:
+        yield handler
+    finally:
+        _usage_handler.reset(token)
@@ -0,0 +1,164 @@
+from typing import Any, Callable, ContextManager, Dict, Iterable, List, Optional
+from contextlib import nullcontext
+from datetime import datetime, timedelta
+from vector_store import UserAwareChroma, normalize_memory_value
+import json
+import logging
+import math
+import threading
+
+logger = logging.getLogger(__name__)
+
+def memory_value(document: str) -> Any:
+    """Return the normalized value of a memory document of the form 'key: <json value>'."""
+    _, _, value = document.partition(": ")
+    try:
+        return normalize_memory_value(json.loads(value))
+    except ValueError:
+        return normalize_memory_value(value)
+
+def cosine_similarity(first: List[float], second: List[float]) -> float:
+    dot = sum(a * b for a, b in zip(first, second))
+    norm = math.sqrt(sum(a * a for a in first)) * math.sqrt(sum(b * b for b in second))
+    return dot / norm if norm else 0.0
+
+def parse_timestamp(metadata: Optional[Dict[str, Any]]) -> Optional[datetime]:
+    try:
+        return datetime.fromisoformat((metadata or {})["timestamp"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+class MemoryConsolidator:
+    """Expires and merges a user's memories and rebuilds the index they are stored in.
+
+    Memories older than max_age_days (by their timestamp metadata) are deleted. Within each
+    memory type, memories with the same normalized value or a cosine similarity of at least
+    merge_similarity are merged into the most recent one, and with keep_per_type only
+    the most recent memories of each type are kept. lock_for returns a context manager that
+    keeps the user's conversation from writing memories while the user is consolidated.
+    """
+
+    def __init__(self, vectorstore: UserAwareChroma, max_age_days: Optional[float] = 365,
+                 merge_similarity: float = 0.95, keep_per_type: Optional[int] = None,
+                 lock_for: Optional[Callable[[str], ContextManager]] = None):
+        self.vectorstore = vectorstore
+        self.max_age_days = max_age_days
+        self.merge_similarity = merge_similarity
+        self.keep_per_type = keep_per_type
+        self.lock_for = lock_for or (lambda user_id: nullcontext())
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def select_removals(self, data: Dict[str, List[Any]], now: datetime) -> Dict[str, List[str]]:
+        """Return the IDs to delete, by reason ("expired", "merged" and "trimmed")."""
+        removals = {"expired": [], "merged": [], "trimmed": []}
+        cutoff = now - timedelta(days=self.max_age_days) if self.max_age_days else None
+        by_type: Dict[str, List[Dict[str, Any]]] = {}
+        for index, memory_id in enumerate(data["ids"]):
+            metadata = data["metadatas"][index] or {}
+            timestamp = parse_timestamp(metadata)
+            if cutoff and timestamp and timestamp < cutoff:
+                removals["expired"].append(memory_id)
+                continue
+            by_type.setdefault(metadata.get("type", ""), []).append({
+                "id": memory_id,
+                "value": memory_value(data["documents"][index]),
+                "embedding": list(data["embeddings"][index]) if data["embeddings"] is not None else None,
+                "timestamp": timestamp or datetime.min
+            })
+
+        for entries in by_type.values():
+            # Newest first, so the most recent statement of a fact is the one that is kept
+            entries.sort(key=lambda entry: entry["timestamp"], reverse=True)
+            kept = []
+            for entry in entries:
+                redundant = any(
+                    entry["value"] == other["value"] or (
+                        entry["embedding"] and other["embedding"]
+                        and cosine_similarity(entry["embedding"], other["embedding"]) >= self.merge_similarity
+                    )
+                    for other in kept
+                )
+                if redundant:
+                    removals["merged"].append(entry["id"])
+                else:
+                    kept.append(entry)
+            if self.keep_per_type:
+                removals["trimmed"].extend(entry["id"] for entry in kept[self.keep_per_type:])
+        return removals
+
+    def consolidate_user(self, user_id: str, rebuild: bool = True, now: Optional[datetime] = None) -> Dict[str, int]:
+        """Consolidate one user's memories and return the number of entries removed and kept."""
+        with self.lock_for(user_id):
+            data = self.vectorstore.get_memories(user_id)
+            removals = self.select_removals(data, now or datetime.now())
+            removed = [memory_id for ids in removals.values() for memory_id in ids]
+            self.vectorstore.delete_memories(user_id, removed)
+            if removed and rebuild:
+                self.vectorstore.rebuild_index(user_id)
+        stats = {reason: len(ids) for reason, ids in removals.items()}
+        stats["before"] = len(data["ids"])
+        stats["after"] = len(data["ids"]) - len(removed)
+        return stats
+
+    def run(self, user_ids: Iterable[str], rebuild: bool = True) -> Dict[str, int]:
+        """Consolidate the given users and return the totals, including the index size before and after."""
+        user_ids = list(user_ids)
+        # Users of the shared backend share a store, which is measured and rebuilt once
+        paths = {self.vectorstore.store_path(user_id): user_id for user_id in user_ids}
+        totals = {"users": 0, "before": 0, "expired": 0, "merged": 0, "trimmed": 0, "after": 0,
+                  "index_bytes_before": sum(self.vectorstore.index_size(user_id) for user_id in paths.values())}
+        # One user per changed store; shards of the shared backend share a directory but are rebuilt separately
+        changed_stores = {}
+        for user_id in user_ids:
+            try:
+                stats = self.consolidate_user(user_id, rebuild=False)
+            except Exception as e:
+                logger.error("Error consolidating memories of user %s: %s", user_id, e, extra={"user_id": user_id})
+                continue
+            totals["users"] += 1
+            for key, value in stats.items():
+                totals[key] += value
+            if stats["after"] < stats["before"]:
+                changed_stores.setdefault(self.vectorstore.store_key(user_id), user_id)
+        if rebuild:
+            for user_id in changed_stores.values():
+                try:
+                    with self.lock_for(user_id):
+                        self.vectorstore.rebuild_index(user_id)
+                except Exception as e:
+                    logger.error("Error rebuilding the memory index of user %s: %s", user_id, e, extra={"user_id": user_id})
+        totals["index_bytes_after"] = sum(self.vectorstore.index_size(user_id) for user_id in paths.values())
+        return totals
+
+    def start(self, interval_seconds: float, list_users: Callable[[], List[str]], rebuild: bool = True):
+        """Run the consolidation every interval_seconds in a daemon thread until stop() is called."""
+        def loop():
+            while not self._stop.wait(interval_seconds):
+                try:
+                    totals = self.run(list_users(), rebuild=rebuild)
+                except Exception as e:
+                    logger.error("Error in memory consolidation: %s", e)
+                    continue
+                removed = totals["expired"] + totals["merged"] + totals["trimmed"]
+                if removed:
+                    logger.info("Memory consolidation removed %d of %d memories", removed, totals["before"])
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=loop, name="memory-consolidation", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background consolidation thread, waiting for a running consolidation to finish."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+def print_consolidation_stats(totals: Dict[str, int]):
+    """Print the totals returned by MemoryConsolidator.run."""
+    print(f"\nConsolidated the memories of {totals['users']} users:")
+    print(f"- entries: {totals['before']} before, {totals['after']} after")
+    print(f"- removed: {totals['expired']} expired, {totals['merged']} merged, {totals['trimmed']} trimmed")
+    print(f"- index size: {totals['index_bytes_before'] / 1024:.1f} KB before, "
+          f"{totals['index_bytes_after'] / 1024:.1f} KB after")
@@ -0,0 +1,338 @@
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Tuple, TypeVar
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from bounded_cache import BoundedCache
+import json
+import logging
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# The turn running in the current context; spans started within it are added to it
+_current_turn: ContextVar[Optional[Dict[str, Any]]] = ContextVar("metrics_turn", default=None)
+
+# Whether the current context runs work that the turn does not wait for
+_background: ContextVar[bool] = ContextVar("metrics_background", default=False)
+
+T = TypeVar("T")
+
+def current_turn() -> Optional[Dict[str, Any]]:
+    """Return the turn running in the current context, if any."""
+    return _current_turn.get()
+
+def is_background() -> bool:
+    """Check whether the current context runs background work of a turn."""
+    return _background.get()
+
+def run_in_background(function: Callable[..., T], *args, **kwargs) -> T:
+    """Call function marked as background work; must run in a copy of the turn's context.
+
+    Its spans still belong to the turn, but are marked with background=True.
+    """
+    _background.set(True)
+    return function(*args, **kwargs)
+
+async def arun_in_background(awaitable: Awaitable[T]) -> T:
+    """Async variant of run_in_background; must run as its own task."""
+    _background.set(True)
+    return await awaitable
+
+class Metrics:
+    """Wall time, token usage and cost of every timed call, per call name and per user.
+
+    A span times one call (a graph node, a chain, a vector store operation or a speech
+    synthesis) and may carry its prompt and completion tokens and its cost in USD. Spans
+    started during a turn belong to that turn and its user, also in worker threads that
+    run in a copy of the turn's context. Spans are aggregated by kind and name for the
+    Prometheus export, per user for the cost per user, and the spans of each user's last
+    turn are kept for a per-turn breakdown. With a trace_path every span is appended to
+    that file as a JSON line.
+    """
+
+    def __init__(self, trace_path: Optional[str] = None, max_users: int = 1000):
+        self.trace_path = trace_path
+        self._trace_file = None
+        self._lock = threading.Lock()
+        # Aggregates by (kind, name)
+        self.calls: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        # Totals and the last turn of the most recently active users
+        self.users = BoundedCache(max_users)
+        self.last_turns = BoundedCache(max_users)
+        # Functions returning additional lines for the Prometheus export, e.g. gauges of other components
+        self.collectors: List[Callable[[], List[str]]] = []
+
+    def add_collector(self, collect: Callable[[], List[str]]):
+        """Add a function whose lines in the Prometheus text format are appended to the export."""
+        with self._lock:
+            self.collectors.append(collect)
+
+    def configure(self, trace_path: Optional[str] = None):
+        """Set the JSONL trace file; None stops tracing."""
+        with self._lock:
+            if self._trace_file is not None:
+                self._trace_file.close()
+                self._trace_file = None
+            self.trace_path = trace_path
+
+    @contextmanager
+    def turn(self, user_id: str) -> Iterator[Dict[str, Any]]:
+        """Time a conversation turn; spans started within it are added to the turn."""
+        turn = {"turn_id": uuid.uuid4().hex, "user_id": user_id, "start": time.time(), "ms": None, "spans": []}
+        token = _current_turn.set(turn)
+        try:
+            with self.span("turn", "turn", user_id):
+                yield turn
+        finally:
+            try:
+                _current_turn.reset(token)
+            except ValueError:
+                # A streamed turn whose generator is closed from another context
+                pass
+            self.last_turns[user_id] = turn
+
+    @contextmanager
+    def span(self, kind: str, name: str, user_id: Optional[str] = None, **fields) -> Iterator[Dict[str, Any]]:
+        """Time a call; the yielded record can be updated with tokens, cost and other fields."""
+        turn = _current_turn.get()
+        record = {
+            "kind": kind,
+            "name": name,
+            "user_id": user_id or (turn["user_id"] if turn else None),
+            "turn_id": turn["turn_id"] if turn else None,
+            "start": time.time(),
+            "ms": 0.0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "cost_usd": 0.0,
+            "error": None,
+            "background": _background.get(),
+            **fields
+        }
+        start = time.perf_counter()
+        try:
+            yield record
+        except Exception as e:
+            record["error"] = type(e).__name__
+            raise
+        finally:
+            record["ms"] = (time.perf_counter() - start) * 1000
+            self._finish(record, turn)
+
+    def _finish(self, record: Dict[str, Any], turn: Optional[Dict[str, Any]]):
+        seconds = record["ms"] / 1000
+        with self._lock:
+            calls = self.calls.get((record["kind"], record["name"]))
+            if calls is None:
+                calls = self.calls[(record["kind"], record["name"])] = {
+                    "calls": 0, "errors": 0, "seconds": 0.0, "buckets": [0] * len(LATENCY_BUCKETS),
+                    "prompt_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0
+                }
+            calls["calls"] += 1
+            calls["errors"] += record["error"] is not None
+            calls["seconds"] += seconds
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    calls["buckets"][index] += 1
+                    break
+            for field in ("prompt_tokens", "completion_tokens", "cost_usd"):
+                calls[field] += record[field]
+
+            if record["user_id"] is not None:
+                totals = self.users.get(record["user_id"])
+                if totals is None:
+                    totals = {"turns": 0, "turn_seconds": 0.0, "prompt_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0}
+                    self.users[record["user_id"]] = totals
+                if record["kind"] == "turn":
+                    totals["turns"] += 1
+                    totals["turn_seconds"] += seconds
+                for field in ("prompt_tokens", "completion_tokens", "cost_usd"):
+                    totals[field] += record[field]
+
+            if turn is not None:
+                if record["kind"] == "turn":
+                    turn["ms"] = record["ms"]
+                else:
+                    # Spans of background work that outlives the turn are still added to it
+                    turn["spans"].append(record)
+            self._trace(record)
+
+    def _trace(self, record: Dict[str, Any]):
+        """Append a span to the trace file; must be called with the lock held."""
+        if not self.trace_path:
+            return
+        try:
+            if self._trace_file is None:
+                self._trace_file = open(self.trace_path, "a", buffering=1)
+            self._trace_file.write(json.dumps(record, default=str) + "\n")
+        except OSError as e:
+            logger.error("Error writing the metrics trace, tracing stopped: %s", e)
+            self.trace_path = None
+
+    def last_turn(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """Return the breakdown of a user's last turn: its time, tokens and cost and its spans by kind and name.
+
+        Spans of background work are listed separately from the spans of the same call the turn waited for.
+        """
+        turn = self.last_turns.peek(user_id)
+        if turn is None:
+            return None
+        with self._lock:
+            spans = list(turn["spans"])
+        breakdown: Dict[Tuple[str, str, bool], Dict[str, Any]] = {}
+        for span in spans:
+            row = breakdown.setdefault((span["kind"], span["name"], span["background"]), {
+                "kind": span["kind"], "name": span["name"], "background": span["background"], "calls": 0, "ms": 0.0,
+                "prompt_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0
+            })
+            row["calls"] += 1
+            for field in ("ms", "prompt_tokens", "completion_tokens", "cost_usd"):
+                row[field] += span[field]
+        return {
+            "turn_id": turn["turn_id"],
+            "ms": turn["ms"],
+            "prompt_tokens": sum(span["prompt_tokens"] for span in spans),
+            "completion_tokens": sum(span["completion_tokens"] for span in spans),
+            "cost_usd": sum(span["cost_usd"] for span in spans),
+            "breakdown": sorted(breakdown.values(), key=lambda row: row["ms"], reverse=True)
+        }
+
+    def user_totals(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """Return a user's number of turns, turn time, tokens and cost."""
+        totals = self.users.peek(user_id)
+        if totals is None:
+            return None
+        with self._lock:
+            return dict(totals)
+
+    def stats(self) -> List[Dict[str, Any]]:
+        """Return the aggregated calls, errors, time, tokens and cost by kind and name."""
+        with self._lock:
+            return [
+                {"kind": kind, "name": name, **{key: value for key, value in calls.items() if key != "buckets"}}
+                for (kind, name), calls in sorted(self.calls.items())
+            ]
+
+    def prometheus_text(self) -> str:
+        """Render the aggregates in the Prometheus text exposition format."""
+        lines = [
+            "# HELP travel_agent_calls_total Timed calls by kind and name.",
+            "# TYPE travel_agent_calls_total counter"
+        ]
+        with self._lock:
+            calls = sorted((key, dict(value, buckets=list(value["buckets"]))) for key, value in self.calls.items())
+        labels = {key: f'kind="{escape_label(key[0])}",name="{escape_label(key[1])}"' for key, _ in calls}
+        lines += [f"travel_agent_calls_total{{{labels[key]}}} {value['calls']}" for key, value in calls]
+        lines += ["# HELP travel_agent_errors_total Timed calls that raised an exception.",
+                  "# TYPE travel_agent_errors_total counter"]
+        lines += [f"travel_agent_errors_total{{{labels[key]}}} {value['errors']}" for key, value in calls]
+        lines += ["# HELP travel_agent_call_duration_seconds Wall time of timed calls.",
+                  "# TYPE travel_agent_call_duration_seconds histogram"]
+        for key, value in calls:
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, value["buckets"]):
+                cumulative += count
+                lines.append(f'travel_agent_call_duration_seconds_bucket{{{labels[key]},le="{bound}"}} {cumulative}')
+            lines.append(f'travel_agent_call_duration_seconds_bucket{{{labels[key]},le="+Inf"}} {value["calls"]}')
+            lines.append(f"travel_agent_call_duration_seconds_sum{{{labels[key]}}} {value['seconds']:.6f}")
+            lines.append(f"travel_agent_call_duration_seconds_count{{{labels[key]}}} {value['calls']}")
+        lines += ["# HELP travel_agent_tokens_total LLM tokens by kind, name and type.",
+                  "# TYPE travel_agent_tokens_total counter"]
+        for key, value in calls:
+            if value["prompt_tokens"] or value["completion_tokens"]:
+                lines.append(f'travel_agent_tokens_total{{{labels[key]},type="prompt"}} {value["prompt_tokens"]}')
+                lines.append(f'travel_agent_tokens_total{{{labels[key]},type="completion"}} {value["completion_tokens"]}')
+        lines += ["# HELP travel_agent_cost_usd_total Estimated cost of LLM and speech calls in USD.",
+                  "# TYPE travel_agent_cost_usd_total counter"]
+        lines += [f"travel_agent_cost_usd_total{{{labels[key]}}} {value['cost_usd']:.8f}"
+                  for key, value in calls if value["cost_usd"]]
+        with self._lock:
+            collectors = list(self.collectors)
+        for collect in collectors:
+            lines += collect()
+        return "\n".join(lines) + "\n"
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+# Metrics of this process, shared by the agent, the vector stores and the speech synthesis
+metrics = Metrics()
+
+def start_metrics_server(port: int, host: str = "127.0.0.1", registry: Metrics = metrics) -> ThreadingHTTPServer:
+    """Serve the metrics in the Prometheus text format at /metrics from a daemon thread."""
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.prometheus_text().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug("Metrics request: " + format, *args)
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    logger.info("Serving metrics at http://%s:%d/metrics", host, server.server_port)
+    return server
+
+# Attributes every LogRecord has; anything else was passed with extra= and is logged as a field
+_LOG_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+def log_record_extras(record: logging.LogRecord) -> Dict[str, Any]:
+    """Return the fields passed with extra= to a log record."""
+    return {key: value for key, value in vars(record).items() if key not in _LOG_RECORD_FIELDS}
+
+class JsonLogFormatter(logging.Formatter):
+    """Formats log records as JSON lines, with the fields passed with extra= and the current turn."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        turn = _current_turn.get()
+        if turn is not None:
+            entry["user_id"] = turn["user_id"]
+            entry["turn_id"] = turn["turn_id"]
+        entry.update(log_record_extras(record))
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class TextLogFormatter(logging.Formatter):
+    """Formats log records as text lines, followed by the fields passed with extra= as key=value."""
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        line = super().formatMessage(record)
+        extras = log_record_extras(record)
+        if extras:
+            # repr keeps multi-line values such as the text of a failed parse on one line
+            line += " " + " ".join(f"{key}={value!r}" for key, value in extras.items())
+        return line
+
+def configure_logging(level: str = "INFO", log_format: str = "text"):
+    """Send log records to stderr, as text or as JSON lines (log_format "json")."""
+    handler = logging.StreamHandler()
+    if log_format == "json":
+        handler.setFormatter(JsonLogFormatter())
+    else:
+        handler.setFormatter(TextLogFormatter())
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level.upper())
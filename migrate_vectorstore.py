@@ -0,0 +1,107 @@
+"""Migrate per-user Chroma stores into the shared vector store.
+
+Copies the documents, metadata and embeddings of every travel_memory/<user_id> store into
+the shared collections used with VECTOR_BACKEND=shared, without re-embedding anything.
+Documents keep their IDs and are upserted, so the migration can safely be run again.
+"""
+from typing import Dict, List
+import argparse
+import os
+import shutil
+import sys
+import uuid
+
+os.environ.setdefault("ANONYMIZED_TELEMETRY", "False")
+
+from langchain.vectorstores import Chroma
+from vector_store import SharedChroma, SHARED_STORE_DIR, close_store
+
+# Number of documents copied per upsert
+BATCH_SIZE = 500
+
+def find_user_stores(base_dir: str) -> List[str]:
+    """Return the IDs of users that have a per-user Chroma store."""
+    if not os.path.exists(base_dir):
+        return []
+    return sorted(
+        d for d in os.listdir(base_dir)
+        if d != SHARED_STORE_DIR and os.path.exists(os.path.join(base_dir, d, "chroma.sqlite3"))
+    )
+
+def remove_user_store(user_dir: str):
+    """Delete the Chroma database and index directories, keeping the session file."""
+    os.remove(os.path.join(user_dir, "chroma.sqlite3"))
+    for name in os.listdir(user_dir):
+        path = os.path.join(user_dir, name)
+        try:
+            # Index directories are named after their segment UUID
+            uuid.UUID(name)
+        except ValueError:
+            continue
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+
+def migrate_user(user_id: str, base_dir: str, target: SharedChroma) -> Dict[str, int]:
+    """Copy one user's memories into the shared store and return the source and target counts."""
+    source = Chroma(persist_directory=os.path.join(base_dir, user_id))
+    try:
+        data = source._collection.get(include=["documents", "metadatas", "embeddings"])
+    finally:
+        # Chroma keeps every opened directory's system running until it is closed
+        close_store(source)
+    with target.use_store(user_id) as store:
+        for start in range(0, len(data["ids"]), BATCH_SIZE):
+            end = start + BATCH_SIZE
+            store._collection.upsert(
+                ids=data["ids"][start:end],
+                embeddings=data["embeddings"][start:end],
+                documents=data["documents"][start:end],
+                # Older entries may lack the user ID the shared store filters on
+                metadatas=[{**(metadata or {}), "user_id": user_id} for metadata in data["metadatas"][start:end]]
+            )
+    return {"source": len(data["ids"]), "target": target._count_documents(user_id)}
+
+def migrate(base_dir: str, shards: int, remove_source: bool = False, dry_run: bool = False) -> bool:
+    """Migrate every per-user store below base_dir; returns False if any user failed to migrate."""
+    user_ids = find_user_stores(base_dir)
+    if not user_ids:
+        print("No per-user vector stores found.")
+        return True
+    print(f"Migrating {len(user_ids)} user stores into {shards} shared shard(s)")
+    if dry_run:
+        for user_id in user_ids:
+            print(f"- {user_id}")
+        return True
+
+    target = SharedChroma(base_dir, embedding_function=None, shards=shards)
+    ok = True
+    migrated = 0
+    for user_id in user_ids:
+        try:
+            counts = migrate_user(user_id, base_dir, target)
+        except Exception as e:
+            print(f"Error migrating user {user_id}: {str(e)}")
+            ok = False
+            continue
+        if counts["target"] < counts["source"]:
+            print(f"Error: user {user_id} has {counts['target']} of {counts['source']} memories after migration")
+            ok = False
+            continue
+        migrated += counts["source"]
+        if remove_source:
+            remove_user_store(os.path.join(base_dir, user_id))
+    print(f"Migrated {migrated} memories")
+    return ok
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Migrate per-user vector stores into the shared vector store')
+    parser.add_argument('--base-dir', default='./travel_memory', help='Directory holding the user directories')
+    parser.add_argument('--shards', type=int, default=int(os.getenv("VECTOR_SHARDS", "1")),
+                        help='Number of shared collections; must match VECTOR_SHARDS')
+    parser.add_argument('--remove-source', action='store_true',
+                        help='Delete the per-user stores once their memories are verified in the shared store')
+    parser.add_argument('--dry-run', action='store_true', help='Only list the stores that would be migrated')
+    args = parser.parse_args()
+
+    if not migrate(args.base_dir, args.shards, remove_source=args.remove_source, dry_run=args.dry_run):
+        sys.exit(1)
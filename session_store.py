@@ -0,0 +1,174 @@
+from typing import Dict, List, Optional, Tuple
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+class SessionStore:
+    """Per-user session snapshots and transcripts in a single SQLite database.
+
+    A snapshot is the compressed JSON of a user's session, one row per user, so resuming
+    a user is a single primary key lookup. Messages that no longer fit the session are
+    appended to the user's transcript, one row per message. Snapshots and transcript
+    messages saved within sync_interval_seconds of each other are written in one
+    transaction, so a burst of turns costs one fsync instead of one per turn, and repeated
+    saves of the same user only write the latest snapshot. Saved data that is not written
+    yet is returned by load and load_transcript. With a sync interval of 0 every save is
+    written immediately.
+    """
+
+    def __init__(self, path: str, sync_interval_seconds: float = 1.0, max_pending: int = 100):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.sync_interval_seconds = sync_interval_seconds
+        self.max_pending = max_pending
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        # In WAL mode a commit appends to the log and syncs it once, readers are not blocked
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=FULL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS sessions "
+            "(user_id TEXT PRIMARY KEY, updated REAL NOT NULL, state BLOB NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS transcripts (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "user_id TEXT NOT NULL, role TEXT NOT NULL, content TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS transcripts_user ON transcripts (user_id, id)")
+        self.connection.commit()
+        # Snapshots saved since the last sync, by user ID
+        self.pending: Dict[str, bytes] = {}
+        # Transcript messages appended since the last sync, in order
+        self.pending_messages: List[Tuple[str, str, str, float]] = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.saves = 0
+        self.syncs = 0
+        self.loads = 0
+
+    def _schedule_sync(self) -> bool:
+        """Start the background sync if needed; must be called with the lock held. Returns True to sync now."""
+        pending = len(self.pending) + len(self.pending_messages)
+        if self.sync_interval_seconds <= 0 or pending >= self.max_pending:
+            return True
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._sync_loop, name="session-sync", daemon=True)
+            self._thread.start()
+        return False
+
+    def save(self, user_id: str, state_json: str):
+        """Save a user's session snapshot; it is written with the next sync."""
+        blob = zlib.compress(state_json.encode("utf-8"))
+        with self._lock:
+            self.pending[user_id] = blob
+            self.saves += 1
+            sync_now = self._schedule_sync()
+        if sync_now:
+            self.sync()
+
+    def append_transcript(self, user_id: str, messages: List[Dict[str, str]]):
+        """Append messages to a user's transcript; they are written with the next sync."""
+        if not messages:
+            return
+        now = time.time()
+        with self._lock:
+            self.pending_messages.extend((user_id, message["role"], message["content"], now) for message in messages)
+            sync_now = self._schedule_sync()
+        if sync_now:
+            self.sync()
+
+    def load_transcript(self, user_id: str) -> List[Dict[str, str]]:
+        """Return the messages appended to a user's transcript, oldest first."""
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT role, content FROM transcripts WHERE user_id = ? ORDER BY id", (user_id,)
+            ).fetchall()
+            rows += [(role, content) for pending_user, role, content, _ in self.pending_messages
+                     if pending_user == user_id]
+        return [{"role": role, "content": content} for role, content in rows]
+
+    def load(self, user_id: str) -> Optional[str]:
+        """Return the JSON of a user's latest session snapshot, or None if there is none."""
+        with self._lock:
+            self.loads += 1
+            blob = self.pending.get(user_id)
+            if blob is None:
+                row = self.connection.execute(
+                    "SELECT state FROM sessions WHERE user_id = ?", (user_id,)
+                ).fetchone()
+                blob = row[0] if row else None
+        return zlib.decompress(blob).decode("utf-8") if blob is not None else None
+
+    def user_ids(self) -> List[str]:
+        """Return the IDs of all users with a session snapshot."""
+        with self._lock:
+            stored = [row[0] for row in self.connection.execute("SELECT user_id FROM sessions")]
+            return sorted(set(stored) | set(self.pending))
+
+    def sync(self):
+        """Write all pending snapshots and transcript messages in one transaction.
+
+        The lock is held from taking the pending data until it is committed, so load and
+        load_transcript never miss data that is being written.
+        """
+        with self._lock:
+            if not self.pending and not self.pending_messages:
+                return
+            now = time.time()
+            rows = [(user_id, now, blob) for user_id, blob in self.pending.items()]
+            try:
+                # Messages dropped from a snapshot are written together with it
+                self.connection.executemany(
+                    "INSERT INTO transcripts (user_id, role, content, created) VALUES (?, ?, ?, ?)",
+                    self.pending_messages
+                )
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO sessions (user_id, updated, state) VALUES (?, ?, ?)", rows
+                )
+                self.connection.commit()
+            except Exception:
+                # The snapshots and messages stay pending for the next sync
+                self.connection.rollback()
+                raise
+            self.pending = {}
+            self.pending_messages = []
+            self.syncs += 1
+
+    def _sync_loop(self):
+        while not self._stop.wait(self.sync_interval_seconds):
+            try:
+                self.sync()
+            except Exception as e:
+                logger.error("Error writing session snapshots: %s", e)
+
+    def close(self):
+        """Stop the background sync and write the pending snapshots."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.sync()
+
+    def stats(self) -> Dict[str, int]:
+        """Return the number of snapshots and transcript messages, their size and the save, sync and load counters."""
+        with self._lock:
+            snapshots, size = self.connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(state)), 0) FROM sessions"
+            ).fetchone()
+            transcript_messages = self.connection.execute("SELECT COUNT(*) FROM transcripts").fetchone()[0]
+            return {
+                "snapshots": snapshots,
+                "bytes": size,
+                "transcript_messages": transcript_messages + len(self.pending_messages),
+                "pending": len(self.pending) + len(self.pending_messages),
+                "saves": self.saves,
+                "syncs": self.syncs,
+                "loads": self.loads
+            }
@@ -1,41 +1,292 @@
-from typing import Dict, List, Tuple, Any
-from langchain.chat_models import ChatOpenAI
-from langchain.chains import LLMChain
-from langchain.prompts import PromptTemplate
-from langchain.memory import ConversationBufferMemory
-from langchain.vectorstores import Chroma
-from langchain.embeddings import OpenAIEmbeddings
-from langgraph.graph import Graph, StateGraph
-from pydantic import BaseModel
+from typing import TYPE_CHECKING, Dict, List, Tuple, Any, Awaitable, Callable, Optional, Iterator, AsyncIterator
+from pydantic import BaseModel, ConfigDict
+from collections import defaultdict
 import json
 import os
 import sys
 import argparse
+import threading
+import asyncio
+import contextvars
+import functools
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 from datetime import datetime
 from dotenv import load_dotenv
+from bounded_cache import BoundedCache
+from vector_store import create_vectorstore, memory_id, SHARED_STORE_DIR
+from memory_consolidation import MemoryConsolidator, print_consolidation_stats
+from session_store import SessionStore
+from user_index import UserIndex, is_valid_user_id
+from user_lock import UserLock
+from contextlib import asynccontextmanager, contextmanager
+from fast_path import MemoryPrefilter, TravelFactExtractor, RECALL_LEVELS, is_recommendation_request, canonical_travel_fields
+from metrics import metrics, configure_logging, start_metrics_server, run_in_background, arun_in_background
+from llm_scheduler import LLMScheduler, DeadlineExceeded, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND
 import uuid
-import random
+import atexit
+import itertools
+import time
+import weakref
+
+# The LangChain, LangGraph and Chroma modules take seconds to import, so they are only
+# imported when the components that use them are built (see AgentComponents)
+if TYPE_CHECKING:
+    from langchain.chains import LLMChain
+    from chat_history import WindowedSummaryMemory
+    from llm_usage import TokenUsageHandler
+
+logger = logging.getLogger("travelAgent")
 
 # Load environment variables
 load_dotenv()
 
-# Get and validate API key
+# The API key is validated when the chat model is built, so commands that do not chat work without it
 api_key = os.getenv("OPENAI_API_KEY")
-if not api_key:
-    raise ValueError("OPENAI_API_KEY not found in environment variables. Please check your .env file.")
-
-# Initialize OpenAI Chat model with GPT-4o-mini
-llm = ChatOpenAI(
-    model="gpt-4o-mini",
-    api_key=api_key,
-    temperature=0.7,
-    max_tokens=2000
-)
 
-# Initialize embeddings with OpenAI
-embeddings = OpenAIEmbeddings(
-    api_key=api_key
-)
+# Memory extraction mode: "two_pass" runs the yes/no memory check before extracting,
+# "single_pass" gates and extracts in a single call (an empty JSON object means nothing to memorize)
+MEMORY_EXTRACTION_MODE = os.getenv("MEMORY_EXTRACTION_MODE", "two_pass")
+MEMORY_EXTRACTION_MODES = ("two_pass", "single_pass")
+
+# Graph mode: "sequential" finishes the memory check before generating the response,
+# "background" runs it concurrently and the response uses the profile as of the previous turn
+MEMORY_GRAPH_MODE = os.getenv("MEMORY_GRAPH_MODE", "sequential")
+MEMORY_GRAPH_MODES = ("sequential", "background")
+
+# Local prefilter that skips the LLM memory check for inputs with clearly nothing to memorize:
+# "high" keeps every input that mentions the user or a memory category, "balanced" only keeps
+# inputs matching a memory category, "off" sends every input to the LLM
+MEMORY_PREFILTER = os.getenv("MEMORY_PREFILTER", "high")
+MEMORY_PREFILTER_MODES = ("off",) + RECALL_LEVELS
+
+# Local extraction of budget, travel companions and travel time: "on" fills these fields
+# without an LLM call and only falls back to the LLM for inputs it cannot fully interpret
+LOCAL_EXTRACTION = os.getenv("LOCAL_EXTRACTION", "on")
+LOCAL_EXTRACTION_MODES = ("on", "off")
+
+# Bounds for the per-user caches; a TTL of 0 disables expiry
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "1000"))
+SESSION_TTL_SECONDS = float(os.getenv("SESSION_TTL_SECONDS", "3600")) or None
+VECTORSTORE_CACHE_SIZE = int(os.getenv("VECTORSTORE_CACHE_SIZE", "100"))
+
+# Session snapshots are saved after every turn and written to SESSION_STORE_PATH in batches,
+# at most SESSION_SYNC_INTERVAL_SECONDS apart; an interval of 0 writes every turn immediately
+SESSION_STORE_PATH = os.getenv("SESSION_STORE_PATH", "./travel_memory/sessions.sqlite3")
+SESSION_SYNC_INTERVAL_SECONDS = float(os.getenv("SESSION_SYNC_INTERVAL_SECONDS", "1"))
+
+# Index of all user IDs, used to allocate new IDs and to look up and list existing users
+USER_INDEX_PATH = os.getenv("USER_INDEX_PATH", "./travel_memory/users.sqlite3")
+
+# Vector store layout: "per_user" keeps a Chroma store in every user's directory, "shared"
+# keeps all users in VECTOR_SHARDS shared collections filtered by the user_id metadata
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "per_user")
+VECTOR_SHARDS = int(os.getenv("VECTOR_SHARDS", "1"))
+
+# Maximum number of tokens the rendered user profile may take up in the agent prompt
+PROFILE_TOKEN_BUDGET = int(os.getenv("PROFILE_TOKEN_BUDGET", "300"))
+
+# Chat history window: the last HISTORY_MAX_TURNS turns are kept verbatim within
+# HISTORY_TOKEN_BUDGET tokens, older turns are folded into a running summary
+HISTORY_MAX_TURNS = int(os.getenv("HISTORY_MAX_TURNS", "5"))
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "1000"))
+HISTORY_SUMMARY_BATCH_TURNS = int(os.getenv("HISTORY_SUMMARY_BATCH_TURNS", "2"))
+
+# Messages kept in the session, at least the chat history window; older messages are moved
+# to the user's transcript in the session store, so sessions stay the same size
+MESSAGE_BUFFER_SIZE = max(int(os.getenv("MESSAGE_BUFFER_SIZE", "40")), 2 * HISTORY_MAX_TURNS)
+
+# Memory consolidation: memories older than MEMORY_MAX_AGE_DAYS are expired (0 keeps them),
+# memories of the same type at least MEMORY_MERGE_SIMILARITY similar are merged, and with
+# MEMORY_KEEP_PER_TYPE only that many memories of each type are kept (0 keeps all). With
+# CONSOLIDATION_INTERVAL_SECONDS the job also runs in a background thread during conversations.
+MEMORY_MAX_AGE_DAYS = float(os.getenv("MEMORY_MAX_AGE_DAYS", "365"))
+MEMORY_MERGE_SIMILARITY = float(os.getenv("MEMORY_MERGE_SIMILARITY", "0.95"))
+MEMORY_KEEP_PER_TYPE = int(os.getenv("MEMORY_KEEP_PER_TYPE", "0"))
+CONSOLIDATION_INTERVAL_SECONDS = float(os.getenv("CONSOLIDATION_INTERVAL_SECONDS", "0"))
+
+# Embedding provider: "openai", or "hashing" / "sentence_transformer" to embed locally without
+# network calls (EMBEDDING_MODEL picks the sentence-transformers model). Embeddings are cached
+# in EMBEDDING_CACHE_PATH, an empty path disables the cache, and it keeps the
+# EMBEDDING_CACHE_MAX_ENTRIES most recently used vectors (0 for no limit). Stores created with
+# one provider cannot be queried with another, as the vectors differ.
+EMBEDDING_PROVIDER = os.getenv("EMBEDDING_PROVIDER", "openai")
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL")
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "./travel_memory/embeddings.sqlite3")
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "100000"))
+
+# Observability: log level and format ("text" or "json lines"), a JSONL trace of every
+# timed call (empty to disable) and the port of the Prometheus /metrics endpoint (0 to
+# disable). The cost of each LLM call is computed from the chat model's prices in USD per
+# million prompt and completion tokens (gpt-4o-mini by default).
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+LOG_FORMATS = ("text", "json")
+METRICS_TRACE_PATH = os.getenv("METRICS_TRACE_PATH", "")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+LLM_INPUT_COST_PER_MILLION = float(os.getenv("LLM_INPUT_COST_PER_MILLION", "0.15"))
+LLM_OUTPUT_COST_PER_MILLION = float(os.getenv("LLM_OUTPUT_COST_PER_MILLION", "0.60"))
+metrics.configure(trace_path=METRICS_TRACE_PATH or None)
+
+# OpenAI rate limits shared by all calls of the process, in requests and tokens per minute
+# (0 for no limit), and the most calls in flight at once. Calls that fail with a rate limit,
+# timeout or server error are retried up to LLM_MAX_RETRIES times with jittered backoff.
+# Each attempt times out after LLM_TIMEOUT_SECONDS; calls the turn waits for must complete
+# within LLM_DEADLINE_SECONDS and background memory extraction within
+# LLM_BACKGROUND_DEADLINE_SECONDS (0 for no deadline), including the time spent waiting to be
+# admitted. The tokens of a call are estimated from its prompt plus
+# LLM_COMPLETION_TOKENS_ESTIMATE and settled afterwards.
+LLM_REQUESTS_PER_MINUTE = float(os.getenv("LLM_REQUESTS_PER_MINUTE", "500"))
+LLM_TOKENS_PER_MINUTE = float(os.getenv("LLM_TOKENS_PER_MINUTE", "200000"))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "30"))
+LLM_DEADLINE_SECONDS = float(os.getenv("LLM_DEADLINE_SECONDS", "60"))
+LLM_BACKGROUND_DEADLINE_SECONDS = float(os.getenv("LLM_BACKGROUND_DEADLINE_SECONDS", "120"))
+LLM_COMPLETION_TOKENS_ESTIMATE = int(os.getenv("LLM_COMPLETION_TOKENS_ESTIMATE", "150"))
+
+class AgentComponents:
+    """The agent's chat model, embeddings, chains, stores and compiled graphs, built on first use.
+
+    Nothing is built when the module is imported, so commands that do not chat (such as
+    --list-users) start without loading LangChain or needing an API key. Each component is
+    built once and then shared by all users of the process. Components passed to the
+    constructor or to configure are used instead of building them, e.g. fakes in tests;
+    the components built from them (such as the chains from llm) pick them up.
+    """
+    NAMES = ("llm", "llm_scheduler", "embeddings", "vectorstore", "chains", "session_store", "user_index",
+             "memory_consolidator")
+
+    def __init__(self, **overrides):
+        self._lock = threading.RLock()
+        self._components: Dict[str, Any] = {}
+        self.configure(**overrides)
+
+    def configure(self, **overrides):
+        """Drop all built components and use the given ones instead of building them."""
+        unknown = set(overrides) - set(self.NAMES)
+        if unknown:
+            raise ValueError(f"Unknown components {sorted(unknown)}, expected some of {self.NAMES}")
+        with self._lock:
+            self._components = dict(overrides)
+
+    def _get(self, name: str, build: Callable[[], Any]) -> Any:
+        component = self._components.get(name)
+        if component is None:
+            # Reentrant, as building a component may build the ones it depends on
+            with self._lock:
+                component = self._components.get(name)
+                if component is None:
+                    component = self._components[name] = build()
+        return component
+
+    def peek(self, name: str) -> Any:
+        """Return a component if it was built, without building it."""
+        return self._components.get(name)
+
+    @property
+    def llm(self):
+        return self._get("llm", create_llm)
+
+    @property
+    def llm_scheduler(self) -> LLMScheduler:
+        return self._get("llm_scheduler", create_llm_scheduler)
+
+    @property
+    def embeddings(self):
+        return self._get("embeddings", create_embedding_function)
+
+    @property
+    def vectorstore(self):
+        return self._get("vectorstore", lambda: create_vectorstore(
+            VECTOR_BACKEND,
+            base_dir="./travel_memory",
+            embedding_function=self.embeddings,
+            shards=VECTOR_SHARDS,
+            max_open_stores=VECTORSTORE_CACHE_SIZE,
+            ttl_seconds=SESSION_TTL_SECONDS
+        ))
+
+    @property
+    def chains(self) -> Dict[str, Any]:
+        return self._get("chains", lambda: create_chains(self.llm))
+
+    @property
+    def session_store(self) -> SessionStore:
+        return self._get("session_store", create_session_store)
+
+    @property
+    def user_index(self) -> UserIndex:
+        return self._get("user_index", lambda: UserIndex(USER_INDEX_PATH, discover_users=discover_legacy_users))
+
+    @property
+    def memory_consolidator(self) -> MemoryConsolidator:
+        return self._get("memory_consolidator", lambda: MemoryConsolidator(
+            self.vectorstore,
+            max_age_days=MEMORY_MAX_AGE_DAYS or None,
+            merge_similarity=MEMORY_MERGE_SIMILARITY,
+            keep_per_type=MEMORY_KEEP_PER_TYPE or None,
+            lock_for=consolidation_lock
+        ))
+
+    def workflow(self, background_memory: bool = False, use_async: bool = False):
+        """Return the compiled agent graph for the given mode."""
+        return self._get(f"workflow_{background_memory}_{use_async}",
+                         lambda: build_workflow(background_memory=background_memory, use_async=use_async))
+
+    def build(self) -> "AgentComponents":
+        """Build every component that is needed to chat, e.g. once at startup."""
+        for name in ("llm", "embeddings", "vectorstore", "chains", "session_store", "user_index"):
+            getattr(self, name)
+        self.workflow(background_memory=MEMORY_GRAPH_MODE == "background")
+        return self
+
+def create_llm():
+    """Create the OpenAI chat model (GPT-4o-mini)."""
+    if not api_key:
+        raise ValueError("OPENAI_API_KEY not found in environment variables. Please check your .env file.")
+    from langchain.chat_models import ChatOpenAI
+    return ChatOpenAI(
+        model="gpt-4o-mini",
+        api_key=api_key,
+        temperature=0.7,
+        max_tokens=2000,
+        # Retries are left to the scheduler, which knows the call's deadline
+        request_timeout=LLM_TIMEOUT_SECONDS,
+        max_retries=0
+    )
+
+def create_llm_scheduler() -> LLMScheduler:
+    """Create the scheduler shared by all LLM calls and export its statistics as metrics."""
+    scheduler = LLMScheduler(
+        requests_per_minute=LLM_REQUESTS_PER_MINUTE,
+        tokens_per_minute=LLM_TOKENS_PER_MINUTE,
+        max_concurrency=LLM_MAX_CONCURRENCY,
+        max_retries=LLM_MAX_RETRIES
+    )
+    metrics.add_collector(scheduler.prometheus_lines)
+    return scheduler
+
+def create_embedding_function():
+    """Create the configured embedding provider."""
+    from embedding_providers import create_embeddings
+    return create_embeddings(
+        EMBEDDING_PROVIDER,
+        api_key=api_key,
+        cache_path=EMBEDDING_CACHE_PATH or None,
+        model_name=EMBEDDING_MODEL,
+        cache_max_entries=EMBEDDING_CACHE_MAX_ENTRIES
+    )
+
+components = AgentComponents()
+
+class RenderedProfile(BaseModel):
+    """User profile text rendered for the agent prompt, cached until the profile changes."""
+    version: int = -1
+    text: str = ""
+    tokens: int = 0
+    raw_tokens: int = 0
 
 # Define the state schema
 class AgentState(BaseModel):
@@ -47,22 +298,20 @@ class AgentState(BaseModel):
     last_recommendation: str = ""
     user_profile: Dict[str, Any] = {}
     chat_history: List[Tuple[str, str]] = []
+    is_new_user: bool = True
+    profile_version: int = 0
+    rendered_profile: RenderedProfile = RenderedProfile()
+    history_summary: str = ""
 
     @classmethod
     def create_new_user(cls, custom_id: str = None) -> 'AgentState':
-        """Create a new AgentState instance with a unique three-digit user ID."""
-        def generate_unique_id():
-            """Generate a unique three-digit ID that doesn't exist in the travel_memory directory."""
-            while True:
-                # Generate a random three-digit number
-                user_id = str(random.randint(100, 999))
-                # Check if this ID already exists
-                user_dir = os.path.join("./travel_memory", user_id)
-                if not os.path.exists(user_dir):
-                    return user_id
-        
-        # Use custom ID if provided, otherwise generate a new one
-        user_id = custom_id if custom_id else generate_unique_id()
+        """Create a new AgentState instance with a unique user ID, registered in the user index."""
+        # Use custom ID if provided, otherwise allocate a new one
+        if custom_id:
+            user_id = custom_id
+            components.user_index.add(user_id)
+        else:
+            user_id = components.user_index.allocate()
         
         return cls(
             user_id=user_id,
@@ -75,6 +324,13 @@ class AgentState(BaseModel):
             chat_history=[]
         )
 
+class ExtractedInfo(BaseModel):
+    """Schema for the JSON object returned by the memory extraction prompts."""
+    model_config = ConfigDict(extra="allow")
+
+    user_name: Optional[str] = None
+    timestamp: Optional[str] = None
+
 # Memory system prompts
 MEMORY_CHECK_PROMPT = """You are a memory system for a travel agent. Your task is to determine if the user's input contains new information that should be memorized.
 Consider the following types of information:
@@ -112,11 +368,45 @@ User input: {input}
 
 Return ONLY a valid JSON object without any additional text or formatting. 
 If a name is mentioned, include it as "user_name" in the JSON.
+Always use these keys for the details needed before recommending destinations: "budget" for the budget,
+"travel_companions" for who the user travels with (e.g. solo, a couple, a family of four) and "travel_time"
+for when they want to travel.
 
 Examples:
 {{"user_name": "John", "timestamp": "2024-04-01"}}
 {{"vacation_preferences": {{"type": "beach"}}, "timestamp": "2024-04-01"}}
-{{"user_name": "Sarah", "vacation_preferences": {{"type": "mountain"}}, "timestamp": "2024-04-01"}}"""
+{{"user_name": "Sarah", "vacation_preferences": {{"type": "mountain"}}, "timestamp": "2024-04-01"}}
+{{"budget": "5000 USD", "travel_companions": "family of four", "travel_time": "July", "timestamp": "2024-04-01"}}"""
+
+SINGLE_PASS_MEMORY_PROMPT = """You are a memory system for a travel agent. Your task is to determine if the user's input contains new information that should be memorized and, if it does, to extract it.
+Consider the following types of information:
+- User's name or personal identifiers (including introductions like "I'm [name]" or "My name is [name]")
+- Vacation preferences (e.g., beach vs. city, luxury vs. budget)
+- Past vacation experiences (destinations, activities, duration)
+- Location information (where they live, where they've been)
+- Travel style preferences (solo, family, group)
+- Budget information (price range, willingness to spend)
+- Family composition (number of children, ages)
+- Time preferences (favorite seasons, preferred duration)
+- Travel frequency
+- Special requirements (accessibility, dietary restrictions)
+- Bucket list destinations
+
+User input: {input}
+
+Return ONLY a valid JSON object without any additional text or formatting.
+If the input contains nothing that should be memorized, return an empty JSON object.
+If a name is mentioned, include it as "user_name" in the JSON.
+Always use these keys for the details needed before recommending destinations: "budget" for the budget,
+"travel_companions" for who the user travels with (e.g. solo, a couple, a family of four) and "travel_time"
+for when they want to travel.
+
+Examples:
+{{}}
+{{"user_name": "John"}}
+{{"vacation_preferences": {{"type": "beach"}}}}
+{{"user_name": "Sarah", "vacation_preferences": {{"type": "mountain"}}}}
+{{"budget": "5000 USD", "travel_companions": "family of four", "travel_time": "July"}}"""
 
 # Main agent prompt
 AGENT_PROMPT = """You are an experienced travel agent with access to the user's preferences and past experiences.
@@ -158,9 +448,17 @@ User Profile:
 Recent Memories:
 {memory}
 
+Previous conversation:
+{chat_history}
+
 Previous Recommendations:
 {last_recommendation}
 
+User request:
+{input}
+
+IMPORTANT: Tailor the recommendation to the user's request, e.g. the region, season or kind of trip they ask about.
+
 IMPORTANT: Only provide a recommendation if the user has specified their budget, number of companions, and preferred travel time. If any of these details are missing, ask the user for the missing information instead.
 
 IMPORTANT: You MUST limit your recommendation to exactly TWO destinations
@@ -173,69 +471,287 @@ STRICT RULES:
 
 Write your response as if you're having a natural conversation with the user. Weave the information into a flowing narrative that highlights why these destinations would be perfect for them based on their preferences and past experiences."""
 
-# Initialize prompts
-memory_check_prompt = PromptTemplate(
-    input_variables=["input"],
-    template=MEMORY_CHECK_PROMPT
-)
+# Essential travel information needed before recommending destinations
+ESSENTIAL_TRAVEL_INFO = {
+    "budget": "budget information",
+    "travel_companions": "number of companions",
+    "travel_time": "preferred travel time"
+}
 
-info_extraction_prompt = PromptTemplate(
-    input_variables=["input"],
-    template=INFO_EXTRACTION_PROMPT
-)
+# Questions for missing essential information, answered from templates without an LLM call
+MISSING_INFO_QUESTIONS = {
+    "budget information": "what budget you have in mind",
+    "number of companions": "who you'll be traveling with",
+    "preferred travel time": "when you'd like to travel"
+}
+MISSING_INFO_TEMPLATE = "I'd love to recommend some destinations for you! To find the right fit, could you tell me {questions}?"
 
-agent_prompt = PromptTemplate(
-    input_variables=["memory", "chat_history", "input", "user_profile", "last_recommendation"],
-    template=AGENT_PROMPT
-)
+def create_chains(llm) -> Dict[str, Any]:
+    """Create the prompt chains of the agent, by name."""
+    from langchain.chains import LLMChain
+    from langchain.prompts import PromptTemplate
 
-recommendation_prompt = PromptTemplate(
-    input_variables=["user_profile", "memory", "last_recommendation"],
-    template=RECOMMENDATION_PROMPT
-)
+    memory_check_prompt = PromptTemplate(
+        input_variables=["input"],
+        template=MEMORY_CHECK_PROMPT
+    )
+    info_extraction_prompt = PromptTemplate(
+        input_variables=["input"],
+        template=INFO_EXTRACTION_PROMPT
+    )
+    single_pass_memory_prompt = PromptTemplate(
+        input_variables=["input"],
+        template=SINGLE_PASS_MEMORY_PROMPT
+    )
+    agent_prompt = PromptTemplate(
+        input_variables=["memory", "chat_history", "input", "user_profile", "last_recommendation"],
+        template=AGENT_PROMPT
+    )
+    recommendation_prompt = PromptTemplate(
+        input_variables=["user_profile", "memory", "chat_history", "input", "last_recommendation"],
+        template=RECOMMENDATION_PROMPT
+    )
+    return {
+        "memory_check": LLMChain(llm=llm, prompt=memory_check_prompt),
+        "info_extraction": LLMChain(llm=llm, prompt=info_extraction_prompt),
+        "single_pass_memory": LLMChain(llm=llm, prompt=single_pass_memory_prompt),
+        "agent": LLMChain(llm=llm, prompt=agent_prompt),
+        "recommendation": LLMChain(llm=llm, prompt=recommendation_prompt),
+        # LLMChain returns the whole completion at once, so streaming uses the prompt piped into the model
+        "agent_stream": agent_prompt | llm,
+        "recommendation_stream": recommendation_prompt | llm
+    }
 
-# Initialize chains
-memory_check_chain = LLMChain(llm=llm, prompt=memory_check_prompt)
-info_extraction_chain = LLMChain(llm=llm, prompt=info_extraction_prompt)
-agent_chain = LLMChain(llm=llm, prompt=agent_prompt)
-recommendation_chain = LLMChain(llm=llm, prompt=recommendation_prompt)
-
-# Initialize vector store for persistent memory with user-specific collections
-class UserAwareChroma:
-    def __init__(self, base_dir: str, embedding_function):
-        self.base_dir = base_dir
-        self.embedding_function = embedding_function
-        self.stores: Dict[str, Chroma] = {}
-
-    def get_store(self, user_id: str) -> Chroma:
-        """Get or create a Chroma store for a specific user."""
-        if user_id not in self.stores:
-            user_dir = os.path.join(self.base_dir, user_id)
-            os.makedirs(user_dir, exist_ok=True)
-            self.stores[user_id] = Chroma(
-                persist_directory=user_dir,
-                embedding_function=self.embedding_function
-            )
-        return self.stores[user_id]
+def create_memory_prefilter(mode: str) -> Optional[MemoryPrefilter]:
+    """Create the memory prefilter for the given mode, or None if it is turned off."""
+    return None if mode == "off" else MemoryPrefilter(recall=mode)
+
+memory_prefilter = create_memory_prefilter(MEMORY_PREFILTER)
+travel_fact_extractor = TravelFactExtractor() if LOCAL_EXTRACTION == "on" else None
+
+# LLM call accounting, used to compare the memory extraction modes
+llm_call_counts: Dict[str, int] = defaultdict(int)
+conversation_turns = 0
+# How often the router picked each kind of response
+route_counts: Dict[str, int] = defaultdict(int)
+_stats_lock = threading.Lock()
+
+def usage_handler(span: Dict[str, Any]) -> "TokenUsageHandler":
+    """Create a callback handler that adds the tokens and cost of LLM calls to a metrics span."""
+    from llm_usage import TokenUsageHandler
+    return TokenUsageHandler(span, count_tokens, LLM_INPUT_COST_PER_MILLION, LLM_OUTPUT_COST_PER_MILLION)
+
+def schedule_call(name: str, chain, inputs: Dict[str, Any], priority: int) -> Tuple[int, Optional[float]]:
+    """Count a chain call and return its estimated tokens and its deadline for the given priority."""
+    with _stats_lock:
+        llm_call_counts[name] += 1
+    # The template of an LLMChain, or of the prompt a streaming chain starts with
+    prompt = getattr(chain, "prompt", None) or getattr(chain, "first", None)
+    characters = len(getattr(prompt, "template", "")) + sum(len(str(value)) for value in inputs.values())
+    tokens = characters // 4 + LLM_COMPLETION_TOKENS_ESTIMATE
+    seconds = LLM_DEADLINE_SECONDS if priority == PRIORITY_INTERACTIVE else LLM_BACKGROUND_DEADLINE_SECONDS
+    return tokens, time.monotonic() + seconds if seconds > 0 else None
+
+def settle_tokens(span: Dict[str, Any], estimated_tokens: int):
+    """Charge the rate limits for the difference between a call's actual and estimated tokens."""
+    actual_tokens = span["prompt_tokens"] + span["completion_tokens"]
+    if actual_tokens:
+        components.llm_scheduler.adjust_tokens(actual_tokens - estimated_tokens)
 
-# Initialize the user-aware vector store
-vectorstore = UserAwareChroma(
-    base_dir="./travel_memory",
-    embedding_function=OpenAIEmbeddings(api_key=api_key)
+def invoke_chain(name: str, chain: "LLMChain", inputs: Dict[str, Any],
+                 priority: int = PRIORITY_INTERACTIVE) -> Dict[str, Any]:
+    """Invoke a chain through the LLM scheduler, count the call under the given name and record its time, tokens and cost.
+
+    Calls nobody waits for should pass PRIORITY_BACKGROUND, so they are admitted after
+    user-facing calls and get the longer background deadline.
+    """
+    tokens, deadline = schedule_call(name, chain, inputs, priority)
+    with metrics.span("chain", name) as span:
+        result = components.llm_scheduler.run(
+            lambda: chain.invoke(inputs, config={"callbacks": [usage_handler(span)]}), priority, tokens, deadline
+        )
+        settle_tokens(span, tokens)
+        return result
+
+async def ainvoke_chain(name: str, chain: "LLMChain", inputs: Dict[str, Any],
+                        priority: int = PRIORITY_INTERACTIVE) -> Dict[str, Any]:
+    """Async variant of invoke_chain."""
+    tokens, deadline = schedule_call(name, chain, inputs, priority)
+    with metrics.span("chain", name) as span:
+        result = await components.llm_scheduler.arun(
+            lambda: chain.ainvoke(inputs, config={"callbacks": [usage_handler(span)]}), priority, tokens, deadline
+        )
+        settle_tokens(span, tokens)
+        return result
+
+def stream_chain(name: str, chain, inputs: Dict[str, Any]) -> Iterator[str]:
+    """Stream the text of a chain's completion through the LLM scheduler, count the call under the given name and record its time, tokens and cost.
+
+    A failed stream is only retried if it failed before its first chunk was yielded.
+    """
+    priority = PRIORITY_INTERACTIVE
+    tokens, deadline = schedule_call(name, chain, inputs, priority)
+    scheduler = components.llm_scheduler
+    with metrics.span("chain", name) as span:
+        for attempt in itertools.count():
+            streamed = False
+            try:
+                with scheduler.slot(priority, tokens, deadline):
+                    for chunk in chain.stream(inputs, config={"callbacks": [usage_handler(span)]}):
+                        if chunk.content:
+                            streamed = True
+                            yield chunk.content
+                break
+            except DeadlineExceeded:
+                raise
+            except Exception as e:
+                if streamed:
+                    raise
+                time.sleep(scheduler.backoff(e, attempt, deadline))
+        settle_tokens(span, tokens)
+
+async def astream_chain(name: str, chain, inputs: Dict[str, Any]) -> AsyncIterator[str]:
+    """Async variant of stream_chain."""
+    priority = PRIORITY_INTERACTIVE
+    tokens, deadline = schedule_call(name, chain, inputs, priority)
+    scheduler = components.llm_scheduler
+    with metrics.span("chain", name) as span:
+        for attempt in itertools.count():
+            streamed = False
+            try:
+                async with scheduler.aslot(priority, tokens, deadline):
+                    async for chunk in chain.astream(inputs, config={"callbacks": [usage_handler(span)]}):
+                        if chunk.content:
+                            streamed = True
+                            yield chunk.content
+                break
+            except DeadlineExceeded:
+                raise
+            except Exception as e:
+                if streamed:
+                    raise
+                await asyncio.sleep(scheduler.backoff(e, attempt, deadline))
+        settle_tokens(span, tokens)
+
+def get_llm_call_stats() -> Dict[str, Any]:
+    """Return LLM call counts per chain and the average number of calls per turn."""
+    with _stats_lock:
+        calls = dict(llm_call_counts)
+        turns = conversation_turns
+        routes = dict(route_counts)
+    total_calls = sum(calls.values())
+    return {
+        "memory_extraction_mode": MEMORY_EXTRACTION_MODE,
+        "turns": turns,
+        "calls": calls,
+        "total_calls": total_calls,
+        "calls_per_turn": total_calls / turns if turns else 0.0,
+        "routes": routes,
+        "prefilter": memory_prefilter.stats() if memory_prefilter else None,
+        "local_extraction": travel_fact_extractor.stats() if travel_fact_extractor else None,
+        "scheduler": components.peek("llm_scheduler").stats() if components.peek("llm_scheduler") else None
+    }
+
+def print_llm_call_stats():
+    """Print the LLM call statistics for this process."""
+    stats = get_llm_call_stats()
+    print(f"\nLLM calls ({stats['memory_extraction_mode']} memory extraction): "
+          f"{stats['total_calls']} over {stats['turns']} turns "
+          f"({stats['calls_per_turn']:.2f} per turn)")
+    for name, count in sorted(stats["calls"].items()):
+        print(f"- {name}: {count}")
+    if stats["routes"]:
+        routes = ", ".join(f"{route}: {count}" for route, count in sorted(stats["routes"].items()))
+        print(f"Router decisions: {routes}")
+    prefilter = stats["prefilter"]
+    if prefilter:
+        print(f"Memory prefilter ({prefilter['recall']} recall): skipped {prefilter['skipped']} "
+              f"of {prefilter['checked'] + prefilter['skipped']} inputs, "
+              f"saving {prefilter['llm_calls_saved']} LLM calls")
+    local_extraction = stats["local_extraction"]
+    if local_extraction:
+        print(f"Local extraction: {local_extraction['local_only']} of {local_extraction['inputs']} inputs "
+              f"handled without the LLM, {local_extraction['fields_extracted']} fields extracted")
+    scheduler = stats["scheduler"]
+    if scheduler:
+        queued = ", ".join(f"{priority}: {count}" for priority, count in scheduler["queued"].items())
+        print(f"LLM scheduler: {scheduler['admitted']} calls admitted, {scheduler['throttled']} throttled, "
+              f"{scheduler['rate_limited']} rate limited, {scheduler['retries']} retries, "
+              f"{scheduler['deadline_exceeded']} past their deadline, {scheduler['failed']} failed "
+              f"({queued} queued, {scheduler['in_flight']} in flight)")
+
+# Background memory checks, one pending check per user
+memory_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("MEMORY_WORKERS", "4")),
+    thread_name_prefix="memory-check"
 )
+pending_memory_checks: Dict[str, Future] = {}
+# Background memory checks started from the async graph
+pending_async_memory_checks: Dict[str, asyncio.Task] = {}
+_pending_lock = threading.Lock()
+# Merges finished background checks into their sessions, off the memory check workers and
+# event loops; checks of users whose lock is held are merged by the holder instead
+memory_apply_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="memory-apply")
+
+def summary_call_plan(prompt_tokens: int) -> Tuple[int, Optional[float]]:
+    """Count a chat history summary call and return its estimated tokens and deadline."""
+    with _stats_lock:
+        llm_call_counts["history_summary"] += 1
+    deadline = time.monotonic() + LLM_DEADLINE_SECONDS if LLM_DEADLINE_SECONDS > 0 else None
+    return prompt_tokens + LLM_COMPLETION_TOKENS_ESTIMATE, deadline
 
-# Dictionary to store user-specific memory buffers
-user_memories: Dict[str, ConversationBufferMemory] = {}
+def run_history_summary(summarize: Callable[[], str], prompt_tokens: int) -> str:
+    """Extend a chat history summary through the LLM scheduler and record its time, tokens and cost."""
+    from llm_usage import track_usage
+    tokens, deadline = summary_call_plan(prompt_tokens)
+    with metrics.span("chain", "history_summary") as span, track_usage(usage_handler(span)):
+        summary = components.llm_scheduler.run(summarize, PRIORITY_INTERACTIVE, tokens, deadline)
+        settle_tokens(span, tokens)
+        return summary
 
-def get_user_memory(user_id: str) -> ConversationBufferMemory:
+async def arun_history_summary(summarize: Callable[[], Awaitable[str]], prompt_tokens: int) -> str:
+    """Async variant of run_history_summary."""
+    from llm_usage import track_usage
+    tokens, deadline = summary_call_plan(prompt_tokens)
+    with metrics.span("chain", "history_summary") as span, track_usage(usage_handler(span)):
+        summary = await components.llm_scheduler.arun(summarize, PRIORITY_INTERACTIVE, tokens, deadline)
+        settle_tokens(span, tokens)
+        return summary
+
+def create_user_memory() -> "WindowedSummaryMemory":
+    """Create an empty chat history for a user."""
+    from chat_history import WindowedSummaryMemory
+    return WindowedSummaryMemory(
+        llm=components.llm,
+        max_turns=HISTORY_MAX_TURNS,
+        summary_batch_turns=HISTORY_SUMMARY_BATCH_TURNS,
+        token_counter=count_tokens,
+        run_summary=run_history_summary,
+        arun_summary=arun_history_summary,
+        max_token_limit=HISTORY_TOKEN_BUDGET,
+        return_messages=True,
+        memory_key="chat_history"
+    )
+
+# Cache of user-specific memory buffers; evicted buffers are rebuilt from the session
+user_memories = BoundedCache(SESSION_CACHE_SIZE, SESSION_TTL_SECONDS)
+
+def get_user_memory(user_id: str) -> "WindowedSummaryMemory":
     """Get or create a memory buffer for a specific user."""
-    if user_id not in user_memories:
-        user_memories[user_id] = ConversationBufferMemory(
-            k=5,  # Keep only the last 2 interactions
-            return_messages=True,
-            memory_key="chat_history"
-        )
-    return user_memories[user_id]
+    user_memory = user_memories.get(user_id)
+    if user_memory is None:
+        user_memory = create_user_memory()
+        # Rehydrate the buffer from the session after it was evicted
+        state = active_sessions.peek(user_id)
+        if state is not None:
+            user_memory.moving_summary_buffer = state.history_summary
+            for message in state.messages[-2 * user_memory.max_turns:]:
+                if message["role"] == "user":
+                    user_memory.chat_memory.add_user_message(message["content"])
+                else:
+                    user_memory.chat_memory.add_ai_message(message["content"])
+        user_memories[user_id] = user_memory
+    return user_memory
 
 def update_user_profile(state: AgentState, new_info: Dict[str, Any]) -> AgentState:
     """Update the user profile with new information."""
@@ -244,243 +760,1051 @@ def update_user_profile(state: AgentState, new_info: Dict[str, Any]) -> AgentSta
             if key != "timestamp":
                 if key not in state.user_profile:
                     state.user_profile[key] = []
+                timestamp = new_info.get("timestamp", datetime.now().isoformat())
+                # A repeated value replaces its earlier entry, so every value is kept once
+                state.user_profile[key] = [entry for entry in state.user_profile[key] if entry["value"] != value]
                 state.user_profile[key].append({
                     "value": value,
-                    "timestamp": new_info.get("timestamp", datetime.now().isoformat())
+                    "timestamp": timestamp
                 })
-        print(f"Updated user profile with new information")
+        state.profile_version += 1
+        logger.info("Updated user profile with new information", extra={"user_id": state.user_id})
     except Exception as e:
-        print(f"Error updating user profile: {str(e)}")
+        logger.error("Error updating user profile: %s", e, extra={"user_id": state.user_id})
+    return state
+
+# Fields that are rendered first, so they survive the profile token budget
+PRIORITY_PROFILE_FIELDS = ("user_name", "budget", "travel_companions", "travel_time")
+
+# Prompt tokens used by the user profile, rendered in full (raw) and compacted
+profile_token_stats = {"renders": 0, "raw_tokens": 0, "compacted_tokens": 0}
+
+_tokenizer_available = True
+
+def count_tokens(text: str) -> int:
+    """Count the tokens of text with the chat model's tokenizer."""
+    global _tokenizer_available
+    if not text:
+        return 0
+    if _tokenizer_available:
+        try:
+            return components.llm.get_num_tokens(text)
+        except Exception as e:
+            # The tokenizer could not be loaded (e.g. offline), fall back to an estimate
+            logger.warning("Error loading tokenizer, estimating token counts: %s", e)
+            _tokenizer_available = False
+    return max(1, len(text) // 4)
+
+def compact_user_profile(user_profile: Dict[str, Any]) -> Dict[str, Tuple[Any, str]]:
+    """Reduce the profile to the latest value and its timestamp for every field."""
+    compacted = {}
+    for key, entries in user_profile.items():
+        if isinstance(entries, list) and entries and isinstance(entries[-1], dict) and "value" in entries[-1]:
+            # Entries are appended in order, so the last one is the latest value
+            compacted[key] = (entries[-1]["value"], entries[-1].get("timestamp", ""))
+        elif entries:
+            compacted[key] = (entries, "")
+    return compacted
+
+def render_user_profile(user_profile: Dict[str, Any], token_budget: int = PROFILE_TOKEN_BUDGET) -> str:
+    """Render the compacted profile as prompt text that fits within token_budget.
+
+    Priority fields come first, then the remaining fields from most to least recently
+    updated; fields that no longer fit the budget are left out.
+    """
+    compacted = compact_user_profile(user_profile)
+    priority = [key for key in PRIORITY_PROFILE_FIELDS if key in compacted]
+    others = sorted(
+        (key for key in compacted if key not in PRIORITY_PROFILE_FIELDS),
+        key=lambda key: compacted[key][1],
+        reverse=True
+    )
+    lines = []
+    used_tokens = 0
+    for key in priority + others:
+        line = f"{key}: {json.dumps(compacted[key][0])}"
+        # Lines are joined with newlines, which count towards the budget as well
+        line_tokens = count_tokens(line) + (1 if lines else 0)
+        if used_tokens + line_tokens > token_budget:
+            continue
+        lines.append(line)
+        used_tokens += line_tokens
+    return "\n".join(lines)
+
+def get_user_profile_text(state: AgentState) -> str:
+    """Return the rendered user profile, re-rendering it only when the profile changed."""
+    if state.rendered_profile.version != state.profile_version:
+        text = render_user_profile(state.user_profile)
+        raw_text = "\n".join([f"{k}: {v}" for k, v in state.user_profile.items()])
+        state.rendered_profile = RenderedProfile(
+            version=state.profile_version,
+            text=text,
+            tokens=count_tokens(text),
+            raw_tokens=count_tokens(raw_text)
+        )
+    with _stats_lock:
+        profile_token_stats["renders"] += 1
+        profile_token_stats["raw_tokens"] += state.rendered_profile.raw_tokens
+        profile_token_stats["compacted_tokens"] += state.rendered_profile.tokens
+    return state.rendered_profile.text
+
+def print_profile_token_stats():
+    """Print how many prompt tokens the profile compaction saved in this process."""
+    with _stats_lock:
+        stats = dict(profile_token_stats)
+    saved = stats["raw_tokens"] - stats["compacted_tokens"]
+    saved_share = saved / stats["raw_tokens"] if stats["raw_tokens"] else 0.0
+    print(f"\nUser profile prompt tokens over {stats['renders']} turns: "
+          f"{stats['raw_tokens']} uncompacted, {stats['compacted_tokens']} compacted "
+          f"({saved} saved, {saved_share:.0%})")
+
+def parse_extracted_info(extracted_text: str) -> Dict[str, Any]:
+    """Parse the JSON returned by an extraction prompt and validate it against ExtractedInfo.
+
+    Raises json.JSONDecodeError for malformed JSON and ValueError for anything that is not
+    a valid JSON object. An empty dictionary means there is nothing to memorize.
+    """
+    extracted_text = extracted_text.strip()
+
+    # Clean up any potential markdown or extra formatting
+    if "```" in extracted_text:
+        # Extract content between triple backticks if present
+        start = extracted_text.find("{")
+        end = extracted_text.rfind("}") + 1
+        if start != -1 and end != -1:
+            extracted_text = extracted_text[start:end]
+
+    extracted_info = json.loads(extracted_text)
+    if not isinstance(extracted_info, dict):
+        raise ValueError("Extracted information is not a dictionary")
+
+    # pydantic.ValidationError is a ValueError
+    return ExtractedInfo.model_validate(extracted_info).model_dump(exclude_none=True)
+
+def extract_new_info(user_input: str, priority: int = PRIORITY_INTERACTIVE) -> str:
+    """Run the configured memory extraction prompts on the user input, at the given scheduler priority.
+
+    Returns the raw JSON text to parse, or an empty string if there is nothing to memorize.
+    Inputs rejected by the local prefilter are not sent to the LLM at all.
+    """
+    if memory_prefilter and not memory_prefilter.should_check(user_input):
+        return ""
+
+    if MEMORY_EXTRACTION_MODE == "single_pass":
+        extracted = invoke_chain("single_pass_memory", components.chains["single_pass_memory"], {"input": user_input}, priority)
+        return extracted["text"]
+
+    result = invoke_chain("memory_check", components.chains["memory_check"], {"input": user_input}, priority)
+    if result["text"].strip().lower() != 'yes':
+        return ""
+    extracted = invoke_chain("info_extraction", components.chains["info_extraction"], {"input": user_input}, priority)
+    return extracted["text"]
+
+async def aextract_new_info(user_input: str, priority: int = PRIORITY_INTERACTIVE) -> str:
+    """Async variant of extract_new_info."""
+    if memory_prefilter and not memory_prefilter.should_check(user_input):
+        return ""
+
+    if MEMORY_EXTRACTION_MODE == "single_pass":
+        extracted = await ainvoke_chain("single_pass_memory", components.chains["single_pass_memory"], {"input": user_input}, priority)
+        return extracted["text"]
+
+    result = await ainvoke_chain("memory_check", components.chains["memory_check"], {"input": user_input}, priority)
+    if result["text"].strip().lower() != 'yes':
+        return ""
+    extracted = await ainvoke_chain("info_extraction", components.chains["info_extraction"], {"input": user_input}, priority)
+    return extracted["text"]
+
+def store_extracted_info(user_id: str, extracted_text: str, local_info: Dict[str, Any] = None) -> Dict[str, Any]:
+    """Parse the extracted information and store it in the user's vector store.
+
+    Fields extracted locally take precedence over the same fields extracted by the LLM.
+    Returns the extracted information, or an empty dictionary if there is nothing to memorize.
+    """
+    if not extracted_text and not local_info:
+        return {}
+    
+    # Parse and validate the JSON
+    extracted_info = {}
+    if extracted_text:
+        chain = "single_pass_memory" if MEMORY_EXTRACTION_MODE == "single_pass" else "info_extraction"
+        try:
+            extracted_info = parse_extracted_info(extracted_text)
+        except json.JSONDecodeError as e:
+            logger.error("Error parsing JSON: %s", e,
+                         extra={"user_id": user_id, "chain": chain, "extracted_text": extracted_text})
+        except ValueError as e:
+            logger.error("Invalid extracted information: %s", e,
+                         extra={"user_id": user_id, "chain": chain, "extracted_text": extracted_text})
+    # The router checks the essential travel fields by key, whatever names the LLM chose for them
+    extracted_info = canonical_travel_fields(extracted_info)
+    if travel_fact_extractor:
+        extracted_info = travel_fact_extractor.normalize(extracted_info)
+    if local_info:
+        extracted_info.update(local_info)
+    
+    # An empty object means there is nothing to memorize
+    if not any(key != "timestamp" for key in extracted_info):
+        return {}
+    
+    # Add timestamp if not present
+    if "timestamp" not in extracted_info:
+        extracted_info["timestamp"] = datetime.now().isoformat()
+    
+    try:
+        # Store all keys in the user-specific vector store in one batch; a fact that is already
+        # stored has the same ID, so restating it only refreshes its timestamp
+        items = [(key, value) for key, value in extracted_info.items() if key != "timestamp"]
+        ids = [memory_id(user_id, key, value) for key, value in items]
+        texts = [f"{key}: {json.dumps(value)}" for key, value in items]
+        new_ids = components.vectorstore.upsert_texts(
+            user_id,
+            ids=ids,
+            texts=texts,
+            metadatas=[{
+                "type": key,
+                "timestamp": extracted_info["timestamp"],
+                "user_id": user_id
+            } for key, _ in items]
+        )
+        components.vectorstore.record_added(user_id, len(new_ids))
+        new_ids = set(new_ids)
+        for memory_text, entry_id in zip(texts, ids):
+            if entry_id in new_ids:
+                logger.info("Stored new information: %s", memory_text, extra={"user_id": user_id})
+            else:
+                logger.info("Refreshed existing information: %s", memory_text, extra={"user_id": user_id})
+    except Exception as e:
+        logger.error("Error processing information: %s", e, extra={"user_id": user_id})
+    return extracted_info
+
+def memorize_new_info(user_id: str, user_input: str, priority: int = PRIORITY_INTERACTIVE) -> Dict[str, Any]:
+    """Extract new information from the user input and store it in the user's vector store.
+
+    Budget, travel companions and travel time are extracted locally first; the LLM is only
+    called if the input contains anything the local extraction could not interpret.
+    Returns the extracted information, or an empty dictionary if there is nothing to memorize.
+    Does not touch the session state, so it can run in the background with PRIORITY_BACKGROUND.
+    """
+    local = travel_fact_extractor.extract(user_input) if travel_fact_extractor else None
+    extracted_text = ""
+    if local is None or local.needs_llm:
+        try:
+            extracted_text = extract_new_info(user_input, priority)
+        except DeadlineExceeded as e:
+            logger.warning("Skipped the memory check, the LLM is overloaded: %s", e, extra={"user_id": user_id})
+        except Exception:
+            logger.exception("Error in memory check", extra={"user_id": user_id})
+    return store_extracted_info(user_id, extracted_text, local.info() if local else None)
+
+async def amemorize_new_info(user_id: str, user_input: str, priority: int = PRIORITY_INTERACTIVE) -> Dict[str, Any]:
+    """Async variant of memorize_new_info; vector store writes run in a worker thread."""
+    local = travel_fact_extractor.extract(user_input) if travel_fact_extractor else None
+    extracted_text = ""
+    if local is None or local.needs_llm:
+        try:
+            extracted_text = await aextract_new_info(user_input, priority)
+        except DeadlineExceeded as e:
+            logger.warning("Skipped the memory check, the LLM is overloaded: %s", e, extra={"user_id": user_id})
+        except Exception:
+            logger.exception("Error in memory check", extra={"user_id": user_id})
+    return await asyncio.to_thread(store_extracted_info, user_id, extracted_text, local.info() if local else None)
+
+def apply_extracted_info(state: AgentState, extracted_info: Dict[str, Any]) -> AgentState:
+    """Merge newly extracted information into the session state."""
+    if extracted_info:
+        state.extracted_info = extracted_info
+        state = update_user_profile(state, extracted_info)
     return state
 
 def check_for_new_info(state: AgentState) -> AgentState:
     """Check if the user input contains new information to memorize."""
+    extracted_info = memorize_new_info(state.user_id, state.current_user_input)
+    return apply_extracted_info(state, extracted_info)
+
+async def acheck_for_new_info(state: AgentState) -> AgentState:
+    """Async variant of check_for_new_info."""
+    extracted_info = await amemorize_new_info(state.user_id, state.current_user_input)
+    return apply_extracted_info(state, extracted_info)
+
+def schedule_memory_check(state: AgentState) -> AgentState:
+    """Start the memory check for this turn in the background.
+
+    This turn's response uses the profile as of the previous turn. The result is merged
+    into the session and saved once the check finishes (see apply_finished_memory_check),
+    or at the start of the user's next turn if that comes first (see apply_pending_memory_check).
+    """
+    with _pending_lock:
+        # The check runs in a copy of the turn's context, so its calls are recorded for the turn,
+        # marked as background work the response does not wait for
+        future = pending_memory_checks[state.user_id] = memory_executor.submit(
+            contextvars.copy_context().run, run_in_background, memorize_new_info,
+            state.user_id, state.current_user_input, PRIORITY_BACKGROUND
+        )
+    watch_memory_check(state.user_id, future)
+    return state
+
+async def aschedule_memory_check(state: AgentState) -> AgentState:
+    """Async variant of schedule_memory_check; the check runs as a task on the event loop."""
+    with _pending_lock:
+        task = pending_async_memory_checks[state.user_id] = asyncio.create_task(
+            arun_in_background(amemorize_new_info(state.user_id, state.current_user_input, PRIORITY_BACKGROUND))
+        )
+    watch_memory_check(state.user_id, task)
+    return state
+
+def watch_memory_check(user_id: str, check):
+    """Merge a background memory check (a Future or Task) into the user's session once it finishes."""
+    def on_done(check):
+        try:
+            memory_apply_executor.submit(apply_finished_memory_check, user_id, check)
+        except RuntimeError:
+            # Shutting down; wait_for_pending_memory_checks merges it
+            pass
+    check.add_done_callback(on_done)
+
+def memory_check_result(user_id: str, check) -> Dict[str, Any]:
+    """Return what a background memory check extracted, waiting for a Future; {} if it failed or was cancelled."""
+    if check.cancelled():
+        return {}
     try:
-        result = memory_check_chain.invoke({"input": state.current_user_input})
-        if result["text"].strip().lower() == 'yes':
-            # Extract information
-            extracted = info_extraction_chain.invoke({"input": state.current_user_input})
-            try:
-                # Get the raw text response
-                extracted_text = extracted["text"].strip()
-                
-                # Clean up any potential markdown or extra formatting
-                if "```" in extracted_text:
-                    # Extract content between triple backticks if present
-                    start = extracted_text.find("{")
-                    end = extracted_text.rfind("}") + 1
-                    if start != -1 and end != -1:
-                        extracted_text = extracted_text[start:end]
-                
-                # Try to parse the JSON
-                extracted_info = json.loads(extracted_text)
-                
-                if not isinstance(extracted_info, dict):
-                    print("Error: Extracted information is not a dictionary")
-                    return state
-                
-                # Add timestamp if not present
-                if "timestamp" not in extracted_info:
-                    extracted_info["timestamp"] = datetime.now().isoformat()
-                
-                state.extracted_info = extracted_info
-                
-                # Update user profile
-                state = update_user_profile(state, extracted_info)
-                
-                # Store in user-specific vector store
-                user_store = vectorstore.get_store(state.user_id)
-                for key, value in extracted_info.items():
-                    if key != "timestamp":  # Don't store timestamp as separate memory
-                        memory_text = f"{key}: {json.dumps(value)}"
-                        user_store.add_texts(
-                            texts=[memory_text],
-                            metadatas=[{
-                                "type": key,
-                                "timestamp": extracted_info["timestamp"],
-                                "user_id": state.user_id
-                            }]
-                        )
-                        print(f"Stored new information: {memory_text}")
-            except json.JSONDecodeError as e:
-                print(f"Error parsing JSON: {e}")
-                print(f"Problematic text: {extracted_text}")
-            except Exception as e:
-                print(f"Error processing information: {str(e)}")
+        with metrics.span("memory", "background_check", user_id):
+            return check.result()
     except Exception as e:
-        print(f"Error in memory check: {str(e)}")
-    
+        logger.error("Background memory check failed: %s", e, extra={"user_id": user_id})
+        return {}
+
+async def amemory_check_result(user_id: str, check) -> Dict[str, Any]:
+    """Async variant of memory_check_result for a Future or a Task."""
+    if check.cancelled():
+        return {}
+    try:
+        with metrics.span("memory", "background_check", user_id):
+            return await (asyncio.wrap_future(check) if isinstance(check, Future) else check)
+    except asyncio.CancelledError:
+        if check.cancelled():
+            return {}
+        raise
+    except Exception as e:
+        logger.error("Background memory check failed: %s", e, extra={"user_id": user_id})
+        return {}
+
+def merge_memory_check(user_id: str, check):
+    """Merge a finished background memory check into the user's session and save it; the user's lock must be held.
+
+    Does nothing if a turn of the user has merged it already.
+    """
+    with _pending_lock:
+        if pending_memory_checks.get(user_id) is check:
+            del pending_memory_checks[user_id]
+        elif pending_async_memory_checks.get(user_id) is check:
+            del pending_async_memory_checks[user_id]
+        else:
+            return
+    extracted_info = memory_check_result(user_id, check)
+    state = get_session(user_id)
+    if extracted_info and state is not None:
+        save_session(apply_extracted_info(state, extracted_info))
+
+def merge_finished_memory_checks(user_id: str):
+    """Merge the user's background memory checks that have finished; the user's lock must be held."""
+    with _pending_lock:
+        checks = [check for check in (pending_memory_checks.get(user_id), pending_async_memory_checks.get(user_id))
+                  if check is not None and check.done()]
+    for check in checks:
+        merge_memory_check(user_id, check)
+
+def apply_finished_memory_check(user_id: str, check, blocking: bool = False):
+    """Merge a finished background memory check into the user's session and save it.
+
+    Without blocking, the check of a user whose lock is held (by a turn or consolidation)
+    is left pending: the holder merges it before releasing the lock (see hold_user_lock),
+    so one user's long turn does not hold up the merges of other users.
+    """
+    lock = get_user_lock(user_id)
+    if not lock.acquire(blocking=blocking):
+        return
+    try:
+        merge_memory_check(user_id, check)
+    finally:
+        lock.release()
+
+def apply_pending_memory_check(state: AgentState) -> AgentState:
+    """Wait for the user's pending background memory check and merge its result."""
+    with _pending_lock:
+        future = pending_memory_checks.pop(state.user_id, None)
+    if future is None:
+        return state
+    return apply_extracted_info(state, memory_check_result(state.user_id, future))
+
+async def aapply_pending_memory_check(state: AgentState) -> AgentState:
+    """Async variant of apply_pending_memory_check."""
+    with _pending_lock:
+        future = pending_memory_checks.pop(state.user_id, None)
+        task = pending_async_memory_checks.pop(state.user_id, None)
+    for check in (future, task):
+        if check is not None:
+            state = apply_extracted_info(state, await amemory_check_result(state.user_id, check))
     return state
 
+def wait_for_pending_memory_checks():
+    """Block until every background memory check has been written and merged into its session."""
+    with _pending_lock:
+        futures = list(pending_memory_checks.values())
+    wait(futures)
+    with _pending_lock:
+        finished = [(user_id, check) for checks in (pending_memory_checks, pending_async_memory_checks)
+                    for user_id, check in checks.items() if check.done()]
+    for user_id, check in finished:
+        apply_finished_memory_check(user_id, check, blocking=True)
+
 def has_essential_travel_info(user_profile: Dict[str, Any]) -> Tuple[bool, List[str]]:
     """Check if the user profile has all essential travel information.
     
     Returns:
         Tuple of (has_all_info: bool, missing_info: List[str])
     """
-    required_fields = {
-        "budget": "budget information",
-        "travel_companions": "number of companions",
-        "travel_time": "preferred travel time"
-    }
-    
     missing_info = []
-    for field, description in required_fields.items():
+    for field, description in ESSENTIAL_TRAVEL_INFO.items():
         if field not in user_profile or not user_profile[field]:
             missing_info.append(description)
     
     return len(missing_info) == 0, missing_info
 
-def generate_response(state: AgentState) -> AgentState:
-    """Generate a response using the agent chain."""
-    # Get user-specific vector store and memory
-    user_store = vectorstore.get_store(state.user_id)
-    user_memory = get_user_memory(state.user_id)
-    
-    # Check if this is a new user by checking for existing memories
-    collection = user_store._collection
-    total_docs = len(collection.get()['ids'])
+def get_missing_travel_info(state: AgentState) -> List[str]:
+    """Return the essential travel information that is still missing for this user.
+
+    Fields the local extraction finds in the current input count as known, so the answer
+    is correct even while the memory check for this turn runs in the background.
+    """
+    user_profile = state.user_profile
+    if travel_fact_extractor:
+        user_profile = {**user_profile, **travel_fact_extractor.parse(state.current_user_input).info()}
+    return has_essential_travel_info(user_profile)[1]
 
+def missing_info_response(missing_info: List[str]) -> str:
+    """Build the templated question for the missing essential travel information."""
+    questions = [MISSING_INFO_QUESTIONS[description] for description in missing_info]
+    if len(questions) > 1:
+        questions = [", ".join(questions[:-1]) + " and " + questions[-1]]
+    return MISSING_INFO_TEMPLATE.format(questions=questions[0])
+
+def missing_info_responses() -> List[str]:
+    """Return every templated missing-information response, e.g. to prewarm the speech cache."""
+    descriptions = list(ESSENTIAL_TRAVEL_INFO.values())
+    return [
+        missing_info_response(list(missing))
+        for size in range(1, len(descriptions) + 1)
+        for missing in itertools.combinations(descriptions, size)
+    ]
+
+def route_response(state: AgentState) -> str:
+    """Decide how to answer the turn and count the decision.
+
+    Recommendation requests go to the recommendation chain once budget, companions and
+    travel time are known and are answered from a template asking for them otherwise;
+    everything else goes to the agent chain.
+    """
+    if not is_recommendation_request(state.current_user_input):
+        route = "agent"
+    elif get_missing_travel_info(state):
+        route = "ask_missing_info"
+    else:
+        route = "recommend"
+    with _stats_lock:
+        route_counts[route] += 1
+    return route
+
+def prepare_agent_inputs(state: AgentState) -> Dict[str, Any]:
+    """Assemble the agent chain inputs: chat history, user profile and relevant memories."""
+    # Get user-specific memory
+    user_memory = get_user_memory(state.user_id)
     
     # Get chat history from user-specific memory buffer
     chat_history = user_memory.load_memory_variables({})["chat_history"]
     
-    # Get user profile
-    user_profile = state.user_profile
-    user_profile_text = "\n".join([f"{k}: {v}" for k, v in user_profile.items()])  
+    # Get the compacted, token-budgeted user profile
+    user_profile_text = get_user_profile_text(state)
 
     # Only use memories for existing users
-    if not is_new_user:
-        # Set k to min of total docs or 3
-        k = min(3, max(1, total_docs))
-        
-        # Retrieve relevant memories for this user
-        relevant_memories = user_store.similarity_search(
-            state.current_user_input,
-            k=k
-        )
-        memory_text = "\n".join([doc.page_content for doc in relevant_memories]) if relevant_memories else ""
+    if not state.is_new_user:
+        total_docs = components.vectorstore.count(state.user_id)
+        if total_docs > 0:
+            # Set k to min of total docs or 3
+            k = min(3, total_docs)
+            
+            # Retrieve relevant memories for this user
+            relevant_memories = components.vectorstore.similarity_search(
+                state.user_id,
+                state.current_user_input,
+                k=k
+            )
+            memory_text = "\n".join([doc.page_content for doc in relevant_memories]) if relevant_memories else ""
+        else:
+            # Nothing stored yet, skip the similarity search
+            memory_text = ""
     else:
         #delete memory input for new users
         memory_text = ""
-        # For new users, only keep last five  messages in chat history
-        if len(chat_history) > 5:
-            chat_history = chat_history[-5:]
-        print("Note: New user session - only storing new memories")
+        logger.info("New user session - only storing new memories", extra={"user_id": state.user_id})
     
-    # Generate response using the agent chain
-    response = agent_chain.invoke({
+    return {
         "memory": memory_text,
         "chat_history": chat_history,
         "input": state.current_user_input,
         "user_profile": user_profile_text,
         "last_recommendation": state.last_recommendation
-    })
-    
-    # Extract the text from the response
-    response_text = response["text"]
-    
+    }
+
+def record_response(state: AgentState, response_text: str, is_recommendation: bool = True) -> AgentState:
+    """Save the interaction to the user's memory buffer and the session state."""
     # Update user-specific memory with the new interaction
+    user_memory = get_user_memory(state.user_id)
     user_memory.save_context(
         {"input": state.current_user_input},
         {"output": response_text}
     )
+    return record_response_in_state(state, response_text, user_memory, is_recommendation)
+
+async def arecord_response(state: AgentState, response_text: str, is_recommendation: bool = True) -> AgentState:
+    """Async variant of record_response; folding old turns into the summary uses ainvoke."""
+    user_memory = get_user_memory(state.user_id)
+    await user_memory.asave_context(
+        {"input": state.current_user_input},
+        {"output": response_text}
+    )
+    return record_response_in_state(state, response_text, user_memory, is_recommendation)
+
+def record_response_in_state(state: AgentState, response_text: str, user_memory: "WindowedSummaryMemory",
+                             is_recommendation: bool = True) -> AgentState:
+    """Add the interaction to the session state.
+
+    Templated questions are not recommendations, so they keep the previous last_recommendation.
+    """
+    state.history_summary = user_memory.moving_summary_buffer
     
     # Update state with the response
     state.messages.append({"role": "user", "content": state.current_user_input})
     state.messages.append({"role": "assistant", "content": response_text})
-    state.last_recommendation = response_text
+    overflow = len(state.messages) - MESSAGE_BUFFER_SIZE
+    if overflow > 0:
+        components.session_store.append_transcript(state.user_id, state.messages[:overflow])
+        del state.messages[:overflow]
+    if is_recommendation:
+        state.last_recommendation = response_text
+    
+    return state
+
+def generate_response(state: AgentState) -> AgentState:
+    """Generate a response using the agent chain."""
+    agent_inputs = prepare_agent_inputs(state)
+    
+    # Generate response using the agent chain
+    response = invoke_chain("agent", components.chains["agent"], agent_inputs)
     
+    # Extract the text from the response
+    return record_response(state, response["text"])
+
+async def agenerate_response(state: AgentState) -> AgentState:
+    """Async variant of generate_response; the similarity search runs in a worker thread."""
+    agent_inputs = await asyncio.to_thread(prepare_agent_inputs, state)
+    
+    # Generate response using the agent chain
+    response = await ainvoke_chain("agent", components.chains["agent"], agent_inputs)
+    
+    return await arecord_response(state, response["text"])
+
+def generate_recommendation(state: AgentState) -> AgentState:
+    """Generate a destination recommendation once the essential travel information is known."""
+    agent_inputs = prepare_agent_inputs(state)
+    response = invoke_chain("recommendation", components.chains["recommendation"], agent_inputs)
+    return record_response(state, response["text"])
+
+async def agenerate_recommendation(state: AgentState) -> AgentState:
+    """Async variant of generate_recommendation."""
+    agent_inputs = await asyncio.to_thread(prepare_agent_inputs, state)
+    response = await ainvoke_chain("recommendation", components.chains["recommendation"], agent_inputs)
+    return await arecord_response(state, response["text"])
+
+def ask_for_missing_info(state: AgentState) -> AgentState:
+    """Ask for the missing essential travel information from a template, without an LLM call."""
+    response_text = missing_info_response(get_missing_travel_info(state))
+    return record_response(state, response_text, is_recommendation=False)
+
+async def aask_for_missing_info(state: AgentState) -> AgentState:
+    """Async variant of ask_for_missing_info."""
+    response_text = missing_info_response(get_missing_travel_info(state))
+    return await arecord_response(state, response_text, is_recommendation=False)
+
+def timed_node(name: str, node: Callable) -> Callable:
+    """Wrap a graph node so every run of it is recorded as a metrics span."""
+    if asyncio.iscoroutinefunction(node):
+        @functools.wraps(node)
+        async def run_node(state: AgentState) -> AgentState:
+            with metrics.span("node", name):
+                return await node(state)
+    else:
+        @functools.wraps(node)
+        def run_node(state: AgentState) -> AgentState:
+            with metrics.span("node", name):
+                return node(state)
+    return run_node
+
+def build_workflow(background_memory: bool = False, use_async: bool = False):
+    """Build and compile the agent graph.
+
+    With background_memory the memory check and vector store writes run in a background
+    task while the response is generated, instead of before it. With use_async the nodes
+    are coroutines and the graph is meant to be run with ainvoke.
+    """
+    from langgraph.graph import StateGraph
+    workflow = StateGraph(AgentState)
+
+    # Add nodes, each timed
+    if background_memory:
+        check_memory = aschedule_memory_check if use_async else schedule_memory_check
+    else:
+        check_memory = acheck_for_new_info if use_async else check_for_new_info
+    workflow.add_node("check_memory", timed_node("check_memory", check_memory))
+    workflow.add_node("generate_response", timed_node(
+        "generate_response", agenerate_response if use_async else generate_response))
+    workflow.add_node("generate_recommendation", timed_node(
+        "generate_recommendation", agenerate_recommendation if use_async else generate_recommendation))
+    workflow.add_node("ask_for_missing_info", timed_node(
+        "ask_for_missing_info", aask_for_missing_info if use_async else ask_for_missing_info))
+
+    # Add edges; the router picks the response node once the memory check is done
+    workflow.add_conditional_edges("check_memory", route_response, {
+        "agent": "generate_response",
+        "recommend": "generate_recommendation",
+        "ask_missing_info": "ask_for_missing_info"
+    })
+
+    # Set entry point
+    workflow.set_entry_point("check_memory")
+
+    # Compile the graph
+    return workflow.compile()
+
+def create_session_store() -> SessionStore:
+    """Open the session snapshot store."""
+    session_store = SessionStore(SESSION_STORE_PATH, SESSION_SYNC_INTERVAL_SECONDS)
+    # Write the snapshots of the last turns when the process exits, after merging the
+    # results of their background memory checks (exit functions run in reverse order)
+    atexit.register(session_store.close)
+    atexit.register(wait_for_pending_memory_checks)
+    return session_store
+
+def discover_legacy_users() -> List[str]:
+    """Return the users created before the user index existed, from their directories and snapshots."""
+    base_dir = "./travel_memory"
+    users = set(components.session_store.user_ids())
+    if os.path.exists(base_dir):
+        # The shared vector store directory is not a user
+        users.update(d for d in os.listdir(base_dir)
+                     if os.path.isdir(os.path.join(base_dir, d)) and d != SHARED_STORE_DIR)
+    return sorted(users)
+
+def session_path(user_id: str) -> str:
+    """Path of the session file written by earlier versions, read when a user has no snapshot."""
+    return os.path.join("./travel_memory", user_id, "session.json")
+
+def flush_session(user_id: str, state: AgentState):
+    """Save a snapshot of the user's session to the session store."""
+    # The input of the last turn is not needed to resume the session
+    components.session_store.save(user_id, state.model_dump_json(exclude={"current_user_input", "chat_history"}))
+
+def load_session(user_id: str) -> Optional[AgentState]:
+    """Load the user's session snapshot, or return None if there is none."""
+    try:
+        state_json = components.session_store.load(user_id)
+        if state_json is None:
+            path = session_path(user_id)
+            if not os.path.exists(path):
+                return None
+            with open(path) as f:
+                state_json = f.read()
+        return AgentState.model_validate_json(state_json)
+    except Exception as e:
+        logger.error("Error loading session for user %s: %s", user_id, e, extra={"user_id": user_id})
+        return None
+
+# Cache of active user sessions; evicted sessions are snapshotted, though they were already
+# saved after their last turn
+active_sessions = BoundedCache(SESSION_CACHE_SIZE, SESSION_TTL_SECONDS, on_evict=flush_session)
 
+def save_session(state: AgentState):
+    """Store the user's session after a turn and save a snapshot of it."""
+    active_sessions[state.user_id] = state
+    flush_session(state.user_id, state)
+
+def get_transcript(user_id: str) -> List[Dict[str, str]]:
+    """Return the user's whole conversation: the messages moved to the transcript and those in the session."""
+    state = get_session(user_id)
+    return components.session_store.load_transcript(user_id) + (state.messages if state else [])
+
+def get_cache_stats() -> Dict[str, Dict[str, Any]]:
+    """Return the hit, miss and eviction counters of the per-user caches."""
+    stats = {
+        "active_sessions": active_sessions.stats(),
+        "user_memories": user_memories.stats()
+    }
+    vectorstore = components.peek("vectorstore")
+    if vectorstore is not None:
+        stats["vector_stores"] = vectorstore.stores.stats()
+    return stats
+
+def print_metrics():
+    """Print the calls, time, tokens and cost by kind and name for this process."""
+    print("\nTimed calls (calls, mean time, tokens, cost):")
+    for stats in metrics.stats():
+        mean_ms = stats["seconds"] * 1000 / stats["calls"]
+        line = f"- {stats['kind']} {stats['name']}: {stats['calls']} calls, {mean_ms:.1f} ms mean"
+        if stats["prompt_tokens"] or stats["completion_tokens"]:
+            line += f", {stats['prompt_tokens']} prompt + {stats['completion_tokens']} completion tokens"
+        if stats["cost_usd"]:
+            line += f", ${stats['cost_usd']:.4f}"
+        if stats["errors"]:
+            line += f", {stats['errors']} errors"
+        print(line)
+
+def print_cache_stats():
+    """Print the per-user cache statistics for this process."""
+    print("\nCache statistics:")
+    for name, stats in get_cache_stats().items():
+        print(f"- {name}: {stats['size']}/{stats['capacity']} entries, {stats['hits']} hits, "
+              f"{stats['misses']} misses, {stats['evictions']} evictions")
+    embeddings = components.peek("embeddings")
+    if embeddings is not None:
+        from embedding_providers import CachedEmbeddings
+        if isinstance(embeddings, CachedEmbeddings):
+            stats = embeddings.stats()
+            print(f"- embeddings: {stats['size']}/{embeddings.max_entries or 'unlimited'} cached, "
+                  f"{stats['hits']} hits, {stats['misses']} misses, {stats['pruned']} pruned")
+    stats = components.session_store.stats()
+    print(f"- session snapshots: {stats['snapshots']} stored ({stats['bytes'] / 1024:.1f} KB), "
+          f"{stats['saves']} saves in {stats['syncs']} syncs, {stats['loads']} loads, "
+          f"{stats['transcript_messages']} messages in transcripts")
+
+def get_session(user_id: str) -> Optional[AgentState]:
+    """Return the user's session from the cache, rehydrating an evicted session from disk."""
+    state = active_sessions.get(user_id)
+    if state is None:
+        state = load_session(user_id)
+        if state is not None:
+            active_sessions[user_id] = state
     return state
 
-# Create the graph
-workflow = StateGraph(AgentState)
+# Per-user locks: turns of the same user are serialized, different users run concurrently.
+# The same lock is held by sync turns (with) and async turns (async with) alike and by memory
+# consolidation. A lock is dropped once no one holds or waits for it, so idle users cost nothing.
+user_locks: "weakref.WeakValueDictionary[str, UserLock]" = weakref.WeakValueDictionary()
+_sessions_lock = threading.Lock()
 
-# Add nodes
-workflow.add_node("check_memory", check_for_new_info)
-workflow.add_node("generate_response", generate_response)
+def get_user_lock(user_id: str) -> UserLock:
+    """Return the lock that serializes a user's turns; keep a reference to it while it is used."""
+    with _sessions_lock:
+        lock = user_locks.get(user_id)
+        if lock is None:
+            lock = user_locks[user_id] = UserLock()
+        return lock
 
-# Add edges
-workflow.add_edge("check_memory", "generate_response")
+def wait_for_task(task: "asyncio.Task"):
+    """Block this thread until a task running on another thread's event loop is done."""
+    done = threading.Event()
+    try:
+        # Callbacks may only be added on the task's event loop
+        task.get_loop().call_soon_threadsafe(task.add_done_callback, lambda _: done.set())
+    except RuntimeError:
+        # Its event loop is closed, so it will never finish
+        return
+    done.wait()
 
-# Set entry point
-workflow.set_entry_point("check_memory")
+@contextmanager
+def hold_user_lock(user_id: str) -> Iterator[None]:
+    """Hold the user's lock; background memory checks that finished meanwhile are merged before it is released."""
+    with get_user_lock(user_id):
+        try:
+            yield
+        finally:
+            merge_finished_memory_checks(user_id)
 
-# Compile the graph
-app = workflow.compile()
+@asynccontextmanager
+async def ahold_user_lock(user_id: str) -> AsyncIterator[None]:
+    """Async variant of hold_user_lock; the checks are merged in a worker thread."""
+    async with get_user_lock(user_id):
+        try:
+            yield
+        finally:
+            await asyncio.to_thread(merge_finished_memory_checks, user_id)
 
-# Dictionary to store active user sessions
-active_sessions: Dict[str, AgentState] = {}
+@contextmanager
+def consolidation_lock(user_id: str):
+    """Keep the user's turns and background memory checks from writing while their memories are consolidated."""
+    with hold_user_lock(user_id):
+        # A background memory check started by the last turn may still be writing
+        with _pending_lock:
+            future = pending_memory_checks.get(user_id)
+            task = pending_async_memory_checks.get(user_id)
+        if future is not None:
+            wait([future])
+        if task is not None and not task.done():
+            wait_for_task(task)
+        yield
 
-# Global flag for new user status
-is_new_user = True
+def start_memory_consolidation(interval_seconds: float = CONSOLIDATION_INTERVAL_SECONDS):
+    """Consolidate all users' memories every interval_seconds in a background thread.
+
+    With the shared backend the index is not rebuilt in the background, as that would
+    block every user of a shard; deleted entries are still excluded from searches.
+    """
+    components.memory_consolidator.start(interval_seconds, get_existing_user_ids, rebuild=VECTOR_BACKEND == "per_user")
 
-def run_conversation(user_input: str, user_id: str = None) -> Tuple[str, str]:
-    """Run a single turn of conversation for a specific user."""
-    global is_new_user  # Access the global variable
+def stop_memory_consolidation():
+    """Stop the background memory consolidation, if it was started."""
+    memory_consolidator = components.peek("memory_consolidator")
+    if memory_consolidator is not None:
+        memory_consolidator.stop()
+
+def get_or_create_session(user_id: str = None, is_new_user: bool = None) -> AgentState:
+    """Return the user's session, creating it if needed.
+
+    is_new_user marks a user whose stored memories should not be used for responses;
+    sessions created without it are treated as new users.
+    """
+    with _sessions_lock:
+        state = get_session(user_id) if user_id else None
+        if state is None:
+            # Create new user session and clear any existing memory
+            state = AgentState.create_new_user(custom_id=user_id)
+            active_sessions[state.user_id] = state
+            # Initialize fresh memory for new user
+            user_memories[state.user_id] = create_user_memory()
+        if is_new_user is not None:
+            state.is_new_user = is_new_user
+        return state
+
+def save_turn_result(state: AgentState, result: Dict[str, Any]) -> str:
+    """Apply the graph result to the user's session and return the assistant's reply.
+
+    The result holds the state's values after the last node; they are assigned to the
+    session in place, without validating and copying the whole state again.
+    """
+    # Update session state
+    for field, value in result.items():
+        if field in AgentState.model_fields:
+            setattr(state, field, value)
+    save_session(state)
+    
+    # Get the last assistant message
+    return next((msg["content"] for msg in reversed(state.messages)
+                if msg["role"] == "assistant"), 
+               "I apologize, but I couldn't generate a response.")
+
+def count_turn():
+    """Count a conversation turn for the LLM call statistics."""
+    global conversation_turns
+    with _stats_lock:
+        conversation_turns += 1
+
+def run_conversation(user_input: str, user_id: str = None, read_your_writes: bool = False,
+                     is_new_user: bool = None) -> Tuple[str, str]:
+    """Run a single turn of conversation for a specific user.
+
+    In the background graph mode the response uses the profile as of the previous turn;
+    pass read_your_writes=True to memorize this turn's input before responding.
+    """
+    count_turn()
     
     # Get or create user session
-    if user_id and user_id in active_sessions:
-        state = active_sessions[user_id]
-    else:
-        # Create new user session and clear any existing memory
-        state = AgentState.create_new_user(custom_id=user_id)
-        user_id = state.user_id
-        active_sessions[user_id] = state
-        # Initialize fresh memory for new user
-        user_memories[user_id] = ConversationBufferMemory(
-            k=5,
-            return_messages=True,
-            memory_key="chat_history"
-        )
+    state = get_or_create_session(user_id, is_new_user)
+    user_id = state.user_id
     
-    state.current_user_input = user_input
-    result = app.invoke(state)
+    with metrics.turn(user_id), hold_user_lock(user_id):
+        # The session may have been evicted and rehydrated while waiting for the lock
+        state = get_session(user_id) or state
+        
+        # Merge the previous turn's background memory check, if any
+        state = apply_pending_memory_check(state)
+        
+        state.current_user_input = user_input
+        if MEMORY_GRAPH_MODE == "background" and not read_your_writes:
+            result = components.workflow(background_memory=True).invoke(state)
+        else:
+            result = components.workflow().invoke(state)
+        
+        return user_id, save_turn_result(state, result)
+
+async def arun_conversation(user_input: str, user_id: str = None, read_your_writes: bool = False,
+                            is_new_user: bool = None) -> Tuple[str, str]:
+    """Async variant of run_conversation.
+
+    Turns of the same user are serialized by a per-user lock, while turns of different
+    users run concurrently on the event loop. Loading and saving sessions run in worker
+    threads, as they read and write the session store.
+    """
+    count_turn()
     
-    # Update session state
-    active_sessions[user_id] = AgentState(
-        user_id=user_id,
-        messages=result.get("messages", state.messages),
-        memory=result.get("memory", state.memory),
-        current_user_input=result.get("current_user_input", state.current_user_input),
-        extracted_info=result.get("extracted_info", state.extracted_info),
-        last_recommendation=result.get("last_recommendation", state.last_recommendation),
-        user_profile=result.get("user_profile", state.user_profile)
-    )
+    # Get or create user session
+    state = await asyncio.to_thread(get_or_create_session, user_id, is_new_user)
+    user_id = state.user_id
     
-    # Get the last assistant message
-    last_message = next((msg["content"] for msg in reversed(result.get("messages", [])) 
-                        if msg["role"] == "assistant"), 
-                       "I apologize, but I couldn't generate a response.")
+    with metrics.turn(user_id):
+        async with ahold_user_lock(user_id):
+            # The session may have been evicted and rehydrated while waiting for the lock
+            state = await asyncio.to_thread(get_session, user_id) or state
+            
+            # Merge the previous turn's background memory check, if any
+            state = await aapply_pending_memory_check(state)
+            
+            state.current_user_input = user_input
+            if MEMORY_GRAPH_MODE == "background" and not read_your_writes:
+                result = await components.workflow(background_memory=True, use_async=True).ainvoke(state)
+            else:
+                result = await components.workflow(use_async=True).ainvoke(state)
+            
+            return user_id, await asyncio.to_thread(save_turn_result, state, result)
+
+def stream_conversation(user_input: str, user_id: str = None, read_your_writes: bool = False,
+                        is_new_user: bool = None) -> Tuple[str, Iterator[str]]:
+    """Run a single turn of conversation and stream the response as it is generated.
+
+    Returns the user ID and an iterator over the response text chunks. The memory check
+    runs when iteration starts (or in the background, as in run_conversation), and the
+    interaction is saved to the user's memory once the stream is exhausted.
+    """
+    count_turn()
+    
+    # Get or create user session
+    state = get_or_create_session(user_id, is_new_user)
+    
+    def stream_turn(state: AgentState) -> Iterator[str]:
+        with metrics.turn(state.user_id), hold_user_lock(state.user_id):
+            # The session may have been evicted and rehydrated in the meantime
+            state = get_session(state.user_id) or state
+            
+            # Merge the previous turn's background memory check, if any
+            state = apply_pending_memory_check(state)
+            
+            state.current_user_input = user_input
+            # The same steps as the graph nodes, timed under the same names
+            with metrics.span("node", "check_memory"):
+                if MEMORY_GRAPH_MODE == "background" and not read_your_writes:
+                    state = schedule_memory_check(state)
+                else:
+                    state = check_for_new_info(state)
+            
+            route = route_response(state)
+            if route == "ask_missing_info":
+                with metrics.span("node", "ask_for_missing_info"):
+                    response_text = missing_info_response(get_missing_travel_info(state))
+                    yield response_text
+                    save_session(record_response(state, response_text, is_recommendation=False))
+                return
+            
+            chain_name = "recommendation" if route == "recommend" else "agent"
+            with metrics.span("node", "generate_recommendation" if route == "recommend" else "generate_response"):
+                agent_inputs = prepare_agent_inputs(state)
+                chain = components.chains[f"{chain_name}_stream"]
+                chunks = []
+                for chunk in stream_chain(chain_name, chain, agent_inputs):
+                    chunks.append(chunk)
+                    yield chunk
+                
+                # Save the interaction once the whole response has been streamed
+                save_session(record_response(state, "".join(chunks)))
+    
+    return state.user_id, stream_turn(state)
+
+async def astream_conversation(user_input: str, user_id: str = None, read_your_writes: bool = False,
+                               is_new_user: bool = None) -> Tuple[str, AsyncIterator[str]]:
+    """Async variant of stream_conversation; sessions are loaded and saved in worker threads."""
+    count_turn()
+    
+    # Get or create user session
+    state = await asyncio.to_thread(get_or_create_session, user_id, is_new_user)
+    
+    async def stream_turn(state: AgentState) -> AsyncIterator[str]:
+        with metrics.turn(state.user_id):
+            async with ahold_user_lock(state.user_id):
+                # The session may have been evicted and rehydrated in the meantime
+                state = await asyncio.to_thread(get_session, state.user_id) or state
+                
+                # Merge the previous turn's background memory check, if any
+                state = await aapply_pending_memory_check(state)
+                
+                state.current_user_input = user_input
+                # The same steps as the graph nodes, timed under the same names
+                with metrics.span("node", "check_memory"):
+                    if MEMORY_GRAPH_MODE == "background" and not read_your_writes:
+                        state = await aschedule_memory_check(state)
+                    else:
+                        state = await acheck_for_new_info(state)
+                
+                route = route_response(state)
+                if route == "ask_missing_info":
+                    with metrics.span("node", "ask_for_missing_info"):
+                        response_text = missing_info_response(get_missing_travel_info(state))
+                        yield response_text
+                        await asyncio.to_thread(save_session, await arecord_response(state, response_text,
+                                                                                     is_recommendation=False))
+                    return
+                
+                chain_name = "recommendation" if route == "recommend" else "agent"
+                with metrics.span("node", "generate_recommendation" if route == "recommend" else "generate_response"):
+                    agent_inputs = await asyncio.to_thread(prepare_agent_inputs, state)
+                    chain = components.chains[f"{chain_name}_stream"]
+                    chunks = []
+                    async for chunk in astream_chain(chain_name, chain, agent_inputs):
+                        chunks.append(chunk)
+                        yield chunk
+                    
+                    # Save the interaction once the whole response has been streamed
+                    await asyncio.to_thread(save_session, await arecord_response(state, "".join(chunks)))
     
-    return user_id, last_message
+    return state.user_id, stream_turn(state)
 
 def parse_arguments():
     """Parse command line arguments."""
     parser = argparse.ArgumentParser(description='Travel Agent Chatbot')
     parser.add_argument('--user-id', type=str, help='Existing user ID to load a specific user session')
-    parser.add_argument('--new-user-id', type=str, help='Custom three-digit ID for a new user session')
+    parser.add_argument('--new-user-id', type=str, help='Custom eight-digit ID for a new user session')
     parser.add_argument('--list-users', action='store_true', help='List all existing user IDs')
+    parser.add_argument('--consolidate-memories', action='store_true',
+                        help='Expire and merge stored memories of all users (or of --user-id) and rebuild their index')
+    parser.add_argument('--consolidation-interval', type=float, default=CONSOLIDATION_INTERVAL_SECONDS,
+                        help='Consolidate memories every this many seconds in the background during the conversation (0 to disable)')
+    parser.add_argument('--memory-mode', choices=MEMORY_EXTRACTION_MODES, default=MEMORY_EXTRACTION_MODE,
+                        help='Memory extraction mode: two prompts (check, then extract) or a single combined prompt')
+    parser.add_argument('--memory-prefilter', choices=MEMORY_PREFILTER_MODES, default=MEMORY_PREFILTER,
+                        help='Recall level of the local prefilter that skips the LLM memory check for trivial inputs')
+    parser.add_argument('--local-extraction', choices=LOCAL_EXTRACTION_MODES, default=LOCAL_EXTRACTION,
+                        help='Extract budget, travel companions and travel time locally before calling the LLM')
+    parser.add_argument('--graph-mode', choices=MEMORY_GRAPH_MODES, default=MEMORY_GRAPH_MODE,
+                        help='Run the memory check before responding or in the background while responding')
+    parser.add_argument('--show-llm-stats', action='store_true', help='Print LLM call counts and profile prompt tokens when the conversation ends')
+    parser.add_argument('--show-cache-stats', action='store_true', help='Print session and vector store cache statistics when the conversation ends')
+    parser.add_argument('--show-metrics', action='store_true', help='Print the time, tokens and cost of every kind of call when the conversation ends')
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT, help='Serve Prometheus metrics on this port (0 to disable)')
+    parser.add_argument('--log-format', choices=LOG_FORMATS, default=LOG_FORMAT, help='Log as text or as JSON lines')
     return parser.parse_args()
 
 def validate_user_id(user_id: str) -> bool:
-    """Validate if a user ID is a valid three-digit number."""
-    try:
-        num = int(user_id)
-        return 100 <= num <= 999
-    except ValueError:
-        return False
+    """Validate if a user ID is an eight-digit number, or a three-digit number for older users."""
+    return is_valid_user_id(user_id)
+
+def user_exists(user_id: str) -> bool:
+    """Check if a user ID is registered in the user index."""
+    return components.user_index.exists(user_id)
+
+def get_existing_user_ids() -> List[str]:
+    """Return all existing user IDs from the user index."""
+    return components.user_index.user_ids()
 
 def list_existing_users():
-    """List all existing user IDs from the travel_memory directory."""
+    """List all existing user IDs from the user index."""
     try:
-        base_dir = "./travel_memory"
-        if not os.path.exists(base_dir):
-            print("No existing users found.")
-            return
-        
-        users = [d for d in os.listdir(base_dir) if os.path.isdir(os.path.join(base_dir, d))]
+        users = get_existing_user_ids()
         if not users:
             print("No existing users found.")
             return
@@ -494,39 +1818,64 @@ def list_existing_users():
 if __name__ == "__main__":
     # Parse command line arguments
     args = parse_arguments()
+    configure_logging(LOG_LEVEL, args.log_format)
     
     # Handle --list-users flag
     if args.list_users:
         list_existing_users()
         sys.exit(0)
     
+    # Handle --consolidate-memories flag
+    if args.consolidate_memories:
+        user_ids = [args.user_id] if args.user_id else get_existing_user_ids()
+        print_consolidation_stats(components.memory_consolidator.run(user_ids))
+        sys.exit(0)
+    
+    if args.consolidation_interval > 0:
+        start_memory_consolidation(args.consolidation_interval)
+    
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port, METRICS_HOST)
+    
+    MEMORY_EXTRACTION_MODE = args.memory_mode
+    memory_prefilter = create_memory_prefilter(args.memory_prefilter)
+    travel_fact_extractor = TravelFactExtractor() if args.local_extraction == "on" else None
+    MEMORY_GRAPH_MODE = args.graph_mode
+    
+    # Fail before the conversation starts if the chat model cannot be created
+    try:
+        components.llm
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    
     print("Welcome to your AI Travel Agent! I'm here to help you plan your next adventure.")
     print("You can ask me for recommendations, share your travel experiences, or discuss your preferences.")
     print("Type 'quit', 'exit', or 'bye' to end the conversation.")
     
     # Initialize with provided user ID or create new session
     current_user_id = args.user_id
+    is_new_user = not current_user_id
     if current_user_id:
         print(f"\nLoading existing user session: {current_user_id}")
         # Verify user exists
-        user_dir = os.path.join("./travel_memory", current_user_id)
-        if not os.path.exists(user_dir):
+        if not user_exists(current_user_id):
             print(f"Warning: User ID {current_user_id} not found. Creating new session.")
             current_user_id = None
+            is_new_user = True
     else:
         print("\nStarting new user session")
-        is_new_user = True
     
     # Handle custom new user ID if provided
     if args.new_user_id:
         if not validate_user_id(args.new_user_id):
-            print("Error: New user ID must be a three-digit number (100-999)")
+            print("Error: New user ID must be an eight-digit number")
             sys.exit(1)
-        user_dir = os.path.join("./travel_memory", args.new_user_id)
-        if os.path.exists(user_dir):
+        if user_exists(args.new_user_id):
             print(f"Error: User ID {args.new_user_id} already exists")
             sys.exit(1)
         current_user_id = args.new_user_id
+        is_new_user = True
         print(f"\nCreating new user session with ID: {current_user_id}")
     
     # Start conversation
@@ -535,20 +1884,41 @@ if __name__ == "__main__":
         try:
             user_input = input("\nYou: ")
             if user_input.lower() in ['quit', 'exit', 'bye']:
+                wait_for_pending_memory_checks()
+                stop_memory_consolidation()
                 print("\nThank you for chatting with me! Have a great day!")
                 print(f"Your user ID is: {current_user_id}")
                 print("You can use this ID to continue our conversation later with:")
                 print(f"python travelAgent.py --user-id {current_user_id}")
+                if args.show_llm_stats:
+                    print_llm_call_stats()
+                    print_profile_token_stats()
+                if args.show_cache_stats:
+                    print_cache_stats()
+                if args.show_metrics:
+                    print_metrics()
                 break
                 
-            current_user_id, response = run_conversation(user_input, current_user_id)
-            print(f"\nTravel Agent: {response}")
+            current_user_id, response_stream = stream_conversation(user_input, current_user_id, is_new_user=is_new_user)
+            print("\nTravel Agent: ", end="", flush=True)
+            for chunk in response_stream:
+                print(chunk, end="", flush=True)
+            print()
             
         except KeyboardInterrupt:
+            wait_for_pending_memory_checks()
+            stop_memory_consolidation()
             print("\n\nConversation interrupted.")
             print(f"Your user ID is: {current_user_id}")
             print("You can use this ID to continue our conversation later with:")
             print(f"python travelAgent.py --user-id {current_user_id}")
+            if args.show_llm_stats:
+                print_llm_call_stats()
+                print_profile_token_stats()
+            if args.show_cache_stats:
+                print_cache_stats()
+            if args.show_metrics:
+                print_metrics()
             break
         except Exception as e:
             print(f"\nAn error occurred: {e}")
@@ -1,20 +1,232 @@
 from google.cloud import texttospeech
 import os
 from playsound import playsound
-import tempfile
 import pygame
+import io
+import re
+import queue
+import threading
+import hashlib
+import json
+import contextvars
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import List
+from metrics import metrics
 
-class TextToSpeech:
-    def __init__(self, credentials_path="API_key.json"):
+logger = logging.getLogger(__name__)
+
+# Price of speech synthesis in USD per million characters (Chirp 3 HD voices), for the cost metrics
+TTS_COST_PER_MILLION_CHARACTERS = float(os.getenv("TTS_COST_PER_MILLION_CHARACTERS", "30"))
+
+# A speech stream that receives no sentence for this long is given up, so a stream that is
+# never finished (e.g. its text source failed) cannot block the playback of later speech
+STREAM_IDLE_TIMEOUT_SECONDS = float(os.getenv("TTS_STREAM_IDLE_TIMEOUT_SECONDS", "120"))
+
+# A sentence ends at ., ! or ? (optionally followed by closing quotes or brackets) and whitespace
+SENTENCE_BOUNDARY = re.compile(r'(?:(?<=[.!?])|(?<=[.!?]["\')\]]))\s+')
+
+def split_sentences(text):
+    """Split text into sentences, dropping empty pieces."""
+    return [sentence.strip() for sentence in SENTENCE_BOUNDARY.split(text) if sentence.strip()]
+
+class SynthesisCache:
+    """On-disk LRU cache of synthesized audio.
+
+    Entries are keyed by a hash of the text, voice name and audio encoding and stored as one
+    file each. The least recently used files are removed once the cache exceeds max_bytes.
+    """
+
+    def __init__(self, cache_dir="./tts_cache", max_bytes=100 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self.total_bytes = sum(
+            os.path.getsize(os.path.join(cache_dir, name))
+            for name in os.listdir(cache_dir) if name.endswith(".audio")
+        )
+
+    @staticmethod
+    def key(text, voice_name, audio_encoding):
+        """Content address of a synthesis request."""
+        payload = json.dumps([text, voice_name, int(audio_encoding)])
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.audio")
+
+    def get(self, key):
+        """Return the cached audio for key, or None if it is not cached."""
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                audio_content = f.read()
+            # The modification time doubles as the last access time for LRU eviction
+            os.utime(path)
+        except OSError:
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return audio_content
+
+    def put(self, key, audio_content):
+        """Store audio under key and evict the least recently used entries if needed."""
+        path = self._path(key)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(audio_content)
+        with self.lock:
+            replaced = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(temp_path, path)
+            self.total_bytes += len(audio_content) - replaced
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """Remove the least recently used files until the cache fits; called with the lock held."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".audio"):
+                stat = os.stat(os.path.join(self.cache_dir, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        entries.sort()
+        for _, size, name in entries:
+            if self.total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                continue
+            self.total_bytes -= size
+            self.evictions += 1
+
+    def stats(self):
+        """Return the cache size and its hit, miss and eviction counters."""
+        with self.lock:
+            return {
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
+
+class SentenceBuffer:
+    """Accumulates streamed text chunks and returns sentences as soon as they are complete."""
+
+    def __init__(self):
+        self.buffer = ""
+
+    def feed(self, chunk) -> List[str]:
+        """Add a chunk of text and return the sentences it completed."""
+        self.buffer += chunk
+        # Everything up to the last sentence boundary is complete
+        last_boundary = None
+        for match in SENTENCE_BOUNDARY.finditer(self.buffer):
+            last_boundary = match.end()
+        if last_boundary is None:
+            return []
+        complete, self.buffer = self.buffer[:last_boundary], self.buffer[last_boundary:]
+        return split_sentences(complete)
+
+    def flush(self) -> List[str]:
+        """Return whatever text is left as a final sentence."""
+        sentences = split_sentences(self.buffer)
+        self.buffer = ""
+        return sentences
+
+class SpeechStream:
+    """Speaks text fed in chunks and serves as the handle for that piece of speech.
+
+    Each complete sentence is synthesized on the TextToSpeech worker pool as soon as it
+    arrives. The TextToSpeech playback worker plays the finished sentences in order from
+    memory, after any speech queued before this one.
+    """
+
+    def __init__(self, tts, pipelined=True):
+        self.tts = tts
+        self.pipelined = pipelined
+        self.sentences = SentenceBuffer()
+        self.text = ""
+        self.pending = queue.Queue()
+        self.cancelled = threading.Event()
+        self.done = threading.Event()
+
+    def feed(self, chunk):
+        """Add streamed text; complete sentences are sent off for synthesis right away."""
+        if not self.pipelined:
+            self.text += chunk
+            return
+        for sentence in self.sentences.feed(chunk):
+            self._submit(sentence)
+
+    def _submit(self, sentence):
+        if not self.cancelled.is_set():
+            # Synthesized in a copy of the caller's context, so it is recorded for the caller's turn
+            self.pending.put(self.tts.executor.submit(contextvars.copy_context().run, self.tts.synthesize, sentence))
+
+    def finish(self, wait=False):
+        """Mark the text as complete; optionally wait until it has been spoken."""
+        if self.pipelined:
+            for sentence in self.sentences.flush():
+                self._submit(sentence)
+        elif self.text.strip():
+            self._submit(self.text)
+        self.pending.put(None)
+        if wait:
+            self.wait()
+        return self
+
+    def cancel(self):
+        """Stop playback and drop any sentences that have not been played yet."""
+        self.cancelled.set()
+        self.pending.put(None)
+
+    def wait(self, timeout=None):
+        """Block until the speech has been played or cancelled; returns False on timeout."""
+        return self.done.wait(timeout)
+
+    def is_done(self):
+        return self.done.is_set()
+
+    def _play_pending(self):
+        """Play the synthesized sentences in order; runs on the playback worker."""
+        try:
+            while True:
+                try:
+                    synthesis = self.pending.get(timeout=STREAM_IDLE_TIMEOUT_SECONDS)
+                except queue.Empty:
+                    logger.warning("Speech stream received no text for %gs, giving up", STREAM_IDLE_TIMEOUT_SECONDS)
+                    self.cancelled.set()
+                    break
+                if synthesis is None or self.cancelled.is_set():
+                    break
+                try:
+                    audio_content = synthesis.result()
+                except Exception as e:
+                    logger.error("Error synthesizing speech: %s", e)
+                    continue
+                self.tts.play_audio(audio_content, self.cancelled)
+        finally:
+            self.done.set()
+
+class SpeechSynthesizer:
+    """Speech client, synthesis worker pool and synthesis cache, which can be shared by any number of players."""
+
+    def __init__(self, credentials_path="API_key.json", synthesis_workers=4,
+                 cache_dir="./tts_cache", cache_max_bytes=100 * 1024 * 1024):
         # Set credentials
         os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = credentials_path
         
         # Initialize the client
         self.client = texttospeech.TextToSpeechClient()
         
-        # Initialize pygame mixer for audio state tracking
-        pygame.mixer.init()
-        
         # Set default voice parameters
         self.voice = texttospeech.VoiceSelectionParams(
             language_code="en-US",
@@ -27,25 +239,31 @@ class TextToSpeech:
             audio_encoding=texttospeech.AudioEncoding.LINEAR16
         )
         
-        # Keep track of current audio file
-        self.current_audio = None
-
-    def stop_current_audio(self):
-        """Stop any currently playing audio and clean up."""
-        if pygame.mixer.music.get_busy():
-            pygame.mixer.music.stop()
-            pygame.mixer.music.unload()
-        if self.current_audio and os.path.exists(self.current_audio):
-            try:
-                os.remove(self.current_audio)
-                self.current_audio = None
-            except:
-                pass
-
-    def play(self, text):
-        # Stop any currently playing audio
-        self.stop_current_audio()
+        # Sentences are synthesized concurrently, so the first one can play while the rest
+        # are still being synthesized
+        self.executor = ThreadPoolExecutor(max_workers=synthesis_workers, thread_name_prefix="tts")
         
+        # Cache of synthesized audio, shared across sessions; cache_dir=None disables it
+        self.cache = SynthesisCache(cache_dir, cache_max_bytes) if cache_dir else None
+
+    def synthesize(self, text):
+        """Synthesize text and return the audio content (a WAV file in memory)."""
+        with metrics.span("tts", "synthesize", characters=len(text), cached=False) as span:
+            # Identical phrases are only synthesized once
+            if self.cache is not None:
+                key = SynthesisCache.key(text, self.voice.name, self.audio_config.audio_encoding)
+                audio_content = self.cache.get(key)
+                if audio_content is not None:
+                    span["cached"] = True
+                    return audio_content
+            
+            audio_content = self._synthesize_uncached(text)
+            span["cost_usd"] = len(text) * TTS_COST_PER_MILLION_CHARACTERS / 1_000_000
+            if self.cache is not None:
+                self.cache.put(key, audio_content)
+            return audio_content
+
+    def _synthesize_uncached(self, text):
         # Set the text input to be synthesized
         synthesis_input = texttospeech.SynthesisInput(text=text)
 
@@ -55,27 +273,116 @@ class TextToSpeech:
             voice=self.voice,
             audio_config=self.audio_config
         )
+        return response.audio_content
 
-        # Create a temporary file
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.wav') as temp_file:
-            temp_file.write(response.audio_content)
-            temp_path = temp_file.name
-            self.current_audio = temp_path
+    def prewarm(self, phrases, wait_for_completion=True):
+        """Synthesize phrases into the cache ahead of time, e.g. at startup.
 
-        # Play the audio
-        try:
-            pygame.mixer.music.load(temp_path)
-            pygame.mixer.music.play()
-            while pygame.mixer.music.get_busy():
-                pygame.time.Clock().tick(10)
-        finally:
-            # Clean up the temporary file
-            pygame.mixer.music.unload()
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
-            self.current_audio = None
+        Phrases are split into sentences, the unit that pipelined playback synthesizes.
+        """
+        sentences = {sentence for phrase in phrases for sentence in split_sentences(phrase)}
+        futures = [self.executor.submit(self.synthesize, sentence) for sentence in sentences]
+        if wait_for_completion:
+            wait(futures)
+        return futures
+
+class TextToSpeech:
+    """Plays speech synthesized by a SpeechSynthesizer, one piece of speech after the other.
+
+    Pass a shared synthesizer to serve several players (e.g. app sessions) from one client
+    and cache; without one, a synthesizer of its own is created from the other arguments.
+    """
+
+    def __init__(self, credentials_path="API_key.json", pipelined=True, synthesis_workers=4,
+                 cache_dir="./tts_cache", cache_max_bytes=100 * 1024 * 1024, synthesizer=None):
+        self.synthesizer = synthesizer or SpeechSynthesizer(credentials_path, synthesis_workers,
+                                                            cache_dir, cache_max_bytes)
+        
+        # Initialize pygame mixer for audio state tracking
+        pygame.mixer.init()
+        
+        # Sentence pipelining: start playing the first sentence while the rest are still
+        # being synthesized
+        self.pipelined = pipelined
+        
+        # Playback runs on a background worker so callers never wait for audio to finish
+        self.playback_queue = queue.Queue()
+        self.streams_lock = threading.Lock()
+        self.active_streams = []
+        self.playback_worker = threading.Thread(target=self._playback_loop, name="tts-playback", daemon=True)
+        self.playback_worker.start()
+
+    @property
+    def client(self):
+        return self.synthesizer.client
+
+    @property
+    def executor(self):
+        return self.synthesizer.executor
+
+    @property
+    def cache(self):
+        return self.synthesizer.cache
+
+    def synthesize(self, text):
+        """Synthesize text and return the audio content (a WAV file in memory)."""
+        return self.synthesizer.synthesize(text)
+
+    def prewarm(self, phrases, wait_for_completion=True):
+        """Synthesize phrases into the cache ahead of time, e.g. at startup."""
+        return self.synthesizer.prewarm(phrases, wait_for_completion)
+
+    def _playback_loop(self):
+        while True:
+            stream = self.playback_queue.get()
+            stream._play_pending()
+            with self.streams_lock:
+                self.active_streams.remove(stream)
+
+    def stop_current_audio(self):
+        """Stop the audio that is playing and cancel all queued speech."""
+        with self.streams_lock:
+            streams = list(self.active_streams)
+        for stream in streams:
+            stream.cancel()
+        # Sentences are played as Sounds on mixer channels
+        pygame.mixer.stop()
+
+    def play_audio(self, audio_content, cancelled=None):
+        """Play synthesized audio from memory and wait until it finishes or is cancelled."""
+        sound = pygame.mixer.Sound(file=io.BytesIO(audio_content))
+        channel = sound.play()
+        clock = pygame.time.Clock()
+        while channel is not None and channel.get_busy():
+            if cancelled is not None and cancelled.is_set():
+                channel.stop()
+                break
+            clock.tick(20)
+
+    def start_stream(self, interrupt=True):
+        """Start speaking text that arrives in chunks, e.g. tokens streamed from the agent.
+
+        Returns a SpeechStream; feed it chunks and call finish() once the text is complete.
+        With interrupt=False the speech is queued after the audio that is already playing.
+        """
+        if interrupt:
+            self.stop_current_audio()
+        stream = SpeechStream(self, pipelined=self.pipelined)
+        with self.streams_lock:
+            self.active_streams.append(stream)
+        self.playback_queue.put(stream)
+        return stream
+
+    def play(self, text, interrupt=True):
+        """Speak text in the background and return a SpeechStream handle right away.
+
+        Call wait() on the handle to block until playback is done, or cancel() to stop it.
+        """
+        speech = self.start_stream(interrupt=interrupt)
+        speech.feed(text)
+        return speech.finish()
 
 # Example usage
 if __name__ == "__main__":
     tts = TextToSpeech()
-    tts.play("Movies, oh my gosh, I just just absolutely love them. They're like time machines taking you to different worlds and landscapes, and um, and I just can't get enough of it.")
\ No newline at end of file
+    tts.play("Movies, oh my gosh, I just just absolutely love them. They're like time machines taking you to different worlds and landscapes, and um, and I just can't get enough of it.").wait()
@@ -0,0 +1,107 @@
+from typing import Callable, Iterable, List, Optional
+import os
+import random
+import sqlite3
+import threading
+import time
+
+# Legacy IDs are three-digit numbers; new IDs are drawn from the eight-digit numbers
+LEGACY_USER_ID_RANGE = (100, 999)
+USER_ID_RANGE = (10_000_000, 99_999_999)
+
+def is_valid_user_id(user_id: str) -> bool:
+    """Check if a user ID is a legacy three-digit ID or an eight-digit ID."""
+    if not user_id.isdigit():
+        return False
+    number = int(user_id)
+    return any(low <= number <= high and len(user_id) == len(str(low))
+               for low, high in (LEGACY_USER_ID_RANGE, USER_ID_RANGE))
+
+class UserIndex:
+    """Persistent index of all user IDs in a SQLite database.
+
+    New IDs are allocated by inserting a random ID under the primary key, so allocation is
+    atomic across threads and processes and takes one insert however many users exist.
+    Lookups and listings are answered from an in-memory copy of the index, which is only
+    reloaded when another connection has written to the database. On first use the index
+    is filled from discover_users, e.g. the user directories of earlier versions.
+    """
+
+    def __init__(self, path: str, discover_users: Optional[Callable[[], Iterable[str]]] = None,
+                 max_attempts: int = 100):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.max_attempts = max_attempts
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS users (user_id TEXT PRIMARY KEY, created REAL NOT NULL)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._lock = threading.Lock()
+        self._users: List[str] = []
+        self._known = set()
+        self._data_version = None
+        if discover_users is not None:
+            self._import(discover_users)
+
+    def _import(self, discover_users: Callable[[], Iterable[str]]):
+        with self._lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                imported = self.connection.execute("SELECT 1 FROM meta WHERE name = 'imported'").fetchone()
+                if not imported:
+                    now = time.time()
+                    self.connection.executemany(
+                        "INSERT OR IGNORE INTO users (user_id, created) VALUES (?, ?)",
+                        [(user_id, now) for user_id in discover_users()]
+                    )
+                    self.connection.execute("INSERT INTO meta (name, value) VALUES ('imported', '1')")
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def _refresh(self):
+        """Reload the in-memory index if the database changed; must be called with the lock held."""
+        # data_version changes whenever another connection commits to the database
+        data_version = self.connection.execute("PRAGMA data_version").fetchone()[0]
+        if data_version != self._data_version:
+            self._users = [row[0] for row in self.connection.execute("SELECT user_id FROM users ORDER BY created, user_id")]
+            self._known = set(self._users)
+            self._data_version = data_version
+
+    def _insert(self, user_id: str) -> bool:
+        """Insert a user ID; must be called with the lock held. Returns False if it exists."""
+        inserted = self.connection.execute(
+            "INSERT OR IGNORE INTO users (user_id, created) VALUES (?, ?)", (user_id, time.time())
+        ).rowcount == 1
+        if inserted and user_id not in self._known:
+            self._users.append(user_id)
+            self._known.add(user_id)
+        return inserted
+
+    def allocate(self) -> str:
+        """Allocate and register a new, unused user ID."""
+        with self._lock:
+            for _ in range(self.max_attempts):
+                user_id = str(random.randint(*USER_ID_RANGE))
+                if self._insert(user_id):
+                    return user_id
+        raise RuntimeError(f"Could not allocate a free user ID in {self.max_attempts} attempts")
+
+    def add(self, user_id: str) -> bool:
+        """Register a user ID; returns False if it was already registered."""
+        with self._lock:
+            return self._insert(user_id)
+
+    def exists(self, user_id: str) -> bool:
+        """Check if a user ID is registered."""
+        with self._lock:
+            self._refresh()
+            return user_id in self._known
+
+    def user_ids(self) -> List[str]:
+        """Return all registered user IDs, oldest first."""
+        with self._lock:
+            self._refresh()
+            return list(self._users)
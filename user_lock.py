@@ -0,0 +1,92 @@
+from collections import deque
+from typing import Deque, Union
+import asyncio
+import threading
+
+class UserLock:
+    """Lock shared by threads and coroutines: threads block in acquire, coroutines await aacquire.
+
+    Waiters are served in arrival order, whichever kind they are. The lock is handed to the
+    next waiter on release, so a coroutine waiting for it is woken on its event loop instead
+    of polling. Use it with "with" in threads and "async with" in coroutines.
+    """
+
+    def __init__(self):
+        self._mutex = threading.Lock()
+        self._held = False
+        # Blocked threads wait on an Event, coroutines on a future of their event loop
+        self._waiters: Deque[Union[threading.Event, asyncio.Future]] = deque()
+
+    def locked(self) -> bool:
+        with self._mutex:
+            return self._held
+
+    def acquire(self, blocking: bool = True) -> bool:
+        with self._mutex:
+            if not self._held:
+                self._held = True
+                return True
+            if not blocking:
+                return False
+            event = threading.Event()
+            self._waiters.append(event)
+        # The releasing thread hands the lock over before setting the event
+        event.wait()
+        return True
+
+    async def aacquire(self):
+        with self._mutex:
+            if not self._held:
+                self._held = True
+                return
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            with self._mutex:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    raise
+            # The lock was handed over just before the cancellation
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+
+    def _grant(self, waiter: asyncio.Future):
+        if waiter.cancelled():
+            # The coroutine stopped waiting after the lock was handed over
+            self.release()
+        else:
+            waiter.set_result(None)
+
+    def release(self):
+        with self._mutex:
+            while self._waiters:
+                waiter = self._waiters.popleft()
+                if isinstance(waiter, threading.Event):
+                    waiter.set()
+                    return
+                if waiter.cancelled():
+                    continue
+                try:
+                    waiter.get_loop().call_soon_threadsafe(self._grant, waiter)
+                    return
+                except RuntimeError:
+                    # Its event loop is closed
+                    continue
+            self._held = False
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    async def __aenter__(self):
+        await self.aacquire()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.release()
@@ -0,0 +1,367 @@
+from typing import TYPE_CHECKING, Any, Dict, Iterable, Iterator, List, Optional, Tuple
+from contextlib import contextmanager
+from bounded_cache import BoundedCache
+from metrics import metrics
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import uuid
+
+if TYPE_CHECKING:
+    from langchain.vectorstores import Chroma
+    from langchain_core.documents import Document
+
+# Directory below the base directory that holds the shared collections
+SHARED_STORE_DIR = "_shared"
+
+VECTOR_BACKENDS = ("per_user", "shared")
+
+def normalize_memory_value(value: Any) -> Any:
+    """Normalize a memory value so restatements of the same fact compare equal."""
+    if isinstance(value, str):
+        return " ".join(value.lower().split())
+    if isinstance(value, dict):
+        return {str(key).lower(): normalize_memory_value(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [normalize_memory_value(item) for item in value]
+    return value
+
+def memory_id(user_id: str, key: str, value: Any) -> str:
+    """Return the deterministic ID of a memory, derived from the user, its key and its normalized value."""
+    payload = json.dumps([user_id, key, normalize_memory_value(value)], sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def remove_orphaned_segments(directory: str, segment_ids: Iterable[str]):
+    """Delete the index directories in a Chroma directory whose segments no longer exist.
+
+    Deleting a collection removes its segments from the database, but some Chroma versions
+    leave the HNSW index directory of its vector segment on disk.
+    """
+    segment_ids = set(segment_ids)
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name in segment_ids or not os.path.isdir(path):
+            continue
+        try:
+            uuid.UUID(name)
+        except ValueError:
+            # Not a segment directory
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+
+def close_store(store: "Chroma"):
+    """Stop the Chroma system behind a store and remove it from Chroma's cache of systems.
+
+    Chroma keeps the system of every persistent client (its database connection, index
+    files and threads) in a class-level cache by directory, so dropping the store alone
+    frees nothing. Reopening the directory starts a new system.
+    """
+    from chromadb.api.client import SharedSystemClient
+    identifier = getattr(store._client, "_identifier", None)
+    # The attribute is misspelled in older Chroma versions
+    systems = getattr(SharedSystemClient, "_identifier_to_system", None)
+    if systems is None:
+        systems = getattr(SharedSystemClient, "_identifer_to_system", {})
+    system = systems.pop(identifier, None)
+    if system is None:
+        return
+    # Stopping the system leaves the HNSW index files open until the segments are garbage
+    # collected, which takes a full collection as they are in reference cycles
+    for component in system.components():
+        for segment in list(getattr(component, "_instances", {}).values()):
+            if hasattr(segment, "close_persistent_index"):
+                segment.close_persistent_index()
+    system.stop()
+
+# Initialize vector store for persistent memory with user-specific collections
+class UserAwareChroma:
+    """One persistent Chroma store per user, in the user's directory below base_dir."""
+
+    def __init__(self, base_dir: str, embedding_function, max_open_stores: int = 100,
+                 ttl_seconds: Optional[float] = None, max_counts: int = 10000):
+        self.base_dir = base_dir
+        self.embedding_function = embedding_function
+        # Open stores, least recently used ones are closed (their Chroma system is stopped);
+        # Chroma persists every write, so an evicted store is simply reopened from its
+        # directory on the next access
+        self.stores = BoundedCache(max_open_stores, ttl_seconds, on_evict=self._close_evicted)
+        # Number of memories per user, loaded from the collection on first use
+        self.counts = BoundedCache(max_counts, ttl_seconds)
+        # Stores can be opened concurrently by background memory checks; reentrant, as
+        # opening a store can evict another one
+        self._lock = threading.RLock()
+        # Number of callers using each store (by id), and the evicted stores that are still
+        # in use, by cache key; those are closed when the last caller releases them
+        self._in_use: Dict[int, int] = {}
+        self._closing: Dict[Any, "Chroma"] = {}
+
+    def _open_store(self, key: Any) -> "Chroma":
+        # Imported on first use, so importing this module does not load Chroma
+        from langchain.vectorstores import Chroma
+        user_dir = os.path.join(self.base_dir, key)
+        os.makedirs(user_dir, exist_ok=True)
+        return Chroma(
+            persist_directory=user_dir,
+            embedding_function=self.embedding_function
+        )
+
+    def _get_cached(self, key: Any) -> "Chroma":
+        with self._lock:
+            store = self.stores.get(key)
+            if store is None:
+                # A store evicted while in use is taken back instead of opening a second
+                # Chroma system on the same directory
+                store = self._closing.pop(key, None) or self._open_store(key)
+                self.stores[key] = store
+            return store
+
+    def get_store(self, user_id: str) -> "Chroma":
+        """Get or create a Chroma store for a specific user.
+
+        The store may be closed once it is evicted; use use_store to keep it open while it is used.
+        """
+        return self._get_cached(self._cache_key(user_id))
+
+    @contextmanager
+    def use_store(self, user_id: str) -> Iterator["Chroma"]:
+        """Hold a user's store for the duration of the block; it is not closed until released."""
+        key = self._cache_key(user_id)
+        with self._lock:
+            store = self._get_cached(key)
+            self._in_use[id(store)] = self._in_use.get(id(store), 0) + 1
+        try:
+            yield store
+        finally:
+            with self._lock:
+                remaining = self._in_use.pop(id(store)) - 1
+                if remaining:
+                    self._in_use[id(store)] = remaining
+                elif self._closing.get(key) is store:
+                    del self._closing[key]
+                    close_store(store)
+
+    def _close_evicted(self, key: Any, store: "Chroma"):
+        with self._lock:
+            if self._in_use.get(id(store)):
+                self._closing[key] = store
+            else:
+                close_store(store)
+
+    def _count_documents(self, user_id: str) -> int:
+        # Collection.count() is answered by the database without loading any documents
+        with self.use_store(user_id) as store:
+            return store._collection.count()
+
+    def count(self, user_id: str) -> int:
+        """Return the number of memories stored for a specific user."""
+        with self._lock:
+            if user_id in self.counts:
+                return self.counts[user_id]
+        total = self._count_documents(user_id)
+        with self._lock:
+            return self.counts.setdefault(user_id, total)
+
+    def record_added(self, user_id: str, added: int):
+        """Update the memory count after texts were added to a user's store."""
+        with self._lock:
+            # An unloaded count is read from the collection, which already includes them
+            if user_id in self.counts:
+                self.counts[user_id] += added
+
+    def add_texts(self, user_id: str, texts: List[str], metadatas: List[Dict[str, Any]],
+                  ids: Optional[List[str]] = None) -> List[str]:
+        """Add memories to a user's store."""
+        with self.use_store(user_id) as store, metrics.span("vectorstore", "add_texts", user_id, texts=len(texts)):
+            return store.add_texts(texts=texts, metadatas=metadatas, ids=ids)
+
+    def upsert_texts(self, user_id: str, ids: List[str], texts: List[str],
+                     metadatas: List[Dict[str, Any]]) -> List[str]:
+        """Write memories under deterministic IDs in one batch and return the IDs that were new.
+
+        Memories that already exist only get their metadata (e.g. the timestamp) refreshed,
+        without being embedded again; new ones are embedded and added in a single call.
+        """
+        # Later entries with the same ID win, as they would in a sequence of writes
+        entries = {entry_id: (text, metadata) for entry_id, text, metadata in zip(ids, texts, metadatas)}
+        with self.use_store(user_id) as store:
+            with metrics.span("vectorstore", "get", user_id):
+                existing = set(store.get(ids=list(entries), include=[])["ids"])
+            new_ids = [entry_id for entry_id in entries if entry_id not in existing]
+            if existing:
+                existing_ids = [entry_id for entry_id in entries if entry_id in existing]
+                with metrics.span("vectorstore", "update", user_id):
+                    store._collection.update(ids=existing_ids,
+                                             metadatas=[entries[entry_id][1] for entry_id in existing_ids])
+            if new_ids:
+                self.add_texts(
+                    user_id,
+                    texts=[entries[entry_id][0] for entry_id in new_ids],
+                    metadatas=[entries[entry_id][1] for entry_id in new_ids],
+                    ids=new_ids
+                )
+        return new_ids
+
+    def similarity_search(self, user_id: str, query: str, k: int) -> List["Document"]:
+        """Return the k memories of a user that are most similar to the query."""
+        with self.use_store(user_id) as store, metrics.span("vectorstore", "similarity_search", user_id, k=k):
+            return store.similarity_search(query, k=k)
+
+    def get_memories(self, user_id: str) -> Dict[str, List[Any]]:
+        """Return the IDs, documents, metadata and embeddings of all of a user's memories."""
+        with self.use_store(user_id) as store:
+            return store.get(include=["documents", "metadatas", "embeddings"])
+
+    def delete_memories(self, user_id: str, ids: List[str]):
+        """Delete memories of a user by ID."""
+        if ids:
+            with self.use_store(user_id) as store:
+                store.delete(ids=ids)
+        with self._lock:
+            self.counts.pop(user_id, None)
+
+    def store_path(self, user_id: str) -> str:
+        """Return the directory of the store holding a user's memories."""
+        return os.path.join(self.base_dir, user_id)
+
+    def index_size(self, user_id: str) -> int:
+        """Return the size in bytes of the store holding a user's memories."""
+        size = 0
+        for root, _, names in os.walk(self.store_path(user_id)):
+            for name in names:
+                if name != "session.json":
+                    size += os.path.getsize(os.path.join(root, name))
+        return size
+
+    def _cache_key(self, user_id: str) -> Any:
+        return user_id
+
+    def store_key(self, user_id: str) -> Tuple[str, Any]:
+        """Return a key identifying the store holding a user's memories; users with the same key share a store."""
+        return self.store_path(user_id), self._cache_key(user_id)
+
+    def rebuild_index(self, user_id: str):
+        """Recreate the collection holding a user's memories from its remaining entries.
+
+        Deleted entries are only marked as deleted in the HNSW index, so the index keeps
+        growing until the collection is rebuilt, and the database file keeps the pages of
+        deleted rows until it is vacuumed. The index directory of the old collection is
+        deleted. Stored embeddings are reused.
+        """
+        with self.use_store(user_id) as store:
+            data = store.get(include=["documents", "metadatas", "embeddings"])
+            with self._lock:
+                # The new collection is opened in the same Chroma system, so the old store is not closed
+                store.delete_collection()
+                self.stores.pop(self._cache_key(user_id))
+        with self.use_store(user_id) as store:
+            for start in range(0, len(data["ids"]), 500):
+                end = start + 500
+                store._collection.add(
+                    ids=data["ids"][start:end],
+                    embeddings=[list(embedding) for embedding in data["embeddings"][start:end]],
+                    documents=data["documents"][start:end],
+                    metadatas=data["metadatas"][start:end]
+                )
+        connection = sqlite3.connect(os.path.join(self.store_path(user_id), "chroma.sqlite3"))
+        try:
+            connection.execute("VACUUM")
+            segment_ids = [row[0] for row in connection.execute("SELECT id FROM segments")]
+        finally:
+            connection.close()
+        remove_orphaned_segments(self.store_path(user_id), segment_ids)
+
+class SharedChroma(UserAwareChroma):
+    """All users in a fixed number of shared Chroma collections, filtered by user_id metadata.
+
+    Users are assigned to shards by a stable hash of their ID, so every shard is one
+    collection (and one HNSW index) in a single database below base_dir/_shared, however
+    many users there are. The per-user directories only hold session files.
+    """
+
+    def __init__(self, base_dir: str, embedding_function, shards: int = 1):
+        if shards < 1:
+            raise ValueError("shards must be at least 1")
+        super().__init__(base_dir, embedding_function, max_open_stores=shards)
+        self.shards = shards
+        self.shard_dir = os.path.join(base_dir, SHARED_STORE_DIR)
+        # Users whose directory is known to exist
+        self.user_dirs = set()
+
+    def shard_for(self, user_id: str) -> int:
+        """Return the shard a user's memories are stored in."""
+        digest = hashlib.sha256(user_id.encode("utf-8")).digest()
+        return int.from_bytes(digest[:8], "big") % self.shards
+
+    def _open_store(self, shard: int) -> "Chroma":
+        from langchain.vectorstores import Chroma
+        os.makedirs(self.shard_dir, exist_ok=True)
+        return Chroma(
+            collection_name=f"memories_{shard}",
+            persist_directory=self.shard_dir,
+            embedding_function=self.embedding_function
+        )
+
+    def get_shard(self, shard: int) -> "Chroma":
+        """Get or create the Chroma collection of a shard."""
+        return self._get_cached(shard)
+
+    def get_store(self, user_id: str) -> "Chroma":
+        """Get the shared collection holding a user's memories; queries must filter by user_id."""
+        return self.get_shard(self.shard_for(user_id))
+
+    def _count_documents(self, user_id: str) -> int:
+        with self.use_store(user_id) as store:
+            return len(store.get(where={"user_id": user_id}, include=[])["ids"])
+
+    def add_texts(self, user_id: str, texts: List[str], metadatas: List[Dict[str, Any]],
+                  ids: Optional[List[str]] = None) -> List[str]:
+        """Add memories to the user's shard, tagged with the user ID."""
+        if user_id not in self.user_dirs:
+            # The user directory marks the user as existing, as with the per-user layout
+            os.makedirs(os.path.join(self.base_dir, user_id), exist_ok=True)
+            self.user_dirs.add(user_id)
+        metadatas = [{**metadata, "user_id": user_id} for metadata in metadatas]
+        with self.use_store(user_id) as store, metrics.span("vectorstore", "add_texts", user_id, texts=len(texts)):
+            return store.add_texts(texts=texts, metadatas=metadatas, ids=ids)
+
+    def upsert_texts(self, user_id: str, ids: List[str], texts: List[str],
+                     metadatas: List[Dict[str, Any]]) -> List[str]:
+        # Refreshed metadata must keep the user ID the queries filter on
+        metadatas = [{**metadata, "user_id": user_id} for metadata in metadatas]
+        return super().upsert_texts(user_id, ids, texts, metadatas)
+
+    def similarity_search(self, user_id: str, query: str, k: int) -> List["Document"]:
+        """Return the k memories of a user that are most similar to the query."""
+        with self.use_store(user_id) as store, metrics.span("vectorstore", "similarity_search", user_id, k=k):
+            return store.similarity_search(query, k=k, filter={"user_id": user_id})
+
+    def get_memories(self, user_id: str) -> Dict[str, List[Any]]:
+        with self.use_store(user_id) as store:
+            return store.get(where={"user_id": user_id}, include=["documents", "metadatas", "embeddings"])
+
+    def store_path(self, user_id: str) -> str:
+        return self.shard_dir
+
+    def _close_evicted(self, key: Any, store: "Chroma"):
+        # All shards share one Chroma system, which must stay open for the other shards
+        pass
+
+    def _cache_key(self, user_id: str) -> Any:
+        return self.shard_for(user_id)
+
+    def rebuild_index(self, user_id: str):
+        """Recreate the shard holding a user's memories; this rebuilds the index of every user in the shard."""
+        super().rebuild_index(user_id)
+
+def create_vectorstore(backend: str, base_dir: str, embedding_function, shards: int = 1,
+                       max_open_stores: int = 100, ttl_seconds: Optional[float] = None) -> UserAwareChroma:
+    """Create the vector store for the given backend ("per_user" or "shared")."""
+    if backend == "shared":
+        return SharedChroma(base_dir, embedding_function, shards=shards)
+    if backend == "per_user":
+        return UserAwareChroma(base_dir, embedding_function, max_open_stores=max_open_stores,
+                               ttl_seconds=ttl_seconds)
+    raise ValueError(f"Unknown vector backend {backend}, expected one of {VECTOR_BACKENDS}")